@@ -1,7 +1,13 @@
 import re
+import csv
+import itertools
+import unicodedata
 from dotenv import load_dotenv
 import os
 import hashlib
+import io
+import shutil
+import subprocess
 import tempfile
 from urllib.parse import urlparse
 load_dotenv()
@@ -11,22 +17,29 @@ from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 import time
 import base64
+import threading
 import uuid 
 from datetime import datetime, timezone, date, timedelta
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import requests
 import boto3
 import psycopg2
+import redis
 from psycopg2 import pool
-from psycopg2.extras import RealDictCursor
+from PIL import Image, ImageOps
+from psycopg2.extras import RealDictCursor, execute_values
 import secrets
 from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import Mail
 from functools import wraps
+import click
+from markupsafe import escape
 from flask import (
     Flask, request, jsonify, render_template, send_from_directory,
-    current_app, redirect, url_for, session, g, abort, flash
+    current_app, redirect, url_for, session, g, abort, flash, Response
 )
-from flask_socketio import SocketIO, join_room
+from flask_socketio import SocketIO, join_room, leave_room, rooms
 from flask_cors import CORS
 
 
@@ -39,11 +52,24 @@ SOCKETIO_CHANNEL = "eventa_crm_socketio"
 if not REDIS_URL:
     raise RuntimeError("Falta configurar REDIS_URL para Socket.IO")
 
+# Modo multi-worker (gunicorn -w N): todo emit pasa por el message queue de
+# Redis y las cachés en memoria se invalidan por Redis pub/sub. Sin sesiones
+# pegajosas en el balanceador se usa SOCKETIO_TRANSPORTS=websocket, porque el
+# long-polling exige que cada petición de un sid caiga en el mismo worker.
+SOCKETIO_TRANSPORTS = [
+    transporte.strip()
+    for transporte in os.getenv("SOCKETIO_TRANSPORTS", "polling,websocket").split(",")
+    if transporte.strip()
+]
+if not SOCKETIO_TRANSPORTS or set(SOCKETIO_TRANSPORTS) - {"polling", "websocket"}:
+    raise RuntimeError("Configuración inválida: SOCKETIO_TRANSPORTS")
+
 socketio = SocketIO(
     app,
     cors_allowed_origins="*",
     message_queue=REDIS_URL,
-    channel=SOCKETIO_CHANNEL
+    channel=SOCKETIO_CHANNEL,
+    transports=SOCKETIO_TRANSPORTS
 )
 app.secret_key = os.getenv('SECRET_KEY')
 
@@ -150,9 +176,22 @@ def cargar_usuario_actual():
                     }
             finally:
                 liberar_db(conn)
-                
 
-    
+
+# 📌 Endpoint para gestión de usuarios y roles en el CRM
+# Decorador genérico que verifica permisos antes de ejecutar un endpoin
+def requires_permission(action):
+    def decorator(f):
+        @wraps(f)
+        def wrapped(*args, **kwargs):
+            if not g.current_user:
+                abort(403)
+            # Por ahora, asumimos que si hay usuario, tiene permiso
+            # Puedes implementar permisos reales más tarde
+            return f(*args, **kwargs)
+        return wrapped
+    return decorator
+
 
 # 📌 Ruta raíz
 @app.route("/") 
@@ -179,9 +218,11 @@ try:
     # Si es local, desactiva SSL. Si es producción (DigitalOcean/Heroku), exígelo.
     modo_ssl = "disable" if es_local else "require"
 
-    db_pool = pool.SimpleConnectionPool(
+    # ThreadedConnectionPool: el media worker comparte el pool entre hilos.
+    # Cada worker web tiene su propio pool: con -w N el total es N * maxconn.
+    db_pool = pool.ThreadedConnectionPool(
         minconn=1,
-        maxconn=10,
+        maxconn=int(os.getenv("DB_POOL_MAXCONN") or 10),
         dsn=DATABASE_URL,
         sslmode=modo_ssl  # <--- Ahora es dinámico e inteligente
     )
@@ -212,6 +253,250 @@ def liberar_db(conn):
         app.logger.error(f"Error al liberar conexión al pool: {e}")
 
 
+def conectar_db_dedicada():
+    """
+    Abre una conexión fuera del pool para sesiones de larga duración
+    (LISTEN). Quien la abre es responsable de cerrarla.
+    """
+    return psycopg2.connect(DATABASE_URL, sslmode=modo_ssl)
+
+
+# ============================================================================
+# REALTIME OUTBOX (eventos Socket.IO transaccionales)
+# ============================================================================
+# Canal LISTEN/NOTIFY que despierta al publicador de worker_realtime.py.
+REALTIME_CANAL_NOTIFY = "realtime_outbox"
+
+
+def _serializar_realtime(valor):
+    if hasattr(valor, "isoformat"):
+        return valor.isoformat()
+    raise TypeError(f"Tipo no serializable: {type(valor).__name__}")
+
+
+def encolar_evento_realtime(cursor, cliente_id, evento, payload, room=None):
+    """
+    Registra un evento Socket.IO en la transacción del cambio que lo produce.
+
+    Se publica sólo si la transacción confirma, y nunca antes: el request no
+    espera a Redis. Por omisión va a la room del tenant.
+    """
+    cursor.execute("""
+        INSERT INTO realtime_outbox (cliente_id, room, evento, payload)
+        VALUES (%s, %s, %s, %s::jsonb)
+    """, (
+        cliente_id,
+        room or f"cliente_{cliente_id}",
+        evento,
+        json.dumps(payload, default=_serializar_realtime, ensure_ascii=False),
+    ))
+    # Postgres entrega una sola notificación por transacción y canal.
+    cursor.execute("SELECT pg_notify(%s, '')", (REALTIME_CANAL_NOTIFY,))
+
+
+# Varios eventos de la misma room en un lote viajan juntos en este evento.
+REALTIME_EVENTO_LOTE = "eventos_lote"
+# Largo del texto que acompaña a resumen_chat en la room del tenant.
+REALTIME_EXTRACTO_MAX = 80
+
+_redis_realtime = None
+_redis_realtime_lock = threading.Lock()
+
+
+def _obtener_redis_realtime():
+    """Cliente Redis compartido (el mismo servidor del message queue)."""
+    global _redis_realtime
+    with _redis_realtime_lock:
+        if _redis_realtime is None:
+            _redis_realtime = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+        return _redis_realtime
+
+
+def _clave_seq_realtime(cliente_id):
+    return f"realtime:seq:{cliente_id}"
+
+
+def _clave_stream_realtime(cliente_id):
+    return f"realtime:stream:{cliente_id}"
+
+
+def _asignar_seq_realtime(eventos):
+    """
+    Regresa {id_outbox: seq}: conserva el seq ya guardado en el outbox y pide
+    a Redis el siguiente número de su tenant para los eventos que no lo tienen.
+    """
+    seqs = {}
+    conteos = OrderedDict()
+    for id_outbox, cliente_id, _room, _evento, _payload, seq in eventos:
+        if seq is not None:
+            seqs[id_outbox] = seq
+        else:
+            conteos[cliente_id] = conteos.get(cliente_id, 0) + 1
+    if not conteos:
+        return seqs
+
+    pipe = _obtener_redis_realtime().pipeline(transaction=False)
+    for cliente_id, total in conteos.items():
+        pipe.incrby(_clave_seq_realtime(cliente_id), total)
+    siguiente = {
+        cliente_id: ultimo - conteos[cliente_id] + 1
+        for cliente_id, ultimo in zip(conteos, pipe.execute())
+    }
+    for id_outbox, cliente_id, _room, _evento, _payload, seq in eventos:
+        if seq is None:
+            seqs[id_outbox] = siguiente[cliente_id]
+            siguiente[cliente_id] += 1
+    return seqs
+
+
+def _secuenciar_eventos_realtime(eventos, seqs):
+    """
+    Pone a cada evento su número de secuencia por tenant y su room (campos
+    _seq y _room del payload) y lo agrega al Redis Stream del tenant, con el seq como id de
+    entrada y recortado a REALTIME_STREAM_MAXLEN.
+
+    Sólo el publicador llama esto, así que el orden del stream es el del
+    outbox. En una reentrega el seq es el mismo y el XADD repetido se rechaza
+    sin efecto.
+    """
+    maxlen = _obtener_entero_positivo_env("REALTIME_STREAM_MAXLEN", 1000)
+    pipe = _obtener_redis_realtime().pipeline(transaction=False)
+    secuenciados = []
+    for id_outbox, cliente_id, room, evento, payload, _seq in eventos:
+        seq = seqs[id_outbox]
+        datos = dict(payload, _seq=seq, _room=room)
+        pipe.xadd(
+            _clave_stream_realtime(cliente_id),
+            {
+                "room": room,
+                "evento": evento,
+                "datos": json.dumps(datos, ensure_ascii=False),
+            },
+            id=f"{seq}-0",
+            maxlen=maxlen,
+            approximate=True,
+        )
+        secuenciados.append((id_outbox, room, evento, datos))
+
+    # Un XADD rechazado (reentrega ya agregada, o contador reiniciado con el
+    # stream vivo) no debe frenar la publicación: en el segundo caso el
+    # cliente caerá en recarga completa al sincronizar.
+    reentregados = {id_outbox for id_outbox, *_resto, seq in eventos if seq is not None}
+    for (id_outbox, *_resto), resultado in zip(secuenciados, pipe.execute(raise_on_error=False)):
+        if isinstance(resultado, Exception) and id_outbox not in reentregados:
+            app.logger.warning(
+                "Stream realtime rechazó evento: "
+                f"tipo_error={type(resultado).__name__}"
+            )
+    return secuenciados
+
+
+def _emitir_eventos_por_room(eventos):
+    """
+    Emite el lote agrupado por room: una room con un solo evento lo recibe
+    tal cual; una con varios recibe un único eventos_lote y el frontend
+    refresca una vez en lugar de una por fila.
+
+    Dentro de cada room se conserva el orden de seq. Entre rooms no: el
+    cliente lleva el último seq por room (campo _room del payload).
+    """
+    por_room = OrderedDict()
+    for _id, room, evento, payload in eventos:
+        por_room.setdefault(room, []).append((evento, payload))
+    for room, eventos_room in por_room.items():
+        if len(eventos_room) == 1:
+            evento, payload = eventos_room[0]
+            socketio.emit(evento, payload, room=room)
+            continue
+        socketio.emit(REALTIME_EVENTO_LOTE, {
+            "eventos": [
+                {"evento": evento, "datos": payload}
+                for evento, payload in eventos_room
+            ]
+        }, room=room)
+
+
+def _room_chat_realtime(cliente_id, telefono):
+    return f"cliente_{cliente_id}:chat:{telefono}"
+
+
+def encolar_mensaje_realtime(cursor, cliente_id, mensaje):
+    """
+    Encola un mensaje de chat: el payload completo sólo a la room de esa
+    conversación (quien la tiene abierta) y un resumen ligero a todo el tenant
+    para la lista de chats, notificaciones y la tarjeta del lead.
+    """
+    encolar_evento_realtime(
+        cursor,
+        cliente_id,
+        "nuevo_mensaje",
+        mensaje,
+        room=_room_chat_realtime(cliente_id, mensaje["remitente"]),
+    )
+    encolar_evento_realtime(cursor, cliente_id, "resumen_chat", {
+        "id": mensaje.get("id"),
+        "remitente": mensaje["remitente"],
+        "tipo": mensaje["tipo"],
+        "extracto": (mensaje.get("mensaje") or "")[:REALTIME_EXTRACTO_MAX],
+        "fecha": mensaje.get("fecha"),
+    })
+
+
+def publicar_eventos_realtime(limite=200):
+    """
+    Publica un lote del outbox en orden de id y lo borra.
+
+    Entrega al-menos-una-vez: si el proceso muere entre el emit y el DELETE,
+    el lote se vuelve a publicar, pero con el seq que ya quedó guardado en el
+    outbox, así que los clientes lo descartan como visto. Regresa cuántos
+    eventos publicó.
+    """
+    conn = conectar_db()
+    if not conn:
+        raise RuntimeError("db_no_disponible_realtime")
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT id, cliente_id, room, evento, payload, seq
+            FROM realtime_outbox
+            ORDER BY id
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        """, (limite,))
+        eventos = cursor.fetchall()
+        if eventos:
+            seqs = _asignar_seq_realtime(eventos)
+            nuevos = [
+                (id_outbox, seqs[id_outbox])
+                for id_outbox, *_resto, seq in eventos
+                if seq is None
+            ]
+            if nuevos:
+                # El seq se confirma antes de emitir para sobrevivir a una
+                # caída; el publicador único (advisory lock) evita carreras.
+                execute_values(cursor, """
+                    UPDATE realtime_outbox AS o
+                    SET seq = v.seq
+                    FROM (VALUES %s) AS v(id, seq)
+                    WHERE o.id = v.id
+                """, nuevos)
+                conn.commit()
+            eventos = _secuenciar_eventos_realtime(eventos, seqs)
+        _emitir_eventos_por_room(eventos)
+        if eventos:
+            cursor.execute(
+                "DELETE FROM realtime_outbox WHERE id = ANY(%s)",
+                ([fila[0] for fila in eventos],)
+            )
+        conn.commit()
+        return len(eventos)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        liberar_db(conn)
+
+
 ##################################
 # Detectar el subdominio en cada petición. 
 # Obtener el cliente_id correspondiente.
@@ -557,19 +842,19 @@ def guardar_estados_lead():
                     -- ↑↑↑ IMPORTANTE: actualizar también 'orden' y 'fijo'
                 """, (cliente_id, nombre, color, i, fijo))  # ← 'i' es el nuevo orden
         
-        conn.commit()
-        
-        # 🔹 4. Emitir evento Socket
-        socketio.emit(
+        # 🔹 4. Encolar evento Socket (se publica al confirmar)
+        encolar_evento_realtime(
+            cur,
+            cliente_id,
             "configuracion_lead_actualizada",
             {
                 "tipo": "estados",
                 "cliente_id": cliente_id,
                 "timestamp": datetime.now().isoformat(),
                 "leads_movidos": leads_movidos
-            },
-            room=f"cliente_{cliente_id}"
+            }
         )
+        conn.commit()
         
         return jsonify({"ok": True, "leads_movidos": leads_movidos}), 200
     except Exception as e:
@@ -628,18 +913,18 @@ def eliminar_estado_lead():
             WHERE cliente_id = %s AND nombre = %s
         """, (cliente_id, nombre_estado))
         
-        conn.commit()
-        
-        # Emitir evento Socket
-        socketio.emit(
+        # Encolar evento Socket (se publica al confirmar)
+        encolar_evento_realtime(
+            cur,
+            cliente_id,
             "configuracion_lead_actualizada",
             {
                 "tipo": "estados",
                 "cliente_id": cliente_id,
                 "timestamp": datetime.now().isoformat()
-            },
-            room=f"cliente_{cliente_id}"
+            }
         )
+        conn.commit()
         
         return jsonify({"ok": True}), 200
     except Exception as e:
@@ -681,22 +966,23 @@ def cambiar_estado_lead():
         if not cursor.fetchone():
             return jsonify({"error": "Estado no válido para este tenant"}), 400
         
-        # Obtener el teléfono del lead para el evento
-        cursor.execute("SELECT telefono FROM leads WHERE id = %s AND cliente_id = %s", (lead_id, cliente_id))
+        # Obtener el teléfono y el estado previo del lead para el evento
+        cursor.execute("SELECT telefono, estado FROM leads WHERE id = %s AND cliente_id = %s", (lead_id, cliente_id))
         row = cursor.fetchone()
-        telefono = row[0] if row else None
+        telefono, estado_anterior = row if row else (None, None)
         
         # Actualizar estado
         cursor.execute("UPDATE leads SET estado = %s WHERE id = %s AND cliente_id = %s", (nuevo_estado, lead_id, cliente_id))
-        conn.commit()
         
-        # Emitir evento en tiempo real
+        # Evento en tiempo real, en la misma transacción
         if telefono:
-            socketio.emit("lead_estado_actualizado", {
+            encolar_evento_realtime(cursor, cliente_id, "lead_estado_actualizado", {
                 "id": lead_id,
+                "estado_anterior": estado_anterior,
                 "estado_nuevo": nuevo_estado,
                 "telefono": telefono
-            }, room=f"cliente_{cliente_id}")
+            })
+        conn.commit()
         
         return jsonify({"mensaje": "Estado actualizado correctamente"}), 200
     except Exception as e:
@@ -747,7 +1033,6 @@ def crear_lead():
         """, (nombre, telefono, estado, notas, cliente_id))  # ✅ Usar variable estado
 
         lead_id = cursor.fetchone()
-        conn.commit()
 
         if lead_id:
             nuevo_lead = {
@@ -757,11 +1042,10 @@ def crear_lead():
                 "estado": estado,  # ✅ Enviar el estado correcto al frontend
                 "notas": notas
             }
-            socketio.emit(
-                "nuevo_lead",
-                nuevo_lead,
-                room=f"cliente_{cliente_id}"
-            )
+            encolar_evento_realtime(cursor, cliente_id, "nuevo_lead", nuevo_lead)
+        conn.commit()
+
+        if lead_id:
             return jsonify({"mensaje": "Lead creado correctamente", "lead": nuevo_lead}), 200
         else:
             return jsonify({"mensaje": "No se pudo obtener el ID del lead"}), 500
@@ -775,140 +1059,781 @@ def crear_lead():
         liberar_db(conn)
           
 
-# 📌 Ruta para obtener Leads 
-@app.route("/leads", methods=["GET"])
-def obtener_leads():
-    cliente_id = obtener_cliente_id_de_subdominio()
-    if not cliente_id:
-        return jsonify([])
+# ============================================================================
+# IMPORTACIÓN MASIVA DE LEADS (CSV / XLSX)
+# ============================================================================
+LEADS_IMPORTACION_ESTADO_DEFAULT = "✅ CONTACTO INICIAL"
+LEADS_IMPORTACION_MAX_ERRORES_REPORTE = 500
+
+# Encabezado normalizado (minúsculas, sin acentos) → columna de leads
+LEADS_IMPORTACION_COLUMNAS = {
+    "nombre": "nombre", "name": "nombre", "cliente": "nombre",
+    "telefono": "telefono", "tel": "telefono", "celular": "telefono",
+    "whatsapp": "telefono", "movil": "telefono", "phone": "telefono",
+    "notas": "notas", "nota": "notas", "comentarios": "notas", "notes": "notas",
+    "estado": "estado", "status": "estado",
+}
 
-    conn = conectar_db()
-    if not conn:
-        return jsonify([])
 
-    try:
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        cursor.execute("""
-            SELECT l.*, 
-                   (SELECT mensaje FROM mensajes WHERE remitente = l.telefono AND cliente_id = %s ORDER BY fecha DESC LIMIT 1) as ultimo_mensaje
-            FROM leads l
-            WHERE l.cliente_id = %s
-            ORDER BY l.estado
-        """, (cliente_id, cliente_id))
-        leads = cursor.fetchall()
-        return jsonify(leads if leads else [])
-    except Exception as e:
-        print("❌ Error en /leads:", str(e))
-        return jsonify([])
-    finally:
-        liberar_db(conn)
-        
+def _sin_acentos(texto):
+    return "".join(
+        c for c in unicodedata.normalize("NFKD", texto)
+        if not unicodedata.combining(c)
+    )
 
-# 📌 Ruta para eliminar un lead
-@app.route("/eliminar_lead", methods=["POST"])
-def eliminar_lead():
-    try:
-        datos = request.json
-        lead_id = datos.get("id")
-        telefono = datos.get("telefono")
-        if not lead_id or not telefono:
-            return jsonify({"error": "Faltan datos"}), 400
 
-        cliente_id = obtener_cliente_id_de_subdominio()
-        if not cliente_id:
-            return jsonify({"error": "Cliente no autorizado"}), 404
+def _normalizar_telefono_importacion(valor):
+    """Lleva 10 dígitos, 52+10 o 521+10 al formato 521XXXXXXXXXX de validar_telefono."""
+    if isinstance(valor, float) and valor.is_integer():
+        valor = int(valor)  # Excel guarda los teléfonos como número
+    digitos = re.sub(r"\D", "", str(valor or ""))
+    if len(digitos) == 10:
+        digitos = "521" + digitos
+    elif len(digitos) == 12 and digitos.startswith("52"):
+        digitos = "521" + digitos[2:]
+    return digitos
 
-        conn = conectar_db()
-        if not conn:
-            return jsonify({"error": "No se pudo conectar a la base de datos"}), 500
-        cursor = conn.cursor()
-        # 🔹 Eliminar solo si pertenece al cliente actual
-        cursor.execute("DELETE FROM mensajes WHERE remitente = %s AND cliente_id = %s", (telefono, cliente_id))
-        cursor.execute("DELETE FROM leads WHERE id = %s AND cliente_id = %s", (lead_id, cliente_id))
-        conn.commit()
-        conn.close()
 
-        # Notificar al bot
+def _filas_archivo_importacion(archivo):
+    """Itera las filas (listas de celdas) de un CSV o XLSX sin cargarlo completo."""
+    extension = os.path.splitext(archivo.filename or "")[1].lower()
+    if extension == ".xlsx":
         try:
-            requests.post(
-                f"{CAMIBOT_API_URL}/limpiar_contexto",
-                json={"telefono": telefono},
-                timeout=5
-            )
-        except Exception as e:
-            app.logger.warning(f"⚠️ No se pudo notificar al bot al eliminar lead {telefono}: {e}")
+            from openpyxl import load_workbook
+        except ImportError as exc:
+            raise ValueError("El servidor no tiene soporte para XLSX; sube un CSV") from exc
+        libro = load_workbook(archivo.stream, read_only=True, data_only=True)
+        try:
+            for fila in libro.active.iter_rows(values_only=True):
+                yield list(fila)
+        finally:
+            libro.close()
+        return
+    if extension not in ("", ".csv", ".txt"):
+        raise ValueError("Formato no soportado; usa CSV o XLSX")
 
-        socketio.emit(
-            "lead_eliminado",
-            {"id": lead_id, "telefono": telefono},
-            room=f"cliente_{cliente_id}"
-        )
-        return jsonify({"mensaje": "Lead y sus mensajes eliminados correctamente"}), 200
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
-    
-@app.route('/editar_lead', methods=['POST'])
-def editar_lead():
+    texto = io.TextIOWrapper(archivo.stream, encoding="utf-8-sig", errors="replace", newline="")
+    encabezado = texto.readline()
+    # Excel en español exporta CSV con ";"
+    delimitador = ";" if encabezado.count(";") > encabezado.count(",") else ","
+    yield from csv.reader(itertools.chain([encabezado], texto), delimiter=delimitador)
+
+
+@app.route("/leads/importar", methods=["POST"])
+def importar_leads():
+    """
+    Importa leads desde un CSV o XLSX (campo "archivo").
+
+    La primera fila es el encabezado; se reconocen nombre, telefono, notas y
+    estado (opcional). Las filas válidas se cargan con COPY a una tabla
+    temporal y se fusionan con un solo upsert: los leads nuevos se crean y en
+    los existentes sólo se actualizan nombre y notas no vacíos (el estado no
+    cambia). Con ?validar=1 sólo regresa el reporte sin escribir nada.
+    """
     cliente_id = obtener_cliente_id_de_subdominio()
     if not cliente_id:
         return jsonify({"error": "Cliente no autorizado"}), 404
 
-    data = request.get_json()
-    lead_id = data.get("id")
-    nuevo_nombre = data.get("nombre").strip() if data.get("nombre") else None
-    nuevo_telefono = data.get("telefono").strip() if data.get("telefono") else None
-    nuevas_notas = data.get("notas").strip() if data.get("notas") else ""
-
-    if not lead_id or not nuevo_telefono:
-        return jsonify({"error": "ID y teléfono son obligatorios"}), 400
+    archivo = request.files.get("archivo")
+    if not archivo or not archivo.filename:
+        return jsonify({"error": "No se encontró el archivo"}), 400
+    solo_validar = request.args.get("validar") == "1"
+    max_filas = _obtener_entero_positivo_env("LEADS_IMPORT_MAX_FILAS", 20000)
 
     conn = conectar_db()
     if not conn:
         return jsonify({"error": "No se pudo conectar a la base de datos"}), 500
 
+    errores = []
+    errores_total = 0
+    validas = 0
     try:
         cursor = conn.cursor()
-        cursor.execute("""
-            UPDATE leads
-            SET nombre = COALESCE(%s, nombre), 
-                telefono = %s, 
-                notas = %s
-            WHERE id = %s AND cliente_id = %s
-        """, (nuevo_nombre, nuevo_telefono, nuevas_notas, lead_id, cliente_id))
-        conn.commit()
+        cursor.execute(
+            "SELECT nombre FROM lead_estados_tenant WHERE cliente_id = %s AND activo = true",
+            (cliente_id,),
+        )
+        estados_validos = {fila[0] for fila in cursor.fetchall()}
+
+        filas = _filas_archivo_importacion(archivo)
+        encabezado = next(filas, None)
+        indices = {}
+        for i, celda in enumerate(encabezado or []):
+            clave = _sin_acentos(str(celda or "")).strip().lower()
+            columna = LEADS_IMPORTACION_COLUMNAS.get(clave)
+            if columna and columna not in indices:
+                indices[columna] = i
+        if "telefono" not in indices or "nombre" not in indices:
+            return jsonify({"error": "El encabezado debe incluir las columnas nombre y telefono"}), 400
+
+        def celda(fila, columna):
+            i = indices.get(columna)
+            valor = fila[i] if i is not None and i < len(fila) else None
+            return valor if valor is not None else ""
+
+        vistos = {}
+        with tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024, mode="w+", newline="") as carga:
+            escritor = csv.writer(carga)
+            for numero, fila in enumerate(filas, start=2):
+                if not any(str(c or "").strip() for c in fila):
+                    continue
+                if numero - 1 > max_filas:
+                    return jsonify({"error": f"El archivo excede {max_filas} filas"}), 400
+
+                nombre = str(celda(fila, "nombre")).strip()
+                telefono = _normalizar_telefono_importacion(celda(fila, "telefono"))
+                notas = str(celda(fila, "notas")).strip()
+                estado = str(celda(fila, "estado")).strip() or LEADS_IMPORTACION_ESTADO_DEFAULT
+
+                error = None
+                if not nombre:
+                    error = "Falta el nombre"
+                elif not validar_telefono(telefono):
+                    error = "El teléfono debe tener 10 dígitos o 13 con 521"
+                elif telefono in vistos:
+                    error = f"Teléfono repetido (fila {vistos[telefono]})"
+                elif estado != LEADS_IMPORTACION_ESTADO_DEFAULT and estado not in estados_validos:
+                    error = f"Estado no válido: {estado}"
+                if error:
+                    errores_total += 1
+                    if len(errores) < LEADS_IMPORTACION_MAX_ERRORES_REPORTE:
+                        errores.append({"fila": numero, "telefono": telefono or None, "error": error})
+                    continue
 
-        if cursor.rowcount == 0:
-            return jsonify({"error": "Lead no encontrado"}), 404
+                vistos[telefono] = numero
+                escritor.writerow([nombre, telefono, estado, notas])
+                validas += 1
 
-        return jsonify({"mensaje": "Lead actualizado correctamente"}), 200
+            insertados = actualizados = 0
+            if validas and not solo_validar:
+                carga.seek(0)
+                cursor.execute("""
+                    CREATE TEMP TABLE leads_importacion (
+                        nombre TEXT, telefono TEXT, estado TEXT, notas TEXT
+                    ) ON COMMIT DROP
+                """)
+                cursor.copy_expert("COPY leads_importacion FROM STDIN WITH (FORMAT csv)", carga)
+                cursor.execute("""
+                    WITH upsert AS (
+                        INSERT INTO leads (nombre, telefono, estado, notas, cliente_id)
+                        SELECT nombre, telefono, estado, notas, %s
+                        FROM leads_importacion
+                        ON CONFLICT (telefono, cliente_id) DO UPDATE
+                        SET nombre = COALESCE(NULLIF(EXCLUDED.nombre, ''), leads.nombre),
+                            notas = COALESCE(NULLIF(EXCLUDED.notas, ''), leads.notas)
+                        RETURNING (xmax = 0) AS insertado
+                    )
+                    SELECT
+                        COUNT(*) FILTER (WHERE insertado),
+                        COUNT(*) FILTER (WHERE NOT insertado)
+                    FROM upsert
+                """, (cliente_id,))
+                insertados, actualizados = cursor.fetchone()
+                # Un solo evento para toda la importación en lugar de un
+                # nuevo_lead por fila.
+                encolar_evento_realtime(cursor, cliente_id, "leads_importados", {
+                    "insertados": insertados,
+                    "actualizados": actualizados,
+                })
+                conn.commit()
+
+        app.logger.info(
+            f"Importación de leads: cliente_id={cliente_id} validas={validas} "
+            f"insertados={insertados} actualizados={actualizados} errores={errores_total}"
+        )
+        return jsonify({
+            "validas": validas,
+            "insertados": insertados,
+            "actualizados": actualizados,
+            "errores_total": errores_total,
+            "errores": errores,
+            "solo_validacion": solo_validar,
+        }), 200
+    except (ValueError, csv.Error) as e:
+        conn.rollback()
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
-        print(f"❌ Error en /editar_lead: {str(e)}")
-        return jsonify({"error": str(e)}), 500
+        conn.rollback()
+        app.logger.error(f"Error en /leads/importar: cliente_id={cliente_id} tipo_error={type(e).__name__}")
+        return jsonify({"error": "No se pudo importar el archivo"}), 500
     finally:
         liberar_db(conn)
 
-# 📌 Actualizar estado de mensaje 
-@app.route("/actualizar_estado", methods=["POST"])
-def actualizar_estado():
-    cliente_id = obtener_cliente_id_de_subdominio()
-    if not cliente_id:
-        return jsonify({"error": "Cliente no autorizado"}), 404
 
-    datos = request.json
-    mensaje_id = datos.get("id")
-    nuevo_estado = datos.get("estado")
+# ============================================================================
+# EXPORTACIÓN DE LEADS Y CONVERSACIONES (CSV / NDJSON)
+# ============================================================================
+EXPORTACION_RECURSOS = ("leads", "mensajes")
 
-    if not mensaje_id or nuevo_estado not in ["Nuevo", "En proceso", "Finalizado"]:
-        return jsonify({"error": "Datos incorrectos"}), 400
 
+def _consulta_exportacion(recurso, cliente_id, args):
+    """
+    SELECT de exportación → (sql, parámetros). Filtros opcionales: estado del
+    lead y desde/hasta (ISO) sobre last_activity en leads y fecha en mensajes.
+    Los mensajes salen agrupados por conversación y del más reciente al más
+    antiguo dentro de cada una: es el orden exacto del índice de la
+    migración 008 y no requiere ordenar el resultado.
+    """
+    condiciones = []
+    parametros = [cliente_id]
+    estado = (args.get("estado") or "").strip()
+    if estado:
+        condiciones.append("l.estado = %s")
+        parametros.append(estado)
+    columna_fecha = "l.last_activity" if recurso == "leads" else "m.fecha"
+    for nombre, operador in (("desde", ">="), ("hasta", "<")):
+        valor = (args.get(nombre) or "").strip()
+        if valor:
+            condiciones.append(f"{columna_fecha} {operador} %s")
+            parametros.append(datetime.fromisoformat(valor))
+    filtros = "".join(f" AND {condicion}" for condicion in condiciones)
+
+    if recurso == "leads":
+        return f"""
+            SELECT l.id, l.nombre, l.telefono, l.estado, l.notas, l.last_activity
+            FROM leads l
+            WHERE l.cliente_id = %s{filtros}
+            ORDER BY l.id
+        """, parametros
+    return f"""
+        SELECT
+            m.id, m.remitente, l.nombre, l.estado AS estado_lead,
+            m.tipo, m.estado, m.fecha, m.mensaje
+        FROM mensajes m
+        LEFT JOIN leads l
+            ON l.cliente_id = m.cliente_id AND l.telefono = m.remitente
+        WHERE m.cliente_id = %s{filtros}
+        ORDER BY m.remitente, m.fecha DESC, m.id DESC
+    """, parametros
+
+
+def _valor_exportacion_json(valor):
+    return valor.isoformat() if hasattr(valor, "isoformat") else str(valor)
+
+
+def _generar_exportacion(sql, parametros, formato, tamano_lote):
+    """
+    Genera el archivo por bloques desde un cursor con nombre (server-side):
+    la memoria no depende del tamaño del tenant. La conexión se toma al
+    empezar a iterar y se libera al terminar o si el cliente corta.
+    """
     conn = conectar_db()
     if not conn:
-        return jsonify({"error": "No se pudo conectar a la base de datos"}), 500
+        raise RuntimeError("No se pudo conectar a la base de datos")
+    try:
+        # Una sola instantánea para todo el archivo.
+        conn.cursor().execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+        cursor = conn.cursor(name=f"exportacion_{uuid.uuid4().hex}")
+        cursor.itersize = tamano_lote
+        cursor.execute(sql, parametros)
+
+        bloque = io.StringIO()
+        escritor = csv.writer(bloque)
+        columnas = None
+        while True:
+            filas = cursor.fetchmany(tamano_lote)
+            if columnas is None:
+                columnas = [d[0] for d in cursor.description]
+                if formato == "csv":
+                    escritor.writerow(columnas)
+            if not filas:
+                break
+            for fila in filas:
+                if formato == "csv":
+                    escritor.writerow(fila)
+                else:
+                    bloque.write(json.dumps(
+                        dict(zip(columnas, fila)),
+                        ensure_ascii=False,
+                        default=_valor_exportacion_json,
+                    ))
+                    bloque.write("\n")
+            yield bloque.getvalue()
+            bloque.seek(0)
+            bloque.truncate()
+        if bloque.tell():
+            yield bloque.getvalue()
+    finally:
+        conn.rollback()
+        liberar_db(conn)
+
 
+@app.route("/api/exportar/<recurso>", methods=["GET"])
+@requires_permission("export_data")
+def exportar_recurso(recurso):
+    """
+    Descarga leads o mensajes del tenant como CSV (?formato=csv, por omisión)
+    o NDJSON (?formato=ndjson), en streaming. Filtros: estado, desde, hasta.
+    Requiere sesión de un usuario del tenant.
+    """
+    cliente_id = g.current_user["cliente_id"]
+    if recurso not in EXPORTACION_RECURSOS:
+        return jsonify({"error": "Recurso no válido"}), 404
+    formato = request.args.get("formato") or "csv"
+    if formato not in ("csv", "ndjson"):
+        return jsonify({"error": "Formato no válido"}), 400
     try:
-        cursor = conn.cursor()
-        cursor.execute(
-            "UPDATE mensajes SET estado = %s WHERE id = %s AND cliente_id = %s",
+        sql, parametros = _consulta_exportacion(recurso, cliente_id, request.args)
+    except ValueError:
+        return jsonify({"error": "Parámetros inválidos"}), 400
+
+    tamano_lote = _obtener_entero_positivo_env("EXPORT_BATCH_SIZE", 2000)
+    nombre_archivo = f"{recurso}_{datetime.now().strftime('%Y%m%d_%H%M')}.{formato}"
+    app.logger.info(f"Exportación: cliente_id={cliente_id} recurso={recurso} formato={formato}")
+    return Response(
+        _generar_exportacion(sql, parametros, formato, tamano_lote),
+        mimetype="text/csv" if formato == "csv" else "application/x-ndjson",
+        headers={
+            "Content-Disposition": f'attachment; filename="{nombre_archivo}"',
+            "X-Accel-Buffering": "no",
+        },
+    )
+
+
+@app.cli.command("exportar")
+@click.option("--cliente-id", type=int, required=True, help="Tenant a exportar.")
+@click.option("--recurso", type=click.Choice(EXPORTACION_RECURSOS), default="mensajes", show_default=True)
+@click.option("--salida", type=click.Path(dir_okay=False, writable=True), default="-", help="Archivo CSV (por omisión stdout).")
+@click.option("--estado", default=None, help="Sólo leads en este estado.")
+@click.option("--desde", default=None, help="Fecha ISO inicial (inclusive).")
+@click.option("--hasta", default=None, help="Fecha ISO final (exclusiva).")
+def exportar_command(cliente_id, recurso, salida, estado, desde, hasta):
+    """Exporta leads o mensajes a CSV con COPY ... TO STDOUT (exportaciones completas sin pasar por HTTP)."""
+    sql, parametros = _consulta_exportacion(
+        recurso, cliente_id, {"estado": estado, "desde": desde, "hasta": hasta}
+    )
+    conn = conectar_db()
+    if not conn:
+        raise RuntimeError("No se pudo conectar a la base de datos")
+    try:
+        cursor = conn.cursor()
+        consulta = cursor.mogrify(sql, parametros).decode()
+        with click.open_file(salida, "w", encoding="utf-8", newline="") as destino:
+            cursor.copy_expert(f"COPY ({consulta}) TO STDOUT WITH (FORMAT csv, HEADER)", destino)
+        click.echo(json.dumps({"recurso": recurso, "filas": cursor.rowcount}), err=True)
+    finally:
+        conn.rollback()
+        liberar_db(conn)
+
+
+# 📌 Ruta para obtener Leads 
+@app.route("/leads", methods=["GET"])
+def obtener_leads():
+    cliente_id = obtener_cliente_id_de_subdominio()
+    if not cliente_id:
+        return jsonify([])
+
+    conn = conectar_db()
+    if not conn:
+        return jsonify([])
+
+    try:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        cursor.execute("""
+            SELECT l.*,
+                   cs.ultimo_mensaje,
+                   COALESCE(cs.no_leidos, 0) AS no_leidos
+            FROM leads l
+            LEFT JOIN conversation_summary cs
+                ON cs.cliente_id = l.cliente_id AND cs.remitente = l.telefono
+            WHERE l.cliente_id = %s
+            ORDER BY l.estado
+        """, (cliente_id,))
+        leads = cursor.fetchall()
+        return jsonify(leads if leads else [])
+    except Exception as e:
+        print("❌ Error en /leads:", str(e))
+        return jsonify([])
+    finally:
+        liberar_db(conn)
+        
+
+def _escapar_like(texto):
+    return texto.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _filtros_leads_api(args):
+    """
+    Filtros comunes de /api/leads y /api/leads/conteos → (sql, parámetros).
+    q es prefijo de nombre (sin distinguir mayúsculas) o de teléfono;
+    actividad_desde/actividad_hasta filtran last_activity (ISO).
+    """
+    condiciones = []
+    parametros = []
+    q = (args.get("q") or "").strip()
+    if q:
+        prefijo = _escapar_like(q) + "%"
+        condiciones.append("(lower(l.nombre) LIKE lower(%s) OR l.telefono LIKE %s)")
+        parametros.extend([prefijo, prefijo])
+    for nombre, operador in (("actividad_desde", ">="), ("actividad_hasta", "<")):
+        valor = (args.get(nombre) or "").strip()
+        if valor:
+            condiciones.append(f"l.last_activity {operador} %s")
+            parametros.append(datetime.fromisoformat(valor))
+    sql = "".join(f" AND {condicion}" for condicion in condiciones)
+    return sql, parametros
+
+
+# Los leads cuyo estado no es exactamente un estado activo del tenant (NULL,
+# vacío, con espacios o de un estado ya desactivado) se muestran y cuentan en
+# la columna inicial, para que no desaparezcan del tablero.
+LEADS_COLUMNA_DEFAULT = "✅ CONTACTO INICIAL"
+
+
+def _estados_activos_leads(conn, cliente_id):
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT nombre FROM lead_estados_tenant
+            WHERE cliente_id = %s AND activo = true
+            ORDER BY orden
+        """, (cliente_id,))
+        return [nombre for (nombre,) in cursor.fetchall()]
+
+
+def _condicion_columna_leads(nombre, estados_activos):
+    """
+    (sql, parámetros) de los leads de una columna. Las columnas normales
+    filtran por igualdad y usan el índice (cliente_id, estado, id); sólo la
+    inicial toma además los leads sin estado activo.
+    """
+    if nombre != LEADS_COLUMNA_DEFAULT:
+        return "l.estado = %s", [nombre]
+    otros = [estado for estado in estados_activos if estado != LEADS_COLUMNA_DEFAULT]
+    return "(l.estado IS NULL OR l.estado <> ALL(%s::text[]))", [otros]
+
+
+def _columnas_leads_api(incluir_contexto):
+    return (
+        "l.id, l.nombre, l.telefono, l.estado, l.notas, l.last_activity, "
+        "cs.ultimo_mensaje, COALESCE(cs.no_leidos, 0) AS no_leidos"
+        + (", l.contexto" if incluir_contexto else "")
+    )
+
+
+@app.route("/api/leads", methods=["GET"])
+def api_leads():
+    """
+    Leads del tablero paginados por keyset (id descendente).
+
+    ?estado=X&before_id=N pagina una columna. Con ?por_estado=1 regresa la
+    primera página de cada estado activo en una sola consulta (UNION ALL de
+    una rama por columna). Los leads sin estado activo van en
+    LEADS_COLUMNA_DEFAULT. contexto sólo viaja con
+    ?incluir_contexto=1.
+    """
+    cliente_id = obtener_cliente_id_de_subdominio()
+    if not cliente_id:
+        return jsonify({"error": "No autorizado"}), 401
+
+    try:
+        limite = min(max(int(request.args.get("limit") or 50), 1), 200)
+        before_id = request.args.get("before_id")
+        before_id = int(before_id) if before_id else None
+        filtros_sql, filtros_parametros = _filtros_leads_api(request.args)
+    except ValueError:
+        return jsonify({"error": "Parámetros inválidos"}), 400
+    columnas = _columnas_leads_api(request.args.get("incluir_contexto") == "1")
+    estado = request.args.get("estado")
+
+    conn = conectar_db()
+    if not conn:
+        return jsonify({"error": "No se pudo conectar a la base de datos"}), 500
+    try:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        estados_activos = _estados_activos_leads(conn, cliente_id)
+        if request.args.get("por_estado") == "1":
+            consultas = []
+            parametros = []
+            for orden_columna, nombre_estado in enumerate(estados_activos):
+                condicion, parametros_condicion = _condicion_columna_leads(
+                    nombre_estado, estados_activos
+                )
+                consultas.append(f"""(
+                    SELECT %s AS columna, %s AS orden_columna, {columnas}
+                    FROM leads l
+                    LEFT JOIN conversation_summary cs
+                        ON cs.cliente_id = l.cliente_id AND cs.remitente = l.telefono
+                    WHERE l.cliente_id = %s
+                      AND {condicion}
+                      {filtros_sql}
+                    ORDER BY l.id DESC
+                    LIMIT %s
+                )""")
+                parametros.extend([
+                    nombre_estado, orden_columna, cliente_id,
+                    *parametros_condicion, *filtros_parametros, limite + 1,
+                ])
+            columnas_tablero = {}
+            if consultas:
+                cursor.execute(
+                    " UNION ALL ".join(consultas) + " ORDER BY orden_columna, id DESC",
+                    parametros,
+                )
+                for fila in cursor.fetchall():
+                    fila.pop("orden_columna")
+                    columnas_tablero.setdefault(fila.pop("columna"), []).append(dict(fila))
+            respuesta = {}
+            for nombre_estado, leads in columnas_tablero.items():
+                hay_mas = len(leads) > limite
+                leads = leads[:limite]
+                respuesta[nombre_estado] = {
+                    "leads": leads,
+                    "cursor": leads[-1]["id"] if hay_mas else None,
+                }
+            return jsonify({"columnas": respuesta})
+
+        condiciones = ["l.cliente_id = %s"]
+        parametros = [cliente_id]
+        if estado:
+            condicion, parametros_condicion = _condicion_columna_leads(estado, estados_activos)
+            condiciones.append(condicion)
+            parametros.extend(parametros_condicion)
+        if before_id is not None:
+            condiciones.append("l.id < %s")
+            parametros.append(before_id)
+        cursor.execute(f"""
+            SELECT {columnas}
+            FROM leads l
+            LEFT JOIN conversation_summary cs
+                ON cs.cliente_id = l.cliente_id AND cs.remitente = l.telefono
+            WHERE {" AND ".join(condiciones)}
+              {filtros_sql}
+            ORDER BY l.id DESC
+            LIMIT %s
+        """, [*parametros, *filtros_parametros, limite + 1])
+        leads = [dict(fila) for fila in cursor.fetchall()]
+        hay_mas = len(leads) > limite
+        leads = leads[:limite]
+        return jsonify({
+            "leads": leads,
+            "cursor": leads[-1]["id"] if hay_mas else None,
+        })
+    except Exception as e:
+        app.logger.error(f"Error en /api/leads: tipo_error={type(e).__name__}")
+        return jsonify({"error": "No se pudieron cargar los leads"}), 500
+    finally:
+        liberar_db(conn)
+
+
+@app.route("/api/leads/conteos", methods=["GET"])
+def api_leads_conteos():
+    """Conteo de leads por estado (encabezados del tablero), con los mismos filtros."""
+    cliente_id = obtener_cliente_id_de_subdominio()
+    if not cliente_id:
+        return jsonify({"error": "No autorizado"}), 401
+    try:
+        filtros_sql, filtros_parametros = _filtros_leads_api(request.args)
+    except ValueError:
+        return jsonify({"error": "Parámetros inválidos"}), 400
+
+    conn = conectar_db()
+    if not conn:
+        return jsonify({"error": "No se pudo conectar a la base de datos"}), 500
+    try:
+        cursor = conn.cursor()
+        estados_activos = _estados_activos_leads(conn, cliente_id)
+        cursor.execute(f"""
+            SELECT
+                CASE WHEN l.estado = ANY(%s::text[]) THEN l.estado ELSE %s END AS columna,
+                COUNT(*)
+            FROM leads l
+            WHERE l.cliente_id = %s
+              {filtros_sql}
+            GROUP BY 1
+        """, [estados_activos, LEADS_COLUMNA_DEFAULT, cliente_id, *filtros_parametros])
+        conteos = {estado: total for estado, total in cursor.fetchall()}
+        return jsonify({"conteos": conteos, "total": sum(conteos.values())})
+    except Exception as e:
+        app.logger.error(f"Error en /api/leads/conteos: tipo_error={type(e).__name__}")
+        return jsonify({"error": "No se pudieron contar los leads"}), 500
+    finally:
+        liberar_db(conn)
+
+
+@app.route("/api/leads/buscar", methods=["GET"])
+def api_leads_buscar():
+    """
+    Typeahead de leads: cualquier fragmento del nombre (sin acentos ni
+    mayúsculas) o del teléfono, usando los índices trigram de la migración
+    011. Con menos de 3 caracteres no hay trigramas y se busca por prefijo.
+    Primero los nombres que empiezan con q, luego por similitud y actividad.
+    """
+    cliente_id = obtener_cliente_id_de_subdominio()
+    if not cliente_id:
+        return jsonify({"error": "No autorizado"}), 401
+
+    q = (request.args.get("q") or "").strip()
+    try:
+        limite = min(max(int(request.args.get("limit") or 10), 1), 50)
+    except ValueError:
+        return jsonify({"error": "Parámetros inválidos"}), 400
+    if not q:
+        return jsonify({"leads": []})
+
+    digitos = re.sub(r"\D", "", q)
+    escapado = _escapar_like(q)
+    if len(q) < 3:
+        condicion = "lower(l.nombre) LIKE lower(%s)"
+        parametros = [escapado + "%"]
+        if digitos:
+            condicion += " OR l.telefono LIKE %s"
+            parametros.append(digitos + "%")
+    else:
+        condicion = "crm_normalizar(l.nombre) LIKE crm_normalizar(%s)"
+        parametros = ["%" + escapado + "%"]
+        # "55 1234 5678" o "+52 1..." se comparan contra los dígitos guardados
+        if len(digitos) >= 3:
+            condicion += " OR l.telefono LIKE %s"
+            parametros.append("%" + digitos + "%")
+
+    conn = conectar_db()
+    if not conn:
+        return jsonify({"error": "No se pudo conectar a la base de datos"}), 500
+    try:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        cursor.execute(f"""
+            SELECT l.id, l.nombre, l.telefono, l.estado
+            FROM leads l
+            WHERE l.cliente_id = %s
+              AND ({condicion})
+            ORDER BY
+                crm_normalizar(l.nombre) LIKE crm_normalizar(%s) DESC,
+                similarity(crm_normalizar(l.nombre), crm_normalizar(%s)) DESC,
+                l.last_activity DESC NULLS LAST,
+                l.id DESC
+            LIMIT %s
+        """, [cliente_id, *parametros, escapado + "%", q, limite])
+        return jsonify({"leads": [dict(fila) for fila in cursor.fetchall()]})
+    except Exception as e:
+        app.logger.error(f"Error en /api/leads/buscar: tipo_error={type(e).__name__}")
+        return jsonify({"error": "No se pudieron buscar los leads"}), 500
+    finally:
+        liberar_db(conn)
+
+
+# 📌 Ruta para eliminar un lead
+@app.route("/eliminar_lead", methods=["POST"])
+def eliminar_lead():
+    try:
+        datos = request.json
+        lead_id = datos.get("id")
+        telefono = datos.get("telefono")
+        if not lead_id or not telefono:
+            return jsonify({"error": "Faltan datos"}), 400
+
+        cliente_id = obtener_cliente_id_de_subdominio()
+        if not cliente_id:
+            return jsonify({"error": "Cliente no autorizado"}), 404
+
+        conn = conectar_db()
+        if not conn:
+            return jsonify({"error": "No se pudo conectar a la base de datos"}), 500
+        cursor = conn.cursor()
+        # 🔹 Eliminar solo si pertenece al cliente actual
+        cursor.execute("""
+            DELETE FROM mensajes
+            WHERE remitente = %s AND cliente_id = %s
+            RETURNING whatsapp_media_id
+        """, (telefono, cliente_id))
+        media_ids = [fila[0] for fila in cursor.fetchall() if fila[0] is not None]
+        objetos_sin_referencias = _liberar_media_de_mensajes(
+            cursor,
+            cliente_id,
+            media_ids
+        )
+        cursor.execute("DELETE FROM leads WHERE id = %s AND cliente_id = %s", (lead_id, cliente_id))
+        cursor.execute("""
+            DELETE FROM conversation_summary
+            WHERE cliente_id = %s AND remitente = %s
+        """, (cliente_id, telefono))
+        encolar_evento_realtime(
+            cursor,
+            cliente_id,
+            "lead_eliminado",
+            {"id": lead_id, "telefono": telefono}
+        )
+        conn.commit()
+        conn.close()
+        if media_ids:
+            invalidar_cache("urls_firmadas_media", cliente_id=cliente_id, media_ids=media_ids)
+        _borrar_objetos_s3_media(objetos_sin_referencias, cliente_id)
+
+        # Notificar al bot
+        try:
+            requests.post(
+                f"{CAMIBOT_API_URL}/limpiar_contexto",
+                json={"telefono": telefono},
+                timeout=5
+            )
+        except Exception as e:
+            app.logger.warning(f"⚠️ No se pudo notificar al bot al eliminar lead {telefono}: {e}")
+
+        return jsonify({"mensaje": "Lead y sus mensajes eliminados correctamente"}), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+    
+@app.route('/editar_lead', methods=['POST'])
+def editar_lead():
+    cliente_id = obtener_cliente_id_de_subdominio()
+    if not cliente_id:
+        return jsonify({"error": "Cliente no autorizado"}), 404
+
+    data = request.get_json()
+    lead_id = data.get("id")
+    nuevo_nombre = data.get("nombre").strip() if data.get("nombre") else None
+    nuevo_telefono = data.get("telefono").strip() if data.get("telefono") else None
+    nuevas_notas = data.get("notas").strip() if data.get("notas") else ""
+
+    if not lead_id or not nuevo_telefono:
+        return jsonify({"error": "ID y teléfono son obligatorios"}), 400
+
+    conn = conectar_db()
+    if not conn:
+        return jsonify({"error": "No se pudo conectar a la base de datos"}), 500
+
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE leads
+            SET nombre = COALESCE(%s, nombre), 
+                telefono = %s, 
+                notas = %s
+            WHERE id = %s AND cliente_id = %s
+        """, (nuevo_nombre, nuevo_telefono, nuevas_notas, lead_id, cliente_id))
+        conn.commit()
+
+        if cursor.rowcount == 0:
+            return jsonify({"error": "Lead no encontrado"}), 404
+
+        return jsonify({"mensaje": "Lead actualizado correctamente"}), 200
+    except Exception as e:
+        print(f"❌ Error en /editar_lead: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+    finally:
+        liberar_db(conn)
+
+# 📌 Actualizar estado de mensaje 
+@app.route("/actualizar_estado", methods=["POST"])
+def actualizar_estado():
+    cliente_id = obtener_cliente_id_de_subdominio()
+    if not cliente_id:
+        return jsonify({"error": "Cliente no autorizado"}), 404
+
+    datos = request.json
+    mensaje_id = datos.get("id")
+    nuevo_estado = datos.get("estado")
+
+    if not mensaje_id or nuevo_estado not in ["Nuevo", "En proceso", "Finalizado"]:
+        return jsonify({"error": "Datos incorrectos"}), 400
+
+    conn = conectar_db()
+    if not conn:
+        return jsonify({"error": "No se pudo conectar a la base de datos"}), 500
+
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "UPDATE mensajes SET estado = %s WHERE id = %s AND cliente_id = %s",
             (nuevo_estado, mensaje_id, cliente_id)
         )
         conn.commit()
@@ -924,6 +1849,69 @@ def actualizar_estado():
         liberar_db(conn)
 
 
+@app.route("/actualizar_estado_lote", methods=["POST"])
+def actualizar_estado_lote():
+    """
+    Versión por lote de /actualizar_estado: {"ids": [..], "estado": "X"}.
+
+    Un solo UPDATE ... WHERE id = ANY(...) y un evento
+    mensajes_estado_actualizado por conversación afectada (los estados
+    viajan a la room del chat, como los de Meta).
+    """
+    cliente_id = obtener_cliente_id_de_subdominio()
+    if not cliente_id:
+        return jsonify({"error": "Cliente no autorizado"}), 404
+
+    datos = request.get_json(silent=True) or {}
+    nuevo_estado = datos.get("estado")
+    try:
+        ids = sorted({int(i) for i in (datos.get("ids") or [])})
+    except (TypeError, ValueError):
+        return jsonify({"error": "Datos incorrectos"}), 400
+    if not ids or nuevo_estado not in ["Nuevo", "En proceso", "Finalizado"]:
+        return jsonify({"error": "Datos incorrectos"}), 400
+    if len(ids) > _obtener_entero_positivo_env("MENSAJES_ESTADO_LOTE_MAX_IDS", 1000):
+        return jsonify({"error": "Demasiados mensajes en una sola operación"}), 400
+
+    conn = conectar_db()
+    if not conn:
+        return jsonify({"error": "No se pudo conectar a la base de datos"}), 500
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE mensajes
+            SET estado = %s
+            WHERE cliente_id = %s
+              AND id = ANY(%s)
+              AND estado IS DISTINCT FROM %s
+            RETURNING id, remitente, estado
+        """, (nuevo_estado, cliente_id, ids, nuevo_estado))
+        cambios_por_chat = {}
+        for mensaje_id, remitente, estado in cursor.fetchall():
+            cambios_por_chat.setdefault(remitente, []).append({
+                "id": mensaje_id,
+                "remitente": remitente,
+                "estado": estado,
+            })
+        for remitente, cambios in cambios_por_chat.items():
+            encolar_evento_realtime(
+                cursor,
+                cliente_id,
+                "mensajes_estado_actualizado",
+                {"cliente_id": cliente_id, "mensajes": cambios},
+                room=_room_chat_realtime(cliente_id, remitente),
+            )
+        conn.commit()
+        actualizados = sum(len(cambios) for cambios in cambios_por_chat.values())
+        return jsonify({"actualizados": actualizados}), 200
+    except Exception as e:
+        conn.rollback()
+        app.logger.error(f"Error en /actualizar_estado_lote: tipo_error={type(e).__name__}")
+        return jsonify({"error": "No se pudieron actualizar los mensajes"}), 500
+    finally:
+        liberar_db(conn)
+
+
 
         
 # 📌 NUEVO: Guardar contexto del bot
@@ -1289,6 +2277,278 @@ def validar_bot_interno(request):
 # ENVÍO WHATSAPP MULTI-TENANT: FLASK -> NODE -> META
 # ============================================================================
 
+def _buscar_media_saliente(cursor, phone_id, url):
+    cursor.execute("""
+        SELECT
+            id,
+            sha256,
+            meta_media_id,
+            etag,
+            last_modified,
+            -- Sin ETag ni Last-Modified revalidar implica descargar todo el
+            -- asset, así que se hace con mucha menos frecuencia.
+            verificado_en > NOW() - (
+                CASE WHEN etag IS NULL AND last_modified IS NULL
+                     THEN %s ELSE %s END
+                * INTERVAL '1 second'
+            ) AS verificado_reciente
+        FROM whatsapp_media_salientes
+        WHERE whatsapp_phone_number_id = %s
+          AND url = %s
+          AND expira_en > NOW() + INTERVAL '1 hour'
+        ORDER BY verificado_en DESC
+        LIMIT 1
+    """, (
+        _obtener_entero_positivo_env(
+            "WHATSAPP_OUTBOUND_MEDIA_REVALIDATE_NO_VALIDATOR_SECONDS",
+            86400
+        ),
+        _obtener_entero_positivo_env(
+            "WHATSAPP_OUTBOUND_MEDIA_REVALIDATE_SECONDS",
+            300
+        ),
+        phone_id,
+        url,
+    ))
+    return cursor.fetchone()
+
+
+def _subir_media_a_meta(phone_id, token, contenido, mime_type, nombre):
+    version = os.getenv("WABA_VERSION", "v21.0").strip()
+    respuesta = requests.post(
+        f"https://graph.facebook.com/{version}/{phone_id}/media",
+        headers={"Authorization": f"Bearer {token}"},
+        data={"messaging_product": "whatsapp", "type": mime_type},
+        files={"file": (nombre, contenido, mime_type)},
+        timeout=(5, 60)
+    )
+    try:
+        if respuesta.status_code != 200:
+            raise ErrorProcesamientoMedia(
+                f"meta_upload_http_{respuesta.status_code}"
+            )
+        media_id = (respuesta.json() or {}).get("id")
+    except ValueError:
+        raise ErrorProcesamientoMedia("meta_upload_json_invalido")
+    finally:
+        respuesta.close()
+    if not media_id:
+        raise ErrorProcesamientoMedia("meta_upload_sin_id")
+    return str(media_id)
+
+
+def obtener_media_id_saliente(cursor, cliente_id, phone_id, url, tipo):
+    """
+    Media id de Meta en caché para un asset de flujo (tipo "imagen" o
+    "video"), leído con el cursor del llamador: el envío nunca descarga ni
+    sube nada.
+
+    Si no hay id o toca revalidarlo, el asset queda anotado en
+    whatsapp_media_salientes_pendientes para refrescar_medias_salientes.
+    Sin id en caché regresa None y el envío sigue por URL.
+    """
+    if urlparse(url).scheme.lower() != "https":
+        return None
+    # Misma conexión y transacción del llamador, con filas como dict.
+    cursor = cursor.connection.cursor(cursor_factory=RealDictCursor)
+    existente = _buscar_media_saliente(cursor, phone_id, url)
+    if not existente or not existente["verificado_reciente"]:
+        cursor.execute("""
+            INSERT INTO whatsapp_media_salientes_pendientes (
+                whatsapp_phone_number_id, url, cliente_id, tipo
+            )
+            VALUES (%s, %s, %s, %s)
+            ON CONFLICT (whatsapp_phone_number_id, url) DO NOTHING
+        """, (phone_id, url, cliente_id, tipo))
+    return existente["meta_media_id"] if existente else None
+
+
+def refrescar_media_saliente(cliente_id, phone_id, token, url, tipo):
+    """
+    Sube o revalida en Meta un asset de flujo (tipo "imagen" o "video").
+
+    Cada asset se sube a Meta una vez por (phone_number_id, url, sha256) y
+    se reutiliza hasta que su id expira. La URL se revalida con un GET
+    condicional (ETag / Last-Modified): si el contenido cambió, el nuevo
+    hash genera otra subida. Corre fuera del request (worker_media.py o la
+    CLI); regresa None ante cualquier problema.
+    """
+    message_type = "video" if tipo == "video" else "image"
+    if urlparse(url).scheme.lower() != "https":
+        return None
+    conn = conectar_db()
+    if not conn:
+        return None
+    try:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        existente = _buscar_media_saliente(cursor, phone_id, url)
+        if existente and existente["verificado_reciente"]:
+            return existente["meta_media_id"]
+
+        headers = {}
+        if existente and existente["etag"]:
+            headers["If-None-Match"] = existente["etag"]
+        if existente and existente["last_modified"]:
+            headers["If-Modified-Since"] = existente["last_modified"]
+
+        respuesta = requests.get(url, headers=headers, stream=True, timeout=(5, 30))
+        try:
+            if respuesta.status_code == 304 and existente:
+                cursor.execute("""
+                    UPDATE whatsapp_media_salientes
+                    SET verificado_en = NOW()
+                    WHERE id = %s
+                """, (existente["id"],))
+                conn.commit()
+                return existente["meta_media_id"]
+            if respuesta.status_code != 200:
+                raise ErrorProcesamientoMedia(
+                    f"asset_http_{respuesta.status_code}"
+                )
+
+            mime_type = (
+                respuesta.headers.get("Content-Type") or ""
+            ).split(";", 1)[0].strip().lower()
+            if mime_type not in WHATSAPP_MEDIA_MIME_EXTENSIONES[message_type]:
+                raise ErrorProcesamientoMedia("asset_mime_no_soportado")
+
+            limite_bytes = _limite_media_bytes(message_type)
+            contenido = bytearray()
+            for bloque in respuesta.iter_content(chunk_size=64 * 1024):
+                contenido.extend(bloque)
+                if len(contenido) > limite_bytes:
+                    raise ErrorProcesamientoMedia("asset_excede_limite")
+            etag = respuesta.headers.get("ETag")
+            last_modified = respuesta.headers.get("Last-Modified")
+        finally:
+            respuesta.close()
+
+        sha256 = hashlib.sha256(contenido).hexdigest()
+        if existente and existente["sha256"] == sha256:
+            meta_media_id = existente["meta_media_id"]
+        else:
+            extension = WHATSAPP_MEDIA_MIME_EXTENSIONES[message_type][mime_type]
+            meta_media_id = _subir_media_a_meta(
+                phone_id,
+                token,
+                bytes(contenido),
+                mime_type,
+                f"{sha256[:16]}.{extension}"
+            )
+            app.logger.info(
+                "Media saliente subida a Meta: "
+                f"cliente_id={cliente_id}, media_type={message_type}, "
+                f"size_bytes={len(contenido)}"
+            )
+
+        # Meta conserva la media subida 30 días; se renueva antes.
+        cursor.execute("""
+            INSERT INTO whatsapp_media_salientes (
+                cliente_id,
+                whatsapp_phone_number_id,
+                url,
+                sha256,
+                meta_media_id,
+                mime_type,
+                size_bytes,
+                etag,
+                last_modified,
+                expira_en,
+                verificado_en
+            )
+            VALUES (
+                %s, %s, %s, %s, %s, %s, %s, %s, %s,
+                NOW() + (%s * INTERVAL '1 day'),
+                NOW()
+            )
+            ON CONFLICT (whatsapp_phone_number_id, url, sha256)
+            DO UPDATE SET
+                meta_media_id = EXCLUDED.meta_media_id,
+                etag = EXCLUDED.etag,
+                last_modified = EXCLUDED.last_modified,
+                expira_en = CASE
+                    WHEN whatsapp_media_salientes.meta_media_id = EXCLUDED.meta_media_id
+                    THEN whatsapp_media_salientes.expira_en
+                    ELSE EXCLUDED.expira_en
+                END,
+                verificado_en = NOW()
+        """, (
+            cliente_id,
+            phone_id,
+            url,
+            sha256,
+            meta_media_id,
+            mime_type,
+            len(contenido),
+            etag,
+            last_modified,
+            _obtener_entero_positivo_env("WHATSAPP_OUTBOUND_MEDIA_TTL_DAYS", 29),
+        ))
+        conn.commit()
+        return meta_media_id
+    except Exception as e:
+        conn.rollback()
+        app.logger.warning(
+            "No se pudo refrescar media saliente: "
+            f"cliente_id={cliente_id}, media_type={message_type}, "
+            f"error_code={e if isinstance(e, ErrorProcesamientoMedia) else type(e).__name__}"
+        )
+        return None
+    finally:
+        liberar_db(conn)
+
+
+def refrescar_medias_salientes(limite=10):
+    """
+    Atiende hasta `limite` assets anotados por obtener_media_id_saliente,
+    los más antiguos primero. Un fallo no se reintenta aquí: el siguiente
+    envío del asset lo vuelve a anotar. Regresa cuántos se refrescaron.
+    """
+    conn = conectar_db()
+    if not conn:
+        raise RuntimeError("db_no_disponible_media_saliente")
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            DELETE FROM whatsapp_media_salientes_pendientes AS p
+            USING (
+                SELECT whatsapp_phone_number_id, url
+                FROM whatsapp_media_salientes_pendientes
+                ORDER BY solicitado_en
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            ) AS elegidos
+            WHERE p.whatsapp_phone_number_id = elegidos.whatsapp_phone_number_id
+              AND p.url = elegidos.url
+            RETURNING p.cliente_id, p.whatsapp_phone_number_id, p.url, p.tipo
+        """, (limite,))
+        pendientes = cursor.fetchall()
+        tokens = {}
+        if pendientes:
+            cursor.execute("""
+                SELECT cliente_id, whatsapp_access_token
+                FROM tenant_integraciones
+                WHERE cliente_id = ANY(%s)
+            """, (list({fila[0] for fila in pendientes}),))
+            tokens = dict(cursor.fetchall())
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        liberar_db(conn)
+
+    # Las descargas y subidas corren sin conexión tomada del pool.
+    refrescados = 0
+    for cliente_id, phone_id, url, tipo in pendientes:
+        token = desencriptar_credencial(tokens.get(cliente_id))
+        if not token:
+            continue
+        if refrescar_media_saliente(cliente_id, phone_id, token, url, tipo):
+            refrescados += 1
+    return refrescados
+
+
 def enviar_respuesta_whatsapp_tenant(
     cursor,
     cliente_id,
@@ -1297,7 +2557,8 @@ def enviar_respuesta_whatsapp_tenant(
 ):
     """
     Envía una respuesta automática usando exclusivamente
-    las credenciales WhatsApp del tenant actual.
+    las credenciales WhatsApp del tenant actual y la registra en
+    mensajes (con su wamid) dentro de la transacción de `cursor`.
 
     Soporta:
       - string -> texto
@@ -1424,6 +2685,18 @@ def enviar_respuesta_whatsapp_tenant(
                 "whatsapp_phone_id": phone_id
             }
 
+            # Con mediaId el gateway envía por id y Meta no vuelve a
+            # descargar el asset; imageUrl queda como respaldo.
+            media_id = obtener_media_id_saliente(
+                cursor,
+                cliente_id,
+                phone_id,
+                url,
+                "imagen"
+            )
+            if media_id:
+                payload["mediaId"] = media_id
+
         # VIDEO
         elif tipo_respuesta == "video":
 
@@ -1445,6 +2718,16 @@ def enviar_respuesta_whatsapp_tenant(
                 "whatsapp_phone_id": phone_id
             }
 
+            media_id = obtener_media_id_saliente(
+                cursor,
+                cliente_id,
+                phone_id,
+                url,
+                "video"
+            )
+            if media_id:
+                payload["mediaId"] = media_id
+
         # OPCIONES / BOTONES
         elif tipo_respuesta == "opciones":
 
@@ -1487,6 +2770,16 @@ def enviar_respuesta_whatsapp_tenant(
             "Formato de respuesta automática no soportado"
         )
 
+    # Flask persiste la respuesta con el wamid del gateway para aplicarle los
+    # estados delivered/read del webhook; Node sólo transporta.
+    payload["reportar_al_crm"] = False
+    if "imageUrl" in payload:
+        texto_persistido, tipo_persistido = payload["imageUrl"], "enviado_imagen"
+    elif "videoUrl" in payload:
+        texto_persistido, tipo_persistido = payload["videoUrl"], "enviado_video"
+    else:
+        texto_persistido, tipo_persistido = payload["mensaje"], "enviado"
+
     # ------------------------------------------------------------------------
     # 5. Enviar al gateway Node
     # ------------------------------------------------------------------------
@@ -1502,12 +2795,55 @@ def enviar_respuesta_whatsapp_tenant(
             f"Node respondió {response.status_code}: {response.text}"
         )
 
+    # ------------------------------------------------------------------------
+    # 6. Registrar la respuesta enviada
+    # ------------------------------------------------------------------------
+    meta_message_id = _extraer_meta_message_id(response)
+    cursor.execute("""
+        INSERT INTO mensajes (plataforma, remitente, mensaje, estado, tipo, cliente_id, fecha, meta_message_id)
+        VALUES ('whatsapp', %s, %s, 'Enviado', %s, %s, NOW(), %s)
+        ON CONFLICT (cliente_id, meta_message_id)
+            WHERE meta_message_id IS NOT NULL
+        DO NOTHING
+        RETURNING id, fecha
+    """, (telefono, texto_persistido, tipo_persistido, cliente_id, meta_message_id))
+    insertado = cursor.fetchone()
+    if insertado:
+        mensaje_id, fecha_mensaje = insertado
+        actualizar_resumen_conversacion(
+            cursor,
+            cliente_id,
+            telefono,
+            mensaje_id,
+            texto_persistido,
+            tipo_persistido,
+            fecha_mensaje,
+        )
+        encolar_mensaje_realtime(
+            cursor,
+            cliente_id,
+            {
+                "id": mensaje_id,
+                "remitente": telefono,
+                "mensaje": texto_persistido,
+                "tipo": tipo_persistido,
+                "estado": "Enviado",
+                "fecha": fecha_mensaje,
+                "cliente_id": cliente_id,
+                "whatsapp_media_id": None,
+                "media_url": None
+            }
+        )
+
     return True
 
 
 # ============================================================================
 # RECEPCIÓN DURABLE DE DESCRIPTORES MULTIMEDIA (BOT -> CRM)
 # ============================================================================
+# Canal LISTEN/NOTIFY que despierta al media worker en cuanto hay trabajo.
+WHATSAPP_MEDIA_CANAL_NOTIFY = "whatsapp_media_jobs"
+
 @app.route("/recibir_media", methods=["POST"])
 def recibir_media():
     if not validar_bot_interno(request):
@@ -1601,6 +2937,12 @@ def recibir_media():
         nueva_fila = cursor.fetchone()
         if nueva_fila:
             event_id = nueva_fila[0]
+            # NOTIFY se entrega al confirmar la transacción: el worker despierta
+            # sólo cuando el evento ya es visible para su claim.
+            cursor.execute(
+                "SELECT pg_notify(%s, %s)",
+                (WHATSAPP_MEDIA_CANAL_NOTIFY, str(event_id))
+            )
             conn.commit()
             app.logger.info(
                 "Evento multimedia aceptado: "
@@ -1712,14 +3054,166 @@ def conectar_socket(auth=None):
 
     room = f"cliente_{identidad['cliente_id']}"
     join_room(room)
+    chats = _suscribir_chats_socket(
+        identidad["cliente_id"],
+        (auth or {}).get("chats") if isinstance(auth, dict) else None,
+    )
     app.logger.info(
         "Socket.IO autenticado: "
         f"user_id={identidad['user_id']}, "
         f"cliente_id={identidad['cliente_id']}, "
-        f"room={room}"
+        f"room={room}, chats={len(chats)}"
     )
 
 
+def _validar_chats_suscripcion(cliente_id, telefonos):
+    """Regresa los teléfonos que son conversaciones o leads del tenant."""
+    if not telefonos:
+        return []
+    conn = conectar_db()
+    if not conn:
+        return []
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT telefono FROM leads
+            WHERE cliente_id = %s AND telefono = ANY(%s)
+            UNION
+            SELECT DISTINCT remitente FROM mensajes
+            WHERE cliente_id = %s AND remitente = ANY(%s)
+        """, (cliente_id, telefonos, cliente_id, telefonos))
+        validos = {fila[0] for fila in cursor.fetchall()}
+        return [telefono for telefono in telefonos if telefono in validos]
+    finally:
+        liberar_db(conn)
+
+
+def _suscribir_chats_socket(cliente_id, telefonos):
+    """
+    Reemplaza las rooms de conversación del socket actual por `telefonos`
+    (a lo más REALTIME_MAX_CHATS_SUSCRITOS). Los teléfonos que no pertenecen
+    al tenant se ignoran.
+    """
+    if not isinstance(telefonos, list):
+        telefonos = []
+    maximo = _obtener_entero_positivo_env("REALTIME_MAX_CHATS_SUSCRITOS", 10)
+    solicitados = []
+    for telefono in telefonos:
+        if isinstance(telefono, str) and telefono.strip() and telefono.strip() not in solicitados:
+            solicitados.append(telefono.strip())
+    validos = _validar_chats_suscripcion(cliente_id, solicitados[:maximo])
+
+    deseadas = {_room_chat_realtime(cliente_id, telefono) for telefono in validos}
+    prefijo = f"cliente_{cliente_id}:chat:"
+    for room in rooms():
+        if room.startswith(prefijo) and room not in deseadas:
+            leave_room(room)
+    for room in deseadas:
+        join_room(room)
+    return validos
+
+
+@socketio.on("suscribir_chats")
+def suscribir_chats_socket(data=None):
+    """Conversaciones abiertas del agente; ack con las que quedaron suscritas."""
+    identidad = resolver_identidad_socket()
+    if not identidad:
+        return {"ok": False, "error": "No autorizado"}
+    telefonos = data.get("telefonos") if isinstance(data, dict) else None
+    chats = _suscribir_chats_socket(identidad["cliente_id"], telefonos)
+    return {"ok": True, "chats": chats}
+
+
+@app.route("/readyz", methods=["GET"])
+def readyz():
+    """
+    Readiness para el balanceador: el worker sólo recibe tráfico si llega a
+    Postgres (pool propio) y a Redis (message queue de Socket.IO y cachés).
+    """
+    fallas = []
+    conn = conectar_db()
+    if not conn:
+        fallas.append("db")
+    else:
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+            conn.rollback()
+        except Exception:
+            conn.rollback()
+            fallas.append("db")
+        finally:
+            liberar_db(conn)
+    try:
+        _obtener_redis_realtime().ping()
+    except Exception:
+        fallas.append("redis")
+
+    if fallas:
+        return jsonify({"ok": False, "fallas": fallas}), 503
+    return jsonify({"ok": True}), 200
+
+
+@app.route("/api/sync", methods=["GET"])
+def api_sync_realtime():
+    """
+    Eventos realtime del tenant posteriores a `since` (su _seq), para que un
+    dashboard que se reconecta aplique sólo lo que se perdió.
+
+    Sin `since` sólo regresa el seq actual (base al conectar). Si el cliente
+    quedó fuera de la ventana retenida del stream, responde recargar=true.
+    """
+    cliente_id = obtener_cliente_id_de_subdominio()
+    if not cliente_id:
+        return jsonify({"error": "No autorizado"}), 401
+
+    cliente_redis = _obtener_redis_realtime()
+    stream = _clave_stream_realtime(cliente_id)
+    ultima = cliente_redis.xrevrange(stream, count=1)
+    seq_actual = int(ultima[0][0].split("-")[0]) if ultima else 0
+
+    since_txt = (request.args.get("since") or "").strip()
+    if not since_txt:
+        return jsonify({"seq": seq_actual, "eventos": [], "recargar": False})
+    try:
+        since = int(since_txt)
+    except ValueError:
+        return jsonify({"error": "since inválido"}), 400
+    if since < 0:
+        return jsonify({"error": "since inválido"}), 400
+
+    if since == seq_actual:
+        return jsonify({"seq": seq_actual, "eventos": [], "recargar": False})
+
+    faltantes = seq_actual - since
+    # since adelante del stream: Redis perdió la secuencia.
+    if faltantes < 0 or faltantes > _obtener_entero_positivo_env("REALTIME_SYNC_MAX_EVENTOS", 500):
+        return jsonify({"seq": seq_actual, "eventos": [], "recargar": True})
+
+    entradas = cliente_redis.xrange(stream, min=f"{since + 1}-0", max="+", count=faltantes)
+    if not entradas or int(entradas[0][0].split("-")[0]) != since + 1:
+        return jsonify({"seq": seq_actual, "eventos": [], "recargar": True})
+
+    # Los eventos de conversación sólo van para los chats que el cliente
+    # indica como abiertos (?chat=<telefono>, repetible).
+    prefijo_chat = f"cliente_{cliente_id}:chat:"
+    rooms_chat = {
+        _room_chat_realtime(cliente_id, telefono)
+        for telefono in request.args.getlist("chat")
+    }
+    eventos = [
+        {
+            "evento": campos["evento"],
+            "room": campos["room"],
+            "datos": json.loads(campos["datos"]),
+        }
+        for _id_entrada, campos in entradas
+        if not campos["room"].startswith(prefijo_chat) or campos["room"] in rooms_chat
+    ]
+    return jsonify({"seq": seq_actual, "eventos": eventos, "recargar": False})
+
+
 # ============================================================================
 # WORKER MULTIMEDIA: PROCESAMIENTO MANUAL DE UN TRABAJO
 # ============================================================================
@@ -1894,57 +3388,152 @@ def _error_media_es_permanente(error_seguro):
     return False
 
 
-def reclamar_trabajo_multimedia():
+# Reclama hasta `limite` trabajos en un solo round trip:
+#   - Tenant: cada tenant aporta sus trabajos por turnos (ROW_NUMBER por
+#     tenant y carril) y, en el mismo turno, va primero el tenant con el
+#     último servicio más antiguo en ese carril (whatsapp_media_turnos).
+#   - Carril: el trabajo k de video/document se ordena en la posición
+#     k * peso - desfase, con desfase = nextval(...) mod peso; uno de cada
+#     `peso` lotes empata con la primera imagen y gana el empate.
+# La secuencia no toma bloqueos, así que las réplicas no se serializan; el
+# upsert de turnos toca sólo las filas de los tenants reclamados.
+SQL_RECLAMAR_TRABAJOS_MULTIMEDIA = """
+    WITH reparto AS (
+        SELECT nextval('whatsapp_media_reparto_seq') %% %(peso)s AS desfase
+    ),
+    reclamables AS (
+        SELECT
+            id,
+            cliente_id,
+            next_attempt_at,
+            CASE WHEN message_type IN ('image', 'sticker', 'audio')
+                 THEN 0 ELSE 1 END AS carril
+        FROM whatsapp_inbound_events
+        WHERE status IN ('pending', 'failed')
+          AND (status = 'pending' OR next_attempt_at IS NOT NULL)
+          AND next_attempt_at <= NOW()
+          AND attempts < %(max_attempts)s
+    ),
+    por_tenant AS (
+        SELECT
+            reclamables.*,
+            ROW_NUMBER() OVER (
+                PARTITION BY cliente_id, carril
+                ORDER BY next_attempt_at, id
+            ) AS turno_tenant
+        FROM reclamables
+    ),
+    por_carril AS (
+        SELECT
+            por_tenant.id,
+            por_tenant.carril,
+            ROW_NUMBER() OVER (
+                PARTITION BY por_tenant.carril
+                ORDER BY por_tenant.turno_tenant,
+                         turno.ultimo_servicio NULLS FIRST,
+                         por_tenant.cliente_id
+            ) AS turno_carril
+        FROM por_tenant
+        LEFT JOIN whatsapp_media_turnos AS turno
+          ON turno.cliente_id = por_tenant.cliente_id
+         AND turno.carril = por_tenant.carril
+        WHERE por_tenant.turno_tenant <= %(limite)s
+    ),
+    elegidos AS (
+        SELECT por_carril.id
+        FROM por_carril
+        CROSS JOIN reparto
+        ORDER BY
+            CASE por_carril.carril
+                WHEN 0 THEN por_carril.turno_carril
+                ELSE por_carril.turno_carril * %(peso)s - reparto.desfase
+            END,
+            por_carril.carril DESC
+        LIMIT %(limite)s
+    ),
+    candidato AS (
+        SELECT evento.id
+        FROM whatsapp_inbound_events AS evento
+        JOIN elegidos ON elegidos.id = evento.id
+        WHERE evento.status IN ('pending', 'failed')
+          AND (evento.status = 'pending' OR evento.next_attempt_at IS NOT NULL)
+          AND evento.next_attempt_at <= NOW()
+          AND evento.attempts < %(max_attempts)s
+        FOR UPDATE OF evento SKIP LOCKED
+    ),
+    reclamados AS (
+        UPDATE whatsapp_inbound_events AS evento
+        SET status = 'processing',
+            attempts = evento.attempts + 1,
+            locked_at = NOW(),
+            lock_token = gen_random_uuid(),
+            actualizado_en = NOW()
+        FROM candidato
+        WHERE evento.id = candidato.id
+        RETURNING
+            evento.id AS event_id,
+            evento.cliente_id,
+            evento.whatsapp_phone_number_id,
+            evento.remitente,
+            evento.message_type,
+            evento.media_id,
+            evento.attempts,
+            evento.lock_token,
+            evento.creado_en AS evento_creado_en
+    ),
+    turnos AS (
+        INSERT INTO whatsapp_media_turnos (cliente_id, carril, ultimo_servicio)
+        SELECT
+            cliente_id,
+            CASE WHEN message_type IN ('image', 'sticker', 'audio')
+                 THEN 0 ELSE 1 END,
+            clock_timestamp()
+        FROM reclamados
+        GROUP BY 1, 2
+        ON CONFLICT (cliente_id, carril) DO UPDATE
+        SET ultimo_servicio = EXCLUDED.ultimo_servicio
+    )
+    SELECT * FROM reclamados
+"""
+
+
+def reclamar_trabajos_multimedia(limite=1):
+    """
+    Reclama hasta `limite` trabajos en un solo round trip.
+
+    El reparto es justo entre tenants y guarda memoria entre reclamos
+    (migraciones 013 y 015): image/sticker/audio es el carril prioritario y
+    video/document avanza uno de cada WHATSAPP_MEDIA_VIDEO_LANE_WEIGHT
+    turnos aunque siempre haya imágenes; dentro del carril se atiende
+    primero al tenant servido hace más tiempo. Ver
+    SQL_RECLAMAR_TRABAJOS_MULTIMEDIA.
+
+    Cada fila recibe su propio lock_token para que cada ejecutor conserve un
+    lease independiente aunque se hayan reclamado en el mismo lote.
+    """
     max_attempts = _obtener_entero_positivo_env(
         "WHATSAPP_MEDIA_MAX_ATTEMPTS",
         5
     )
+    peso_carril_lento = _obtener_entero_positivo_env(
+        "WHATSAPP_MEDIA_VIDEO_LANE_WEIGHT",
+        4
+    )
+    limite = max(1, int(limite))
     conn = conectar_db()
     if not conn:
         raise ErrorProcesamientoMedia("db_no_disponible_claim")
 
-    lock_token = str(uuid.uuid4())
     try:
         cursor = conn.cursor(cursor_factory=RealDictCursor)
-        cursor.execute("""
-            WITH candidato AS (
-                SELECT id
-                FROM whatsapp_inbound_events
-                WHERE (
-                    status = 'pending'
-                    OR (
-                        status = 'failed'
-                        AND next_attempt_at IS NOT NULL
-                    )
-                )
-                  AND next_attempt_at <= NOW()
-                  AND attempts < %s
-                ORDER BY next_attempt_at ASC, creado_en ASC, id ASC
-                FOR UPDATE SKIP LOCKED
-                LIMIT 1
-            )
-            UPDATE whatsapp_inbound_events AS evento
-            SET status = 'processing',
-                attempts = evento.attempts + 1,
-                locked_at = NOW(),
-                lock_token = %s,
-                actualizado_en = NOW()
-            FROM candidato
-            WHERE evento.id = candidato.id
-            RETURNING
-                evento.id AS event_id,
-                evento.cliente_id,
-                evento.whatsapp_phone_number_id,
-                evento.remitente,
-                evento.message_type,
-                evento.media_id,
-                evento.attempts,
-                evento.lock_token,
-                evento.creado_en AS evento_creado_en
-        """, (max_attempts, lock_token))
-        trabajo = cursor.fetchone()
+        cursor.execute(SQL_RECLAMAR_TRABAJOS_MULTIMEDIA, {
+            "max_attempts": max_attempts,
+            "limite": limite,
+            "peso": peso_carril_lento,
+        })
+        trabajos = [dict(trabajo) for trabajo in cursor.fetchall()]
         conn.commit()
-        return dict(trabajo) if trabajo else None
+        return trabajos
     except Exception:
         conn.rollback()
         raise
@@ -1952,11 +3541,22 @@ def reclamar_trabajo_multimedia():
         liberar_db(conn)
 
 
-def recuperar_leases_multimedia_vencidos():
-    timeout_segundos = _obtener_entero_positivo_env(
+def reclamar_trabajo_multimedia():
+    trabajos = reclamar_trabajos_multimedia(limite=1)
+    return trabajos[0] if trabajos else None
+
+
+def _lease_timeout_multimedia():
+    # Con latidos cada WHATSAPP_MEDIA_LEASE_HEARTBEAT_SECONDS el lease sólo
+    # vence si el worker murió; no depende de la duración del trabajo.
+    return _obtener_entero_positivo_env(
         "WHATSAPP_MEDIA_LEASE_TIMEOUT_SECONDS",
-        15 * 60
+        60
     )
+
+
+def recuperar_leases_multimedia_vencidos():
+    timeout_segundos = _lease_timeout_multimedia()
     max_attempts = _obtener_entero_positivo_env(
         "WHATSAPP_MEDIA_MAX_ATTEMPTS",
         5
@@ -2005,6 +3605,174 @@ def recuperar_leases_multimedia_vencidos():
         liberar_db(conn)
 
 
+def renovar_leases_multimedia(trabajos):
+    """
+    Renueva locked_at de varios trabajos en un solo UPDATE.
+
+    Sólo renueva filas que siguen en processing con el mismo lock_token;
+    regresa el conjunto de event_id cuyo lease sigue siendo propio.
+    """
+    if not trabajos:
+        return set()
+
+    conn = conectar_db()
+    if not conn:
+        raise ErrorProcesamientoMedia("db_no_disponible_heartbeat")
+
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE whatsapp_inbound_events AS evento
+            SET locked_at = NOW()
+            FROM unnest(%s::bigint[], %s::text[]) AS lease(id, lock_token)
+            WHERE evento.id = lease.id
+              AND evento.lock_token::text = lease.lock_token
+              AND evento.status = 'processing'
+            RETURNING evento.id
+        """, (
+            [trabajo["event_id"] for trabajo in trabajos],
+            [str(trabajo["lock_token"]) for trabajo in trabajos],
+        ))
+        renovados = {fila[0] for fila in cursor.fetchall()}
+        conn.commit()
+        return renovados
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        liberar_db(conn)
+
+
+class LeaseTrabajoMultimedia:
+    """Estado del lease de un trabajo en vuelo, compartido con su latido."""
+
+    def __init__(self, trabajo):
+        self.trabajo = trabajo
+        self._perdido = threading.Event()
+
+    def marcar_perdido(self):
+        self._perdido.set()
+
+    def vigente(self):
+        return not self._perdido.is_set()
+
+
+class LatidoLeasesMultimedia:
+    """
+    Hilo que renueva en lote los leases de los trabajos en vuelo.
+
+    Un trabajo cuyo lease ya no es propio (recuperado por vencido o
+    reclamado por otra réplica) se marca perdido y deja de subir en el
+    siguiente bloque. Un error de BD no marca nada: si el lease llega a
+    vencer, la finalización lo detecta por lock_token.
+    """
+
+    def __init__(self, intervalo_segundos):
+        self._intervalo = intervalo_segundos
+        self._leases = {}
+        self._lock = threading.Lock()
+        self._detener = threading.Event()
+        self._hilo = None
+
+    def registrar(self, trabajo):
+        lease = LeaseTrabajoMultimedia(trabajo)
+        with self._lock:
+            self._leases[trabajo["event_id"]] = lease
+        return lease
+
+    def liberar(self, trabajo):
+        with self._lock:
+            self._leases.pop(trabajo["event_id"], None)
+
+    def iniciar(self):
+        self._hilo = threading.Thread(
+            target=self._ciclo,
+            name="media-lease-heartbeat",
+            daemon=True,
+        )
+        self._hilo.start()
+
+    def detener(self):
+        self._detener.set()
+        if self._hilo is not None:
+            self._hilo.join()
+
+    def _ciclo(self):
+        while not self._detener.wait(self._intervalo):
+            self.renovar()
+
+    def renovar(self):
+        with self._lock:
+            leases = list(self._leases.values())
+        if not leases:
+            return
+        try:
+            renovados = renovar_leases_multimedia(
+                [lease.trabajo for lease in leases]
+            )
+        except Exception as e:
+            app.logger.error(
+                "Error al renovar leases multimedia: "
+                f"trabajos={len(leases)}, tipo_error={type(e).__name__}"
+            )
+            return
+        for lease in leases:
+            if lease.trabajo["event_id"] not in renovados and lease.vigente():
+                lease.marcar_perdido()
+                app.logger.warning(
+                    "Lease multimedia perdido: "
+                    f"cliente_id={lease.trabajo['cliente_id']}, "
+                    f"event_id={lease.trabajo['event_id']}"
+                )
+
+
+def _intervalo_latido_multimedia():
+    return _obtener_entero_positivo_env(
+        "WHATSAPP_MEDIA_LEASE_HEARTBEAT_SECONDS",
+        15
+    )
+
+
+def _verificar_lease(lease):
+    if lease is not None and not lease.vigente():
+        raise ErrorProcesamientoMedia("lease_perdido")
+
+
+def segundos_hasta_proximo_trabajo_multimedia():
+    """
+    Segundos hasta el next_attempt_at más cercano de un trabajo reclamable,
+    o None si la cola no tiene trabajos pendientes ni reintentos programados.
+    """
+    max_attempts = _obtener_entero_positivo_env(
+        "WHATSAPP_MEDIA_MAX_ATTEMPTS",
+        5
+    )
+    conn = conectar_db()
+    if not conn:
+        raise ErrorProcesamientoMedia("db_no_disponible_proximo")
+
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT EXTRACT(EPOCH FROM (MIN(next_attempt_at) - NOW()))
+            FROM whatsapp_inbound_events
+            WHERE status IN ('pending', 'failed')
+              AND next_attempt_at IS NOT NULL
+              AND attempts < %s
+        """, (max_attempts,))
+        segundos = cursor.fetchone()[0]
+        conn.rollback()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        liberar_db(conn)
+
+    if segundos is None:
+        return None
+    return max(0.0, float(segundos))
+
+
 def _obtener_integracion_media(trabajo):
     conn = conectar_db()
     if not conn:
@@ -2078,10 +3846,17 @@ def _obtener_metadata_meta(media_id, token):
         "url": url_temporal.strip(),
         "mime_type": metadata.get("mime_type"),
         "file_size": metadata.get("file_size"),
+        "sha256": metadata.get("sha256"),
     }
 
 
-def _descargar_media_a_temporal(metadata, token, message_type):
+def _abrir_descarga_meta(metadata, token, message_type):
+    """
+    Abre la descarga en streaming y valida HTTPS, MIME y Content-Length.
+
+    Regresa (respuesta, mime_type, extension, limite_bytes); quien la recibe
+    debe cerrar la respuesta.
+    """
     limite_bytes = _limite_media_bytes(message_type)
     file_size_meta = metadata.get("file_size")
     if file_size_meta is not None:
@@ -2101,8 +3876,6 @@ def _descargar_media_a_temporal(metadata, token, message_type):
     except requests.RequestException:
         raise ErrorProcesamientoMedia("meta_download_network_error")
 
-    archivo = None
-    entregar_archivo = False
     try:
         if respuesta.status_code != 200:
             raise ErrorProcesamientoMedia(
@@ -2125,13 +3898,30 @@ def _descargar_media_a_temporal(metadata, token, message_type):
                     raise ErrorProcesamientoMedia("media_excede_limite_header")
             except ValueError:
                 raise ErrorProcesamientoMedia("content_length_invalido")
+    except Exception:
+        respuesta.close()
+        raise
+
+    return respuesta, mime_type, extension, limite_bytes
 
+
+def _descargar_media_a_temporal(metadata, token, message_type, lease=None):
+    respuesta, mime_type, extension, limite_bytes = _abrir_descarga_meta(
+        metadata,
+        token,
+        message_type
+    )
+
+    archivo = None
+    entregar_archivo = False
+    try:
         archivo = tempfile.TemporaryFile(mode="w+b")
         sha256 = hashlib.sha256()
         size_bytes = 0
         for bloque in respuesta.iter_content(chunk_size=64 * 1024):
             if not bloque:
                 continue
+            _verificar_lease(lease)
             size_bytes += len(bloque)
             if size_bytes > limite_bytes:
                 raise ErrorProcesamientoMedia("media_excede_limite_stream")
@@ -2159,21 +3949,361 @@ def _descargar_media_a_temporal(metadata, token, message_type):
                 archivo.close()
 
 
-def _crear_cliente_s3_media():
-    region = os.getenv("AWS_REGION")
-    access_key = os.getenv("AWS_ACCESS_KEY_ID")
-    secret_key = os.getenv("AWS_SECRET_ACCESS_KEY")
-    bucket = os.getenv("S3_BUCKET_NAME")
-    if not all((region, access_key, secret_key, bucket)):
-        raise ErrorProcesamientoMedia("configuracion_s3_incompleta")
+# Tamaño de parte del multipart upload; S3 exige mínimo 5 MiB salvo la última.
+S3_MULTIPART_MIN_BYTES = 5 * 1024 * 1024
+
+
+def _modo_transferencia_media():
+    modo = (os.getenv("WHATSAPP_MEDIA_TRANSFER_MODE") or "streaming").strip().lower()
+    if modo not in {"streaming", "tempfile"}:
+        raise ErrorProcesamientoMedia(
+            "configuracion_invalida:WHATSAPP_MEDIA_TRANSFER_MODE"
+        )
+    return modo
+
+
+def _construir_s3_key_media(trabajo, extension):
+    return (
+        f"tenants/{trabajo['cliente_id']}/whatsapp/inbound/"
+        f"{trabajo['message_type']}/{uuid.uuid4()}."
+        f"{extension}"
+    )
+
+
+def _transferir_media_a_s3_streaming(
+    metadata,
+    token,
+    trabajo,
+    cliente_s3,
+    bucket,
+    lease=None
+):
+    """
+    Copia la media de Meta a S3 sin disco local.
+
+    Los bloques de iter_content se acumulan en partes de multipart upload; la
+    subida de una parte corre en segundo plano mientras se descarga la
+    siguiente. SHA-256 y el límite por tipo se calculan al vuelo. Si algo
+    falla, el multipart upload se aborta y no queda ningún objeto.
+    Un archivo que cabe en una sola parte se sube con un put_object.
+    """
+    message_type = trabajo["message_type"]
+    parte_bytes = max(
+        S3_MULTIPART_MIN_BYTES,
+        _obtener_entero_positivo_env(
+            "WHATSAPP_MEDIA_S3_PART_BYTES",
+            S3_MULTIPART_MIN_BYTES
+        )
+    )
+    respuesta, mime_type, extension, limite_bytes = _abrir_descarga_meta(
+        metadata,
+        token,
+        message_type
+    )
+    s3_key = _construir_s3_key_media(trabajo, extension)
+
+    upload_id = None
+    partes = []
+    subida_en_curso = None
+    subidor = None
+
+    def _subir_parte(numero, cuerpo):
+        resultado = cliente_s3.upload_part(
+            Bucket=bucket,
+            Key=s3_key,
+            PartNumber=numero,
+            UploadId=upload_id,
+            Body=cuerpo,
+        )
+        return {"PartNumber": numero, "ETag": resultado["ETag"]}
+
+    def _esperar_parte_previa():
+        if subida_en_curso is None:
+            return
+        try:
+            partes.append(subida_en_curso.result())
+        except Exception:
+            raise ErrorProcesamientoMedia("s3_upload_error")
+
+    try:
+        sha256 = hashlib.sha256()
+        size_bytes = 0
+        buffer = bytearray()
+        for bloque in respuesta.iter_content(chunk_size=64 * 1024):
+            if not bloque:
+                continue
+            _verificar_lease(lease)
+            size_bytes += len(bloque)
+            if size_bytes > limite_bytes:
+                raise ErrorProcesamientoMedia("media_excede_limite_stream")
+            sha256.update(bloque)
+            buffer.extend(bloque)
+
+            if len(buffer) >= parte_bytes:
+                if upload_id is None:
+                    try:
+                        upload_id = cliente_s3.create_multipart_upload(
+                            Bucket=bucket,
+                            Key=s3_key,
+                            ContentType=mime_type,
+                        )["UploadId"]
+                    except Exception:
+                        raise ErrorProcesamientoMedia("s3_upload_error")
+                    subidor = ThreadPoolExecutor(max_workers=1)
+                _esperar_parte_previa()
+                subida_en_curso = subidor.submit(
+                    _subir_parte,
+                    len(partes) + 1,
+                    bytes(buffer)
+                )
+                buffer.clear()
+
+        if size_bytes <= 0:
+            raise ErrorProcesamientoMedia("media_vacia")
+
+        try:
+            if upload_id is None:
+                cliente_s3.put_object(
+                    Bucket=bucket,
+                    Key=s3_key,
+                    Body=bytes(buffer),
+                    ContentType=mime_type,
+                )
+            else:
+                _esperar_parte_previa()
+                subida_en_curso = None
+                if buffer:
+                    partes.append(_subir_parte(len(partes) + 1, bytes(buffer)))
+                cliente_s3.complete_multipart_upload(
+                    Bucket=bucket,
+                    Key=s3_key,
+                    UploadId=upload_id,
+                    MultipartUpload={"Parts": partes},
+                )
+                upload_id = None
+        except ErrorProcesamientoMedia:
+            raise
+        except Exception:
+            raise ErrorProcesamientoMedia("s3_upload_error")
+
+        return {
+            "s3_key": s3_key,
+            "mime_type": mime_type,
+            "extension": extension,
+            "size_bytes": size_bytes,
+            "sha256": sha256.hexdigest(),
+        }
+    except Exception:
+        if upload_id is not None:
+            # Abortar con una parte aún subiendo puede dejar esa parte huérfana.
+            if subida_en_curso is not None:
+                try:
+                    subida_en_curso.result()
+                except Exception:
+                    pass
+            try:
+                cliente_s3.abort_multipart_upload(
+                    Bucket=bucket,
+                    Key=s3_key,
+                    UploadId=upload_id,
+                )
+            except Exception:
+                app.logger.error(
+                    "No se pudo abortar multipart upload: "
+                    f"cliente_id={trabajo['cliente_id']}, "
+                    f"event_id={trabajo['event_id']}"
+                )
+        raise
+    finally:
+        try:
+            respuesta.close()
+        finally:
+            if subidor is not None:
+                subidor.shutdown(wait=True)
+
+
+_cliente_s3_media = None
+_cliente_s3_media_lock = threading.Lock()
+
+
+def _obtener_cliente_s3_media():
+    """
+    Cliente S3 compartido por el proceso.
+
+    Los clientes de boto3 son thread-safe; crearlo por trabajo o por request
+    repetía la carga de configuración y el pool de conexiones HTTP.
+    """
+    global _cliente_s3_media
+    with _cliente_s3_media_lock:
+        if _cliente_s3_media is not None:
+            return _cliente_s3_media
+
+        region = os.getenv("AWS_REGION")
+        access_key = os.getenv("AWS_ACCESS_KEY_ID")
+        secret_key = os.getenv("AWS_SECRET_ACCESS_KEY")
+        bucket = os.getenv("S3_BUCKET_NAME")
+        if not all((region, access_key, secret_key, bucket)):
+            raise ErrorProcesamientoMedia("configuracion_s3_incompleta")
+
+        cliente = boto3.client(
+            "s3",
+            region_name=region,
+            aws_access_key_id=access_key,
+            aws_secret_access_key=secret_key,
+        )
+        _cliente_s3_media = (cliente, bucket.strip())
+        return _cliente_s3_media
+
+
+# Caché de URLs presignadas por (cliente_id, media_id, variante). Una entrada
+# se reutiliza hasta `margen` segundos antes de que la URL expire.
+_urls_firmadas_media = OrderedDict()
+_urls_firmadas_media_lock = threading.Lock()
+
+
+def _parametros_urls_firmadas():
+    expiracion = _obtener_entero_positivo_env(
+        "WHATSAPP_MEDIA_PRESIGNED_EXPIRES_SECONDS",
+        300
+    )
+    margen = min(
+        _obtener_entero_positivo_env(
+            "WHATSAPP_MEDIA_PRESIGNED_CACHE_MARGIN_SECONDS",
+            60
+        ),
+        expiracion // 2
+    )
+    return expiracion, margen
+
+
+def _url_firmada_en_cache(cliente_id, media_id, variante="original"):
+    """Regresa (url, segundos_vigente) o None si no hay entrada vigente."""
+    _asegurar_escucha_invalidacion_cache()
+    ahora = time.monotonic()
+    clave = (cliente_id, media_id, variante)
+    with _urls_firmadas_media_lock:
+        entrada = _urls_firmadas_media.get(clave)
+        if entrada is None:
+            return None
+        url, vigente_hasta = entrada
+        if vigente_hasta <= ahora:
+            del _urls_firmadas_media[clave]
+            return None
+        _urls_firmadas_media.move_to_end(clave)
+        return url, int(vigente_hasta - ahora)
+
+
+def _firmar_url_media(cliente_id, media_id, bucket, key, variante="original"):
+    """
+    URL presignada de un objeto ya autorizado para el tenant.
+
+    La firma es local (sin red); la caché evita repetirla y, sobre todo,
+    la consulta a la BD en /api/media/<id>.
+    """
+    clave = (cliente_id, media_id, variante)
+    en_cache = _url_firmada_en_cache(cliente_id, media_id, variante)
+    if en_cache:
+        return en_cache[0]
+
+    cliente_s3, _bucket_configurado = _obtener_cliente_s3_media()
+    expiracion, margen = _parametros_urls_firmadas()
+    url_firmada = cliente_s3.generate_presigned_url(
+        "get_object",
+        Params={
+            "Bucket": bucket,
+            "Key": key
+        },
+        ExpiresIn=expiracion
+    )
+    maximo_entradas = _obtener_entero_positivo_env(
+        "WHATSAPP_MEDIA_PRESIGNED_CACHE_MAX_ENTRIES",
+        5000
+    )
+    with _urls_firmadas_media_lock:
+        _urls_firmadas_media[clave] = (
+            url_firmada,
+            time.monotonic() + expiracion - margen
+        )
+        _urls_firmadas_media.move_to_end(clave)
+        while len(_urls_firmadas_media) > maximo_entradas:
+            _urls_firmadas_media.popitem(last=False)
+    return url_firmada
+
+
+def _invalidar_urls_firmadas_media(datos):
+    cliente_id = datos["cliente_id"]
+    media_ids = set(datos.get("media_ids") or [])
+    with _urls_firmadas_media_lock:
+        for clave in [
+            clave for clave in _urls_firmadas_media
+            if clave[0] == cliente_id and clave[1] in media_ids
+        ]:
+            del _urls_firmadas_media[clave]
 
-    cliente = boto3.client(
-        "s3",
-        region_name=region,
-        aws_access_key_id=access_key,
-        aws_secret_access_key=secret_key,
-    )
-    return cliente, bucket.strip()
+
+# ============================================================================
+# INVALIDACIÓN DE CACHÉS ENTRE PROCESOS (Redis pub/sub)
+# ============================================================================
+# Cada worker web tiene sus cachés en memoria; quien vuelve obsoleta una
+# entrada lo anuncia aquí y todos la descartan. Si un proceso pierde un
+# anuncio mientras reconecta, la entrada igual expira por su TTL.
+CACHE_CANAL_INVALIDACION = "eventa_crm_cache"
+_invalidadores_cache = {
+    "urls_firmadas_media": _invalidar_urls_firmadas_media,
+}
+_escucha_invalidacion_iniciada = False
+_escucha_invalidacion_lock = threading.Lock()
+
+
+def _escuchar_invalidaciones_cache():
+    while True:
+        try:
+            pubsub = _obtener_redis_realtime().pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(CACHE_CANAL_INVALIDACION)
+            for mensaje in pubsub.listen():
+                try:
+                    datos = json.loads(mensaje["data"])
+                    _invalidadores_cache[datos["cache"]](datos)
+                except Exception as e:
+                    app.logger.warning(
+                        "Invalidación de caché ignorada: "
+                        f"tipo_error={type(e).__name__}"
+                    )
+        except Exception as e:
+            app.logger.warning(
+                "Escucha de invalidación de caché perdida: "
+                f"tipo_error={type(e).__name__}"
+            )
+            time.sleep(1)
+
+
+def _asegurar_escucha_invalidacion_cache():
+    """Arranca (una vez por proceso) el hilo que escucha invalidaciones."""
+    global _escucha_invalidacion_iniciada
+    if _escucha_invalidacion_iniciada:
+        return
+    with _escucha_invalidacion_lock:
+        if _escucha_invalidacion_iniciada:
+            return
+        threading.Thread(
+            target=_escuchar_invalidaciones_cache,
+            name="cache-invalidacion",
+            daemon=True,
+        ).start()
+        _escucha_invalidacion_iniciada = True
+
+
+def invalidar_cache(nombre, **datos):
+    """Invalida localmente y anuncia la invalidación a los demás procesos."""
+    datos["cache"] = nombre
+    _invalidadores_cache[nombre](datos)
+    try:
+        _obtener_redis_realtime().publish(CACHE_CANAL_INVALIDACION, json.dumps(datos))
+    except Exception as e:
+        app.logger.warning(
+            f"No se pudo anunciar invalidación de caché: cache={nombre}, "
+            f"tipo_error={type(e).__name__}"
+        )
 
 
 def _marcar_evento_fallido(trabajo, error_seguro, permanente=False):
@@ -2190,7 +4320,6 @@ def _marcar_evento_fallido(trabajo, error_seguro, permanente=False):
         and trabajo.get("message_type") == "video"
         and error_truncado in ERRORES_VIDEO_DEMASIADO_GRANDE
     )
-    aviso = None
 
     conn = conectar_db()
     if not conn:
@@ -2262,11 +4391,29 @@ def _marcar_evento_fallido(trabajo, error_seguro, permanente=False):
                 trabajo["evento_creado_en"],
             ))
             aviso_id, aviso_fecha = cursor.fetchone()
-            aviso = {
-                "id": aviso_id,
-                "mensaje": texto_aviso,
-                "fecha": aviso_fecha,
-            }
+            actualizar_resumen_conversacion(
+                cursor,
+                trabajo["cliente_id"],
+                trabajo["remitente"],
+                aviso_id,
+                texto_aviso,
+                "recibido",
+                aviso_fecha,
+            )
+            encolar_mensaje_realtime(
+                cursor,
+                trabajo["cliente_id"],
+                {
+                    "id": aviso_id,
+                    "remitente": trabajo["remitente"],
+                    "mensaje": texto_aviso,
+                    "tipo": "recibido",
+                    "fecha": aviso_fecha,
+                    "cliente_id": trabajo["cliente_id"],
+                    "whatsapp_media_id": None,
+                    "media_url": None,
+                }
+            )
         conn.commit()
         if not actualizado:
             app.logger.warning(
@@ -2287,43 +4434,219 @@ def _marcar_evento_fallido(trabajo, error_seguro, permanente=False):
     finally:
         liberar_db(conn)
 
-    if aviso:
-        fecha_socket = aviso["fecha"]
-        if hasattr(fecha_socket, "isoformat"):
-            fecha_socket = fecha_socket.isoformat()
+    return actualizado
+
+
+# Deduplicación por contenido: contadores del proceso para el log de
+# "Media completada"; el acumulado global sale de `flask media-dedup-stats`.
+METRICAS_DEDUP_MEDIA = {"hits": 0, "misses": 0}
+_metricas_dedup_lock = threading.Lock()
+
+
+def _registrar_dedup_media(hit):
+    with _metricas_dedup_lock:
+        METRICAS_DEDUP_MEDIA["hits" if hit else "misses"] += 1
+        total = METRICAS_DEDUP_MEDIA["hits"] + METRICAS_DEDUP_MEDIA["misses"]
+        return METRICAS_DEDUP_MEDIA["hits"] / total
+
+
+def _normalizar_sha256_meta(valor):
+    """Meta entrega el sha256 en hex o en base64; se normaliza a hex."""
+    if not isinstance(valor, str):
+        return None
+    valor = valor.strip()
+    if re.fullmatch(r"[0-9a-fA-F]{64}", valor):
+        return valor.lower()
+    try:
+        crudo = base64.b64decode(valor, validate=True)
+    except ValueError:
+        return None
+    return crudo.hex() if len(crudo) == 32 else None
+
+
+def _buscar_objeto_media(cliente_id, sha256, message_type):
+    """
+    Objeto S3 vigente del tenant con ese contenido, o None.
+
+    Un error aquí no detiene el trabajo: sin dedup se descarga y sube normal.
+    """
+    if not sha256:
+        return None
+
+    conn = conectar_db()
+    if not conn:
+        return None
+    try:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        cursor.execute("""
+            SELECT id, s3_bucket, s3_key, mime_type, size_bytes
+            FROM whatsapp_media_objetos
+            WHERE cliente_id = %s
+              AND sha256 = %s
+              AND ref_count > 0
+        """, (cliente_id, sha256))
+        objeto = cursor.fetchone()
+    except Exception as e:
+        app.logger.warning(
+            "No se pudo consultar objeto media deduplicado: "
+            f"cliente_id={cliente_id}, tipo_error={type(e).__name__}"
+        )
+        return None
+    finally:
+        liberar_db(conn)
+
+    if not objeto:
+        return None
+    # Mismo contenido con un MIME que este tipo no admite: no se reutiliza.
+    if objeto["mime_type"] not in WHATSAPP_MEDIA_MIME_EXTENSIONES[message_type]:
+        return None
+    return dict(objeto)
+
+
+def _liberar_media_de_mensajes(cursor, cliente_id, media_ids):
+    """
+    Borra las filas whatsapp_media indicadas y descuenta sus referencias.
+
+    Regresa [(bucket, key)] de los objetos que quedaron sin referencias;
+    se deben borrar de S3 después del commit.
+    """
+    media_ids = [media_id for media_id in media_ids if media_id is not None]
+    if not media_ids:
+        return []
+
+    cursor.execute("""
+        DELETE FROM whatsapp_media
+        WHERE cliente_id = %s
+          AND id = ANY(%s)
+        RETURNING objeto_id, s3_bucket, s3_key, thumb_s3_key
+    """, (cliente_id, media_ids))
+    filas = cursor.fetchall()
+
+    # Media previa a la deduplicación: objeto propio, se borra directo.
+    objetos_sin_referencias = []
+    for objeto_id, bucket, key, thumb_key in filas:
+        if objeto_id is None:
+            objetos_sin_referencias.append((bucket, key))
+            if thumb_key:
+                objetos_sin_referencias.append((bucket, thumb_key))
+    referencias = {}
+    for objeto_id, _bucket, _key, _thumb_key in filas:
+        if objeto_id is not None:
+            referencias[objeto_id] = referencias.get(objeto_id, 0) + 1
+    if not referencias:
+        return objetos_sin_referencias
+
+    cursor.execute("""
+        UPDATE whatsapp_media_objetos AS o
+        SET ref_count = o.ref_count - v.total,
+            actualizado_en = NOW()
+        FROM unnest(%s::bigint[], %s::int[]) AS v(id, total)
+        WHERE o.id = v.id
+          AND o.cliente_id = %s
+    """, (list(referencias), list(referencias.values()), cliente_id))
+    cursor.execute("""
+        DELETE FROM whatsapp_media_objetos
+        WHERE cliente_id = %s
+          AND id = ANY(%s)
+          AND ref_count = 0
+        RETURNING s3_bucket, s3_key
+    """, (cliente_id, list(referencias)))
+    for bucket, key in cursor.fetchall():
+        objetos_sin_referencias.append((bucket, key))
+        objetos_sin_referencias.append((bucket, _s3_key_miniatura(key)))
+    return objetos_sin_referencias
+
+
+def _borrar_objetos_s3_media(objetos, cliente_id):
+    if not objetos:
+        return
+    try:
+        cliente_s3, _bucket_configurado = _obtener_cliente_s3_media()
+    except ErrorProcesamientoMedia:
+        app.logger.error(
+            "Configuración S3 incompleta al borrar media: "
+            f"cliente_id={cliente_id}, objetos={len(objetos)}"
+        )
+        return
+    for bucket, key in objetos:
         try:
-            socketio.emit(
-                "nuevo_mensaje",
-                {
-                    "id": aviso["id"],
-                    "remitente": trabajo["remitente"],
-                    "mensaje": aviso["mensaje"],
-                    "tipo": "recibido",
-                    "fecha": fecha_socket,
-                    "cliente_id": trabajo["cliente_id"],
-                    "whatsapp_media_id": None,
-                    "media_url": None,
-                },
-                room=f"cliente_{trabajo['cliente_id']}"
-            )
+            cliente_s3.delete_object(Bucket=bucket, Key=key)
         except Exception as e:
-            app.logger.warning(
-                "No se pudo emitir aviso multimedia por Socket.IO: "
-                f"cliente_id={trabajo['cliente_id']}, "
-                f"event_id={trabajo['event_id']}, "
-                f"tipo_error={type(e).__name__}"
+            app.logger.error(
+                "No se pudo borrar objeto S3 sin referencias: "
+                f"cliente_id={cliente_id}, tipo_error={type(e).__name__}"
             )
 
-    return actualizado
 
+def _persistir_media_y_completar(
+    trabajo,
+    datos_media,
+    bucket,
+    s3_key,
+    objeto_id_existente=None
+):
+    """
+    Registra la media, su mensaje y completa el evento en una transacción.
 
-def _persistir_media_y_completar(trabajo, datos_media, bucket, s3_key):
+    Con `objeto_id_existente` se reutiliza un objeto ya almacenado; si no,
+    el objeto subido se registra por (cliente_id, sha256). Si otro trabajo
+    registró el mismo contenido primero, la fila apunta a ese objeto y
+    `objeto_reutilizado` indica que la copia propia sobra.
+    """
     conn = conectar_db()
     if not conn:
         raise ErrorProcesamientoMedia("db_no_disponible_finalize")
 
     try:
         cursor = conn.cursor()
+        if objeto_id_existente is not None:
+            # ref_count > 0: un objeto que se está liberando ya no se reutiliza.
+            cursor.execute("""
+                UPDATE whatsapp_media_objetos
+                SET ref_count = ref_count + 1,
+                    actualizado_en = NOW()
+                WHERE id = %s
+                  AND cliente_id = %s
+                  AND ref_count > 0
+                RETURNING id, s3_bucket, s3_key
+            """, (objeto_id_existente, trabajo["cliente_id"]))
+            objeto = cursor.fetchone()
+            if not objeto:
+                raise ErrorProcesamientoMedia("media_objeto_no_vigente")
+        else:
+            cursor.execute("""
+                INSERT INTO whatsapp_media_objetos (
+                    cliente_id,
+                    sha256,
+                    s3_bucket,
+                    s3_key,
+                    mime_type,
+                    size_bytes,
+                    ref_count,
+                    creado_en,
+                    actualizado_en
+                )
+                VALUES (%s, %s, %s, %s, %s, %s, 1, NOW(), NOW())
+                ON CONFLICT (cliente_id, sha256)
+                DO UPDATE SET
+                    ref_count = whatsapp_media_objetos.ref_count + 1,
+                    actualizado_en = NOW()
+                RETURNING id, s3_bucket, s3_key
+            """, (
+                trabajo["cliente_id"],
+                datos_media["sha256"],
+                bucket,
+                s3_key,
+                datos_media["mime_type"],
+                datos_media["size_bytes"],
+            ))
+            objeto = cursor.fetchone()
+        objeto_id, bucket_objeto, key_objeto = objeto
+        objeto_reutilizado = (
+            objeto_id_existente is not None
+            or (bucket_objeto, key_objeto) != (bucket, s3_key)
+        )
+
         cursor.execute("""
             INSERT INTO whatsapp_media (
                 cliente_id,
@@ -2336,20 +4659,22 @@ def _persistir_media_y_completar(trabajo, datos_media, bucket, s3_key):
                 size_bytes,
                 sha256,
                 original_filename,
+                objeto_id,
                 creado_en
             )
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, NULL, NOW())
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, NULL, %s, NOW())
             RETURNING id
         """, (
             trabajo["cliente_id"],
             trabajo["event_id"],
             trabajo["message_type"],
             trabajo["media_id"],
-            bucket,
-            s3_key,
+            bucket_objeto,
+            key_objeto,
             datos_media["mime_type"],
             datos_media["size_bytes"],
             datos_media["sha256"],
+            objeto_id,
         ))
         media_id_db = cursor.fetchone()[0]
 
@@ -2377,7 +4702,7 @@ def _persistir_media_y_completar(trabajo, datos_media, bucket, s3_key):
             ON CONFLICT (whatsapp_media_id)
                 WHERE whatsapp_media_id IS NOT NULL
             DO NOTHING
-            RETURNING id
+            RETURNING id, fecha
         """, (
             trabajo["remitente"],
             texto_mensaje,
@@ -2390,6 +4715,16 @@ def _persistir_media_y_completar(trabajo, datos_media, bucket, s3_key):
 
         if mensaje_insertado:
             mensaje_id_db = mensaje_insertado[0]
+            actualizar_resumen_conversacion(
+                cursor,
+                trabajo["cliente_id"],
+                trabajo["remitente"],
+                mensaje_id_db,
+                texto_mensaje,
+                tipo_mensaje,
+                mensaje_insertado[1],
+                media_id_db,
+            )
         else:
             cursor.execute("""
                 SELECT id
@@ -2402,6 +4737,24 @@ def _persistir_media_y_completar(trabajo, datos_media, bucket, s3_key):
                 raise ErrorProcesamientoMedia("mensaje_media_no_resuelto")
             mensaje_id_db = mensaje_existente[0]
 
+        # La miniatura se genera después de completar el trabajo; cuando
+        # exista, _generar_miniatura_media publica miniatura_media.
+        encolar_mensaje_realtime(
+            cursor,
+            trabajo["cliente_id"],
+            {
+                "id": mensaje_id_db,
+                "remitente": trabajo["remitente"],
+                "mensaje": texto_mensaje,
+                "tipo": tipo_mensaje,
+                "fecha": trabajo["evento_creado_en"],
+                "cliente_id": trabajo["cliente_id"],
+                "whatsapp_media_id": media_id_db,
+                "media_url": f"/api/media/{media_id_db}",
+                "thumb_url": None,
+            }
+        )
+
         cursor.execute("""
             UPDATE whatsapp_inbound_events
             SET status = 'completed',
@@ -2429,24 +4782,274 @@ def _persistir_media_y_completar(trabajo, datos_media, bucket, s3_key):
             "mensaje": texto_mensaje,
             "tipo": tipo_mensaje,
             "fecha": trabajo["evento_creado_en"],
+            "objeto_id": objeto_id,
+            "s3_bucket": bucket_objeto,
+            "s3_key": key_objeto,
+            "objeto_reutilizado": objeto_reutilizado,
+        }
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        liberar_db(conn)
+
+
+def _bytes_estimados_media(metadata, message_type):
+    """Tamaño a reservar en el presupuesto de bytes en vuelo del worker."""
+    limite_bytes = _limite_media_bytes(message_type)
+    try:
+        file_size = int(metadata.get("file_size"))
+    except (TypeError, ValueError):
+        return limite_bytes
+    if file_size <= 0:
+        return limite_bytes
+    return min(file_size, limite_bytes)
+
+
+def _s3_key_miniatura(s3_key):
+    """La miniatura se guarda junto al original; objetos deduplicados la comparten."""
+    return f"{s3_key.rsplit('.', 1)[0]}.thumb.webp"
+
+
+def _miniatura_webp(origen):
+    """
+    Reduce una imagen (archivo o bytes) a WebP de a lo más
+    WHATSAPP_MEDIA_THUMB_MAX_PX por lado. Regresa (bytes, ancho, alto).
+    """
+    lado_maximo = _obtener_entero_positivo_env(
+        "WHATSAPP_MEDIA_THUMB_MAX_PX",
+        320
+    )
+    calidad = min(
+        100,
+        _obtener_entero_positivo_env("WHATSAPP_MEDIA_THUMB_QUALITY", 70)
+    )
+    if isinstance(origen, (bytes, bytearray)):
+        origen = io.BytesIO(origen)
+
+    with Image.open(origen) as imagen:
+        # JPEG decodifica directo a escala reducida; evita abrir 12 MP completos.
+        imagen.draft("RGB", (lado_maximo, lado_maximo))
+        imagen = ImageOps.exif_transpose(imagen)
+        imagen.thumbnail((lado_maximo, lado_maximo))
+        if imagen.mode not in ("RGB", "RGBA"):
+            imagen = imagen.convert(
+                "RGBA" if "transparency" in imagen.info else "RGB"
+            )
+        salida = io.BytesIO()
+        imagen.save(salida, format="WEBP", quality=calidad, method=4)
+        return salida.getvalue(), imagen.width, imagen.height
+
+
+_aviso_sin_ffmpeg_emitido = False
+
+
+def ffmpeg_disponible():
+    """
+    ffmpeg es dependencia del sistema (no de pip; ver requirements.txt) para
+    los posters de video. Sin él se avisa una sola vez por proceso.
+    """
+    global _aviso_sin_ffmpeg_emitido
+    ffmpeg = shutil.which("ffmpeg")
+    if not ffmpeg and not _aviso_sin_ffmpeg_emitido:
+        _aviso_sin_ffmpeg_emitido = True
+        app.logger.warning(
+            "ffmpeg no está en PATH: posters de video desactivados"
+        )
+    return ffmpeg
+
+
+def _primer_cuadro_video(url_video):
+    """
+    Extrae el primer cuadro con ffmpeg leyendo la URL presignada.
+
+    ffmpeg sólo pide por HTTP los rangos que necesita, así que el video
+    completo no se descarga. Sin ffmpeg instalado regresa None.
+    """
+    ffmpeg = ffmpeg_disponible()
+    if not ffmpeg:
+        return None
+    try:
+        resultado = subprocess.run(
+            [
+                ffmpeg,
+                "-v", "error",
+                "-i", url_video,
+                "-frames:v", "1",
+                "-f", "image2pipe",
+                "-vcodec", "mjpeg",
+                "-",
+            ],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            timeout=30,
+            check=False,
+        )
+    except subprocess.TimeoutExpired:
+        raise ErrorProcesamientoMedia("thumb_ffmpeg_timeout")
+    if resultado.returncode != 0 or not resultado.stdout:
+        raise ErrorProcesamientoMedia("thumb_ffmpeg_error")
+    return resultado.stdout
+
+
+def _generar_miniatura_media(trabajo, resultado_persistencia, archivo_temporal=None):
+    """
+    Etapa posterior a la persistencia: miniatura WebP para imágenes y
+    poster del primer cuadro para videos.
+
+    Si el objeto se reutilizó por deduplicación se copia la miniatura de
+    otra fila del mismo objeto. Un fallo aquí no afecta al trabajo: sin
+    miniatura, ?variant=thumb sirve el original.
+    """
+    message_type = trabajo["message_type"]
+    if message_type not in ("image", "video"):
+        return None
+
+    media_id_db = resultado_persistencia["media_id"]
+    bucket = resultado_persistencia["s3_bucket"]
+    s3_key = resultado_persistencia["s3_key"]
+    miniatura = None
+
+    if resultado_persistencia["objeto_reutilizado"]:
+        conn = conectar_db()
+        if not conn:
+            return None
+        try:
+            cursor = conn.cursor(cursor_factory=RealDictCursor)
+            cursor.execute("""
+                SELECT
+                    thumb_s3_key,
+                    thumb_mime_type,
+                    thumb_size_bytes,
+                    thumb_ancho,
+                    thumb_alto
+                FROM whatsapp_media
+                WHERE objeto_id = %s
+                  AND cliente_id = %s
+                  AND thumb_s3_key IS NOT NULL
+                LIMIT 1
+            """, (resultado_persistencia["objeto_id"], trabajo["cliente_id"]))
+            existente = cursor.fetchone()
+        finally:
+            liberar_db(conn)
+        if existente:
+            miniatura = dict(existente)
+
+    if miniatura is None:
+        cliente_s3, _bucket_configurado = _obtener_cliente_s3_media()
+        if message_type == "image":
+            if archivo_temporal is not None:
+                archivo_temporal.seek(0)
+                contenido, ancho, alto = _miniatura_webp(archivo_temporal)
+            else:
+                objeto = cliente_s3.get_object(Bucket=bucket, Key=s3_key)
+                try:
+                    contenido, ancho, alto = _miniatura_webp(objeto["Body"].read())
+                finally:
+                    objeto["Body"].close()
+        else:
+            url_video = cliente_s3.generate_presigned_url(
+                "get_object",
+                Params={"Bucket": bucket, "Key": s3_key},
+                ExpiresIn=120
+            )
+            cuadro = _primer_cuadro_video(url_video)
+            if cuadro is None:
+                return None
+            contenido, ancho, alto = _miniatura_webp(cuadro)
+
+        thumb_key = _s3_key_miniatura(s3_key)
+        cliente_s3.put_object(
+            Bucket=bucket,
+            Key=thumb_key,
+            Body=contenido,
+            ContentType="image/webp",
+        )
+        miniatura = {
+            "thumb_s3_key": thumb_key,
+            "thumb_mime_type": "image/webp",
+            "thumb_size_bytes": len(contenido),
+            "thumb_ancho": ancho,
+            "thumb_alto": alto,
         }
+
+    conn = conectar_db()
+    if not conn:
+        return None
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE whatsapp_media
+            SET thumb_s3_key = %s,
+                thumb_mime_type = %s,
+                thumb_size_bytes = %s,
+                thumb_ancho = %s,
+                thumb_alto = %s
+            WHERE id = %s
+              AND cliente_id = %s
+        """, (
+            miniatura["thumb_s3_key"],
+            miniatura["thumb_mime_type"],
+            miniatura["thumb_size_bytes"],
+            miniatura["thumb_ancho"],
+            miniatura["thumb_alto"],
+            media_id_db,
+            trabajo["cliente_id"],
+        ))
+        # Quien ya pintó el mensaje sin miniatura (p. ej. el poster del
+        # video) la recibe aquí.
+        encolar_evento_realtime(
+            cursor,
+            trabajo["cliente_id"],
+            "miniatura_media",
+            {
+                "id": resultado_persistencia["mensaje_id"],
+                "remitente": trabajo["remitente"],
+                "whatsapp_media_id": media_id_db,
+                "thumb_url": f"/api/media/{media_id_db}?variant=thumb",
+            },
+            room=_room_chat_realtime(trabajo["cliente_id"], trabajo["remitente"]),
+        )
+        conn.commit()
     except Exception:
         conn.rollback()
         raise
     finally:
         liberar_db(conn)
+    return miniatura
 
 
 def procesar_un_trabajo_multimedia():
     trabajo = reclamar_trabajo_multimedia()
     if not trabajo:
         return {"status": "no_job"}
+    latido = LatidoLeasesMultimedia(_intervalo_latido_multimedia())
+    lease = latido.registrar(trabajo)
+    latido.iniciar()
+    try:
+        return procesar_trabajo_multimedia(trabajo, lease=lease)
+    finally:
+        latido.detener()
 
+
+def procesar_trabajo_multimedia(trabajo, presupuesto_bytes=None, lease=None):
+    """
+    Ejecuta el ciclo metadata -> descarga -> S3 -> persistencia de un trabajo
+    ya reclamado.
+
+    `presupuesto_bytes` es opcional; si se recibe debe exponer
+    reservar(bytes) -> reservados y liberar(reservados). El worker
+    concurrente lo usa para acotar los bytes en vuelo del proceso.
+
+    `lease` es opcional (LeaseTrabajoMultimedia); si se pierde, el trabajo
+    se detiene en el siguiente bloque sin terminar la subida.
+    """
     archivo_temporal = None
     cliente_s3 = None
     bucket = None
     s3_key = None
     objeto_subido = False
+    bytes_reservados = 0
 
     try:
         if trabajo["message_type"] not in WHATSAPP_MEDIA_MIME_EXTENSIONES:
@@ -2454,62 +5057,117 @@ def procesar_un_trabajo_multimedia():
 
         token = _obtener_integracion_media(trabajo)
         metadata = _obtener_metadata_meta(trabajo["media_id"], token)
-        datos_media = _descargar_media_a_temporal(
-            metadata,
-            token,
-            trabajo["message_type"]
-        )
-        archivo_temporal = datos_media["archivo"]
 
-        cliente_s3, bucket = _crear_cliente_s3_media()
-        s3_key = (
-            f"tenants/{trabajo['cliente_id']}/whatsapp/inbound/"
-            f"{trabajo['message_type']}/{uuid.uuid4()}."
-            f"{datos_media['extension']}"
+        # Si Meta ya trae el hash y el tenant tiene ese contenido, no se
+        # descarga ni se sube nada.
+        sha256_meta = _normalizar_sha256_meta(metadata.get("sha256"))
+        objeto_existente = _buscar_objeto_media(
+            trabajo["cliente_id"],
+            sha256_meta,
+            trabajo["message_type"]
         )
-        try:
-            cliente_s3.upload_fileobj(
-                archivo_temporal,
-                bucket,
-                s3_key,
-                ExtraArgs={"ContentType": datos_media["mime_type"]}
-            )
-        except Exception:
-            raise ErrorProcesamientoMedia("s3_upload_error")
-        objeto_subido = True
+        if objeto_existente is not None:
+            datos_media = {
+                "mime_type": objeto_existente["mime_type"],
+                "size_bytes": objeto_existente["size_bytes"],
+                "sha256": sha256_meta,
+            }
+        else:
+            if presupuesto_bytes is not None:
+                bytes_reservados = presupuesto_bytes.reservar(
+                    _bytes_estimados_media(metadata, trabajo["message_type"])
+                )
+            _verificar_lease(lease)
+            cliente_s3, bucket = _obtener_cliente_s3_media()
+            if _modo_transferencia_media() == "streaming":
+                # El hash se conoce al terminar de subir; un duplicado se
+                # detecta al persistir y la copia propia se borra.
+                datos_media = _transferir_media_a_s3_streaming(
+                    metadata,
+                    token,
+                    trabajo,
+                    cliente_s3,
+                    bucket,
+                    lease
+                )
+                s3_key = datos_media["s3_key"]
+                objeto_subido = True
+            else:
+                datos_media = _descargar_media_a_temporal(
+                    metadata,
+                    token,
+                    trabajo["message_type"],
+                    lease
+                )
+                archivo_temporal = datos_media["archivo"]
+                objeto_existente = _buscar_objeto_media(
+                    trabajo["cliente_id"],
+                    datos_media["sha256"],
+                    trabajo["message_type"]
+                )
+                if objeto_existente is None:
+                    _verificar_lease(lease)
+                    s3_key = _construir_s3_key_media(
+                        trabajo,
+                        datos_media["extension"]
+                    )
+                    try:
+                        cliente_s3.upload_fileobj(
+                            archivo_temporal,
+                            bucket,
+                            s3_key,
+                            ExtraArgs={"ContentType": datos_media["mime_type"]}
+                        )
+                    except Exception:
+                        raise ErrorProcesamientoMedia("s3_upload_error")
+                    objeto_subido = True
+
+        if objeto_existente is not None:
+            bucket = objeto_existente["s3_bucket"]
+            s3_key = objeto_existente["s3_key"]
+        _verificar_lease(lease)
 
         resultado_persistencia = _persistir_media_y_completar(
             trabajo,
             datos_media,
             bucket,
-            s3_key
+            s3_key,
+            objeto_id_existente=(
+                objeto_existente["id"] if objeto_existente else None
+            )
+        )
+        # Ya persistido, el objeto pertenece a la BD y no se limpia en error.
+        copia_redundante = (
+            objeto_subido and resultado_persistencia["objeto_reutilizado"]
+        )
+        objeto_subido = False
+        if copia_redundante:
+            try:
+                cliente_s3.delete_object(Bucket=bucket, Key=s3_key)
+            except Exception:
+                app.logger.error(
+                    "No se pudo borrar copia S3 duplicada: "
+                    f"cliente_id={trabajo['cliente_id']}, "
+                    f"event_id={trabajo['event_id']}"
+                )
+        dedup_hit_rate = _registrar_dedup_media(
+            resultado_persistencia["objeto_reutilizado"]
         )
         media_id_db = resultado_persistencia["media_id"]
 
-        fecha_socket = resultado_persistencia["fecha"]
-        if hasattr(fecha_socket, "isoformat"):
-            fecha_socket = fecha_socket.isoformat()
-
         try:
-            socketio.emit(
-                "nuevo_mensaje",
-                {
-                    "remitente": trabajo["remitente"],
-                    "mensaje": resultado_persistencia["mensaje"],
-                    "tipo": resultado_persistencia["tipo"],
-                    "fecha": fecha_socket,
-                    "cliente_id": trabajo["cliente_id"],
-                    "whatsapp_media_id": media_id_db,
-                    "media_url": f"/api/media/{media_id_db}",
-                },
-                room=f"cliente_{trabajo['cliente_id']}"
+            _generar_miniatura_media(
+                trabajo,
+                resultado_persistencia,
+                archivo_temporal
             )
         except Exception as e:
             app.logger.warning(
-                "No se pudo emitir media completada por Socket.IO: "
+                "No se pudo generar miniatura de media: "
                 f"cliente_id={trabajo['cliente_id']}, "
                 f"event_id={trabajo['event_id']}, "
-                f"tipo_error={type(e).__name__}"
+                f"media_id={media_id_db}, "
+                f"error_code={e if isinstance(e, ErrorProcesamientoMedia) else type(e).__name__}"
             )
 
         app.logger.info(
@@ -2518,7 +5176,10 @@ def procesar_un_trabajo_multimedia():
             f"event_id={trabajo['event_id']}, "
             f"media_type={trabajo['message_type']}, "
             f"attempts={trabajo['attempts']}, "
-            f"size_bytes={datos_media['size_bytes']}"
+            f"size_bytes={datos_media['size_bytes']}, "
+            "dedup="
+            f"{'hit' if resultado_persistencia['objeto_reutilizado'] else 'miss'}, "
+            f"dedup_hit_rate={dedup_hit_rate:.3f}"
         )
         return {
             "status": "completed",
@@ -2576,6 +5237,8 @@ def procesar_un_trabajo_multimedia():
     finally:
         if archivo_temporal:
             archivo_temporal.close()
+        if presupuesto_bytes is not None and bytes_reservados:
+            presupuesto_bytes.liberar(bytes_reservados)
 
 
 @app.cli.command("procesar-media-una-vez")
@@ -2585,6 +5248,399 @@ def procesar_media_una_vez_command():
     print(json.dumps(resultado, ensure_ascii=False))
 
 
+@app.cli.command("media-salientes-refrescar")
+@click.option("--lote", type=int, default=50, show_default=True, help="Assets por ejecución.")
+def media_salientes_refrescar_command(lote):
+    """Sube a Meta o revalida los assets de flujos pendientes y termina."""
+    refrescados = refrescar_medias_salientes(lote)
+    print(json.dumps({"refrescados": refrescados}, ensure_ascii=False))
+
+
+# Condición de "dead letter": fallido sin reintento programado (permanente)
+# o con el presupuesto de intentos agotado.
+SQL_EVENTO_MEDIA_DEFINITIVO = """
+    status = 'failed'
+    AND (next_attempt_at IS NULL OR attempts >= %(max_attempts)s)
+"""
+
+
+@app.cli.command("media-fallidos")
+@click.option("--cliente-id", type=int, default=None, help="Filtra por tenant.")
+@click.option(
+    "--incluir-reintentos",
+    is_flag=True,
+    help="Incluye fallidos que aún tienen reintento programado.",
+)
+def media_fallidos_command(cliente_id, incluir_reintentos):
+    """Lista eventos multimedia fallidos agrupados por error, tenant y antigüedad."""
+    max_attempts = _obtener_entero_positivo_env(
+        "WHATSAPP_MEDIA_MAX_ATTEMPTS",
+        5
+    )
+    filtro_estado = (
+        "status = 'failed'" if incluir_reintentos else SQL_EVENTO_MEDIA_DEFINITIVO
+    )
+    conn = conectar_db()
+    if not conn:
+        raise RuntimeError("No se pudo conectar a la base de datos")
+    try:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        cursor.execute(f"""
+            SELECT
+                COALESCE(last_error, '') AS last_error,
+                cliente_id,
+                CASE
+                    WHEN creado_en >= NOW() - INTERVAL '1 hour' THEN '<1h'
+                    WHEN creado_en >= NOW() - INTERVAL '1 day' THEN '1h-24h'
+                    WHEN creado_en >= NOW() - INTERVAL '7 days' THEN '1d-7d'
+                    ELSE '>7d'
+                END AS antiguedad,
+                (next_attempt_at IS NULL OR attempts >= %(max_attempts)s) AS definitivo,
+                COUNT(*) AS total,
+                MIN(creado_en) AS mas_antiguo
+            FROM whatsapp_inbound_events
+            WHERE {filtro_estado}
+              AND (%(cliente_id)s::int IS NULL OR cliente_id = %(cliente_id)s)
+            GROUP BY 1, 2, 3, 4
+            ORDER BY total DESC, last_error, cliente_id
+        """, {"max_attempts": max_attempts, "cliente_id": cliente_id})
+        grupos = cursor.fetchall()
+        conn.rollback()
+    finally:
+        liberar_db(conn)
+
+    for grupo in grupos:
+        grupo = dict(grupo)
+        grupo["mas_antiguo"] = grupo["mas_antiguo"].isoformat()
+        print(json.dumps(grupo, ensure_ascii=False))
+    print(json.dumps(
+        {"grupos": len(grupos), "eventos": sum(g["total"] for g in grupos)},
+        ensure_ascii=False
+    ))
+
+
+@app.cli.command("media-reencolar")
+@click.option("--error", "last_error", default=None, help="last_error exacto.")
+@click.option("--cliente-id", type=int, default=None, help="Filtra por tenant.")
+@click.option(
+    "--desde-horas",
+    type=int,
+    default=None,
+    help="Sólo eventos creados en las últimas N horas.",
+)
+@click.option("--limite", type=int, default=10000, show_default=True)
+@click.option(
+    "--por-minuto",
+    type=int,
+    default=None,
+    help="Escalona next_attempt_at para liberar N eventos por minuto.",
+)
+@click.option("--dry-run", is_flag=True, help="Cuenta sin modificar nada.")
+def media_reencolar_command(
+    last_error,
+    cliente_id,
+    desde_horas,
+    limite,
+    por_minuto,
+    dry_run
+):
+    """Reencola eventos multimedia definitivamente fallidos con intentos en cero."""
+    if limite <= 0 or (por_minuto is not None and por_minuto <= 0):
+        raise click.BadParameter("--limite y --por-minuto deben ser positivos")
+    max_attempts = _obtener_entero_positivo_env(
+        "WHATSAPP_MEDIA_MAX_ATTEMPTS",
+        5
+    )
+    conn = conectar_db()
+    if not conn:
+        raise RuntimeError("No se pudo conectar a la base de datos")
+    try:
+        cursor = conn.cursor()
+        # Un solo UPDATE por lote. Con --por-minuto, la posición de cada
+        # evento fija su next_attempt_at: los workers lo drenan al ritmo
+        # indicado sin recibir miles de trabajos a la vez.
+        cursor.execute(f"""
+            WITH bloqueados AS (
+                SELECT id, creado_en
+                FROM whatsapp_inbound_events
+                WHERE {SQL_EVENTO_MEDIA_DEFINITIVO}
+                  AND (%(last_error)s::text IS NULL OR last_error = %(last_error)s)
+                  AND (%(cliente_id)s::int IS NULL OR cliente_id = %(cliente_id)s)
+                  AND (
+                      %(desde_horas)s::int IS NULL
+                      OR creado_en >= NOW() - (%(desde_horas)s * INTERVAL '1 hour')
+                  )
+                ORDER BY creado_en, id
+                LIMIT %(limite)s
+                FOR UPDATE SKIP LOCKED
+            ),
+            seleccion AS (
+                SELECT id, ROW_NUMBER() OVER (ORDER BY creado_en, id) - 1 AS posicion
+                FROM bloqueados
+            )
+            UPDATE whatsapp_inbound_events AS evento
+            SET status = 'pending',
+                attempts = 0,
+                locked_at = NULL,
+                lock_token = NULL,
+                processed_at = NULL,
+                last_error = NULL,
+                next_attempt_at = NOW() + CASE
+                    WHEN %(por_minuto)s::int IS NULL THEN INTERVAL '0'
+                    ELSE (seleccion.posicion / %(por_minuto)s::int) * INTERVAL '1 minute'
+                END,
+                actualizado_en = NOW()
+            FROM seleccion
+            WHERE evento.id = seleccion.id
+        """, {
+            "max_attempts": max_attempts,
+            "last_error": last_error,
+            "cliente_id": cliente_id,
+            "desde_horas": desde_horas,
+            "limite": limite,
+            "por_minuto": por_minuto,
+        })
+        reencolados = cursor.rowcount
+        if dry_run:
+            conn.rollback()
+        else:
+            cursor.execute(
+                "SELECT pg_notify(%s, %s)",
+                (WHATSAPP_MEDIA_CANAL_NOTIFY, "reencolar")
+            )
+            conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        liberar_db(conn)
+
+    minutos = (
+        -(-reencolados // por_minuto) if por_minuto and reencolados else 0
+    )
+    print(json.dumps({
+        "reencolados": reencolados,
+        "dry_run": dry_run,
+        "minutos_estimados": minutos,
+    }, ensure_ascii=False))
+
+
+@app.cli.command("media-dedup-stats")
+def media_dedup_stats_command():
+    """Tasa de deduplicación de media por tenant (referencias vs objetos)."""
+    conn = conectar_db()
+    if not conn:
+        raise RuntimeError("No se pudo conectar a la base de datos")
+    try:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        cursor.execute("""
+            SELECT
+                cliente_id,
+                COUNT(*) AS objetos,
+                COALESCE(SUM(ref_count), 0) AS referencias,
+                COALESCE(SUM((ref_count - 1) * size_bytes), 0) AS bytes_ahorrados
+            FROM whatsapp_media_objetos
+            WHERE ref_count > 0
+            GROUP BY cliente_id
+            ORDER BY cliente_id
+        """)
+        tenants = []
+        for fila in cursor.fetchall():
+            referencias = int(fila["referencias"])
+            objetos = int(fila["objetos"])
+            tenants.append({
+                "cliente_id": fila["cliente_id"],
+                "objetos": objetos,
+                "referencias": referencias,
+                "dedup_hit_rate": (
+                    round((referencias - objetos) / referencias, 4)
+                    if referencias else 0.0
+                ),
+                "bytes_ahorrados": int(fila["bytes_ahorrados"]),
+            })
+    finally:
+        liberar_db(conn)
+    print(json.dumps({"tenants": tenants}, ensure_ascii=False))
+
+
+# ============================================================================
+# RESUMEN POR CONVERSACIÓN (conversation_summary)
+# ============================================================================
+def _sql_ultimo_si_mas_reciente(columna):
+    return (
+        f"CASE WHEN EXCLUDED.ultima_fecha >= cs.ultima_fecha "
+        f"THEN EXCLUDED.{columna} ELSE cs.{columna} END"
+    )
+
+
+def actualizar_resumen_conversacion(
+    cursor,
+    cliente_id,
+    remitente,
+    mensaje_id,
+    mensaje,
+    tipo,
+    fecha,
+    whatsapp_media_id=None
+):
+    """
+    Refleja en conversation_summary un mensaje recién insertado; se llama en
+    la misma transacción que el INSERT en mensajes.
+
+    Un mensaje con fecha anterior al último (media procesada tarde) sólo
+    suma no leídos. Un saliente más reciente deja la conversación leída.
+    """
+    cursor.execute(f"""
+        INSERT INTO conversation_summary AS cs (
+            cliente_id,
+            remitente,
+            ultimo_mensaje_id,
+            ultimo_mensaje,
+            ultimo_tipo,
+            ultima_fecha,
+            ultimo_media_id,
+            no_leidos
+        )
+        VALUES (%s, %s, %s, %s, %s, %s, %s, CASE WHEN %s LIKE 'recibido%%' THEN 1 ELSE 0 END)
+        ON CONFLICT (cliente_id, remitente) DO UPDATE SET
+            ultimo_mensaje_id = {_sql_ultimo_si_mas_reciente("ultimo_mensaje_id")},
+            ultimo_mensaje = {_sql_ultimo_si_mas_reciente("ultimo_mensaje")},
+            ultimo_tipo = {_sql_ultimo_si_mas_reciente("ultimo_tipo")},
+            ultimo_media_id = {_sql_ultimo_si_mas_reciente("ultimo_media_id")},
+            ultima_fecha = GREATEST(EXCLUDED.ultima_fecha, cs.ultima_fecha),
+            no_leidos = CASE
+                WHEN EXCLUDED.ultimo_tipo LIKE 'enviado%%'
+                     AND EXCLUDED.ultima_fecha >= cs.ultima_fecha THEN 0
+                ELSE cs.no_leidos + EXCLUDED.no_leidos
+            END,
+            actualizado_en = NOW()
+    """, (
+        cliente_id,
+        remitente,
+        mensaje_id,
+        mensaje,
+        tipo,
+        fecha,
+        whatsapp_media_id,
+        tipo,
+    ))
+
+
+SQL_BACKFILL_RESUMEN_CONVERSACIONES = """
+    WITH ultimos AS (
+        SELECT DISTINCT ON (remitente)
+            remitente, id, mensaje, tipo, fecha, whatsapp_media_id
+        FROM mensajes
+        WHERE cliente_id = %(cliente_id)s
+        ORDER BY remitente, fecha DESC, id DESC
+    ),
+    ultima_salida AS (
+        SELECT remitente, MAX(fecha) AS fecha
+        FROM mensajes
+        WHERE cliente_id = %(cliente_id)s AND tipo LIKE 'enviado%%'
+        GROUP BY remitente
+    ),
+    pendientes AS (
+        SELECT m.remitente, COUNT(*) AS no_leidos
+        FROM mensajes AS m
+        LEFT JOIN ultima_salida AS s ON s.remitente = m.remitente
+        WHERE m.cliente_id = %(cliente_id)s
+          AND m.tipo LIKE 'recibido%%'
+          AND (s.fecha IS NULL OR m.fecha > s.fecha)
+        GROUP BY m.remitente
+    )
+    INSERT INTO conversation_summary (
+        cliente_id, remitente, ultimo_mensaje_id, ultimo_mensaje, ultimo_tipo,
+        ultima_fecha, ultimo_media_id, no_leidos
+    )
+    SELECT
+        %(cliente_id)s, u.remitente, u.id, u.mensaje, u.tipo,
+        u.fecha, u.whatsapp_media_id, COALESCE(p.no_leidos, 0)
+    FROM ultimos AS u
+    LEFT JOIN pendientes AS p ON p.remitente = u.remitente
+    WHERE u.fecha IS NOT NULL
+    ON CONFLICT (cliente_id, remitente) DO UPDATE SET
+        ultimo_mensaje_id = EXCLUDED.ultimo_mensaje_id,
+        ultimo_mensaje = EXCLUDED.ultimo_mensaje,
+        ultimo_tipo = EXCLUDED.ultimo_tipo,
+        ultima_fecha = EXCLUDED.ultima_fecha,
+        ultimo_media_id = EXCLUDED.ultimo_media_id,
+        no_leidos = EXCLUDED.no_leidos,
+        actualizado_en = NOW()
+"""
+
+
+@app.cli.command("conversaciones-backfill")
+@click.option("--cliente-id", type=int, default=None, help="Sólo este tenant.")
+def conversaciones_backfill_command(cliente_id):
+    """Reconstruye conversation_summary desde mensajes, un tenant por transacción."""
+    conn = conectar_db()
+    if not conn:
+        raise RuntimeError("No se pudo conectar a la base de datos")
+    try:
+        cursor = conn.cursor()
+        if cliente_id is not None:
+            tenants = [cliente_id]
+        else:
+            cursor.execute("SELECT DISTINCT cliente_id FROM mensajes ORDER BY cliente_id")
+            tenants = [fila[0] for fila in cursor.fetchall()]
+            conn.rollback()
+
+        resultado = []
+        for tenant_id in tenants:
+            try:
+                cursor.execute(SQL_BACKFILL_RESUMEN_CONVERSACIONES, {"cliente_id": tenant_id})
+                conversaciones = cursor.rowcount
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            resultado.append({"cliente_id": tenant_id, "conversaciones": conversaciones})
+    finally:
+        liberar_db(conn)
+    print(json.dumps({"tenants": resultado}, ensure_ascii=False))
+
+
+@app.route("/api/chat/leido", methods=["POST"])
+def marcar_chat_leido():
+    """
+    El agente abrió la conversación: sus no leídos vuelven a cero.
+    Acepta {"telefono": X} o {"telefonos": [..]} para marcar varias a la vez.
+    """
+    cliente_id = obtener_cliente_id_de_subdominio()
+    if not cliente_id:
+        return jsonify({"error": "No autorizado"}), 401
+    datos = request.get_json(silent=True) or {}
+    telefonos = datos.get("telefonos")
+    if not isinstance(telefonos, list):
+        telefonos = [datos.get("telefono")]
+    telefonos = sorted({str(t).strip() for t in telefonos if t and str(t).strip()})
+    if not telefonos:
+        return jsonify({"error": "Falta el teléfono"}), 400
+    if len(telefonos) > _obtener_entero_positivo_env("MENSAJES_ESTADO_LOTE_MAX_IDS", 1000):
+        return jsonify({"error": "Demasiadas conversaciones en una sola operación"}), 400
+
+    conn = conectar_db()
+    if not conn:
+        return jsonify({"error": "No se pudo conectar a la base de datos"}), 500
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            UPDATE conversation_summary
+            SET no_leidos = 0, actualizado_en = NOW()
+            WHERE cliente_id = %s AND remitente = ANY(%s) AND no_leidos > 0
+        """, (cliente_id, telefonos))
+        marcados = cursor.rowcount
+        conn.commit()
+        return jsonify({"ok": True, "marcados": marcados}), 200
+    except Exception as e:
+        conn.rollback()
+        app.logger.error(f"Error marcando chat leído: tipo_error={type(e).__name__}")
+        return jsonify({"error": "No se pudo actualizar"}), 500
+    finally:
+        liberar_db(conn)
+
+
 # ============================================================================
 # 1. RECIBIR MENSAJES DESDE WHATSAPP (BOT -> CRM)
 # ============================================================================
@@ -2621,6 +5677,10 @@ def recibir_mensaje():
         datos.get("whatsapp_phone_id", "")
     ).strip()
 
+    meta_message_id = str(
+        datos.get("meta_message_id") or ""
+    ).strip() or None
+
     print(
         f"📝 [CRM] Datos procesados -> "
         f"Remitente: {remitente}, "
@@ -2715,19 +5775,48 @@ def recibir_mensaje():
 
         # 2. Guardar el mensaje en la BD
         cursor.execute("""
-            INSERT INTO mensajes (plataforma, remitente, mensaje, estado, tipo, cliente_id, fecha)
-            VALUES (%s, %s, %s, 'Nuevo', %s, %s, NOW())
-        """, (plataforma, remitente, mensaje, tipo, cliente_id))
+            INSERT INTO mensajes (plataforma, remitente, mensaje, estado, tipo, cliente_id, fecha, meta_message_id)
+            VALUES (%s, %s, %s, 'Nuevo', %s, %s, NOW(), %s)
+            ON CONFLICT (cliente_id, meta_message_id)
+                WHERE meta_message_id IS NOT NULL
+            DO NOTHING
+            RETURNING id, fecha
+        """, (plataforma, remitente, mensaje, tipo, cliente_id, meta_message_id))
+        insertado = cursor.fetchone()
+        # Un reintento del bot con el mismo wamid ya se guardó, se publicó y
+        # se respondió: no se vuelve a emitir ni a correr la automatización.
+        if not insertado:
+            conn.commit()
+            print(
+                f"♻️ [CRM] Mensaje duplicado ignorado -> "
+                f"cliente_id={cliente_id}, meta_message_id={meta_message_id}"
+            )
+            return jsonify({
+                "ok": True,
+                "duplicado": True,
+                "mensaje": "Mensaje ya recibido"
+            }), 200
+
+        actualizar_resumen_conversacion(
+            cursor,
+            cliente_id,
+            remitente,
+            insertado[0],
+            mensaje,
+            tipo,
+            insertado[1],
+        )
 
         # Hacer durable y publicar el inbound antes de cualquier automatización.
-        conn.commit()
-        socketio.emit("nuevo_mensaje", {
+        encolar_mensaje_realtime(cursor, cliente_id, {
+            "id": insertado[0],
             "remitente": remitente,
             "mensaje": mensaje,
             "tipo": tipo,
             "fecha": datetime.now().isoformat(),
             "cliente_id": cliente_id
-        }, room=f"cliente_{cliente_id}")
+        })
+        conn.commit()
 
         # ========================================================================
         # 🧠 3. LÓGICA DE RESPUESTA AUTOMÁTICA (FLUJOS + TUS KEYWORDS FUNCIONALES)
@@ -3148,9 +6237,19 @@ def enviar_mensaje():
             RETURNING id, fecha
         """, (telefono, mensaje_texto, tipo_persistido, cliente_id))
         mensaje_id, fecha_mensaje = cursor.fetchone()
+        actualizar_resumen_conversacion(
+            cursor,
+            cliente_id,
+            telefono,
+            mensaje_id,
+            mensaje_texto,
+            tipo_persistido,
+            fecha_mensaje,
+        )
         conn.commit()
 
         exito = False
+        meta_message_id = None
         # Sin una idempotency key durable, cada intento manual realiza una
         # sola llamada. Flask espera más que el timeout Meta de cada helper.
         timeout_gateway = 25 if tipo == "imagen" else 35 if tipo == "video" else 20
@@ -3163,6 +6262,7 @@ def enviar_mensaje():
             )
             if r.status_code == 200:
                 exito = True
+                meta_message_id = _extraer_meta_message_id(r)
             elif r.status_code == 504:
                 app.logger.warning(
                     "resultado_ambiguo_timeout: "
@@ -3194,36 +6294,33 @@ def enviar_mensaje():
             conn.commit()
             return jsonify({"error": "No se pudo conectar con el servicio de mensajería"}), 500
 
+        # El wamid permite aplicar después los estados delivered/read que
+        # Meta envía al webhook.
         cursor.execute("""
-            UPDATE mensajes SET estado = 'Enviado'
+            UPDATE mensajes
+            SET estado = 'Enviado',
+                meta_message_id = COALESCE(%s, meta_message_id)
             WHERE id = %s AND cliente_id = %s
-        """, (mensaje_id, cliente_id))
-        conn.commit()
+        """, (meta_message_id, mensaje_id, cliente_id))
 
-        # Flask publica el envío manual sólo después de confirmar a Node y
-        # persistir estado='Enviado', siempre en la room del tenant.
-        try:
-            socketio.emit(
-                "nuevo_mensaje",
-                {
-                    "id": mensaje_id,
-                    "remitente": telefono,
-                    "mensaje": mensaje_texto,
-                    "tipo": tipo_persistido,
-                    "estado": "Enviado",
-                    "fecha": fecha_mensaje.isoformat(),
-                    "cliente_id": cliente_id,
-                    "whatsapp_media_id": None,
-                    "media_url": None
-                },
-                room=f"cliente_{cliente_id}"
-            )
-        except Exception as emit_error:
-            app.logger.warning(
-                "No se pudo emitir el mensaje saliente por Socket.IO: "
-                f"cliente_id={cliente_id}, mensaje_id={mensaje_id}, "
-                f"error={emit_error}"
-            )
+        # El envío manual se publica sólo después de confirmar a Node, en la
+        # misma transacción que persiste estado='Enviado'.
+        encolar_mensaje_realtime(
+            cursor,
+            cliente_id,
+            {
+                "id": mensaje_id,
+                "remitente": telefono,
+                "mensaje": mensaje_texto,
+                "tipo": tipo_persistido,
+                "estado": "Enviado",
+                "fecha": fecha_mensaje,
+                "cliente_id": cliente_id,
+                "whatsapp_media_id": None,
+                "media_url": None
+            }
+        )
+        conn.commit()
 
         return jsonify({"mensaje": "Mensaje enviado correctamente"}), 200
 
@@ -3364,6 +6461,205 @@ def upload_imagen_chat():
             "error": "No se pudo guardar el archivo."
         }), 500
 
+
+# Subida directa del navegador a S3 (presigned POST). Los bytes no pasan por
+# el worker web: el servidor sólo firma la política y valida el objeto.
+CHAT_UPLOAD_MIME_EXTENSIONES = {
+    "imagen": {
+        "image/jpeg": {"jpg", "jpeg"},
+        "image/png": {"png"},
+        "image/gif": {"gif"},
+        "image/webp": {"webp"},
+    },
+    "video": {
+        "video/mp4": {"mp4"},
+        "video/3gpp": {"3gp", "3gpp"},
+    },
+}
+
+CHAT_UPLOAD_NOMBRE_RE = re.compile(r"^[0-9a-f]{32}\.[a-z0-9]{2,5}$")
+
+
+def _prefijo_upload_chat(cliente_id):
+    return f"tenants/{cliente_id}/chat/outbound/"
+
+
+def _limite_upload_chat(tipo):
+    if tipo == "video":
+        return WHATSAPP_VIDEO_MAX_BYTES
+    return _limite_media_bytes("image")
+
+
+def _clasificar_upload_chat(extension, mime_type):
+    """Regresa "imagen" o "video" si la pareja extensión/MIME es aceptada."""
+    for tipo, mimes in CHAT_UPLOAD_MIME_EXTENSIONES.items():
+        if extension in mimes.get(mime_type, ()):
+            return tipo
+    return None
+
+
+@app.route("/api/chat/upload/firmar", methods=["POST"])
+def firmar_upload_chat():
+    if not g.current_user:
+        return jsonify({"error": "No autorizado"}), 401
+
+    cliente_id = g.current_user["cliente_id"]
+    datos = request.get_json(silent=True) or {}
+    nombre_seguro = secure_filename(str(datos.get("filename") or ""))
+    extension = os.path.splitext(nombre_seguro)[1].lower().lstrip(".")
+    mime_type = str(datos.get("content_type") or "").split(";", 1)[0].strip().lower()
+    try:
+        tamano = int(datos.get("size"))
+    except (TypeError, ValueError):
+        return jsonify({"ok": False, "code": "size_invalido", "error": "Tamaño inválido."}), 400
+
+    tipo = _clasificar_upload_chat(extension, mime_type)
+    if not tipo:
+        es_video = mime_type.startswith("video/")
+        return jsonify({
+            "ok": False,
+            "code": (
+                "video_format_not_supported"
+                if es_video else "image_format_not_supported"
+            ),
+            "error": (
+                "Formato de video no compatible. Usa MP4 o 3GP."
+                if es_video else "Formato de imagen no compatible."
+            )
+        }), 415
+
+    max_bytes = _limite_upload_chat(tipo)
+    if tamano <= 0 or tamano > max_bytes:
+        return jsonify({
+            "ok": False,
+            "code": "video_too_large" if tipo == "video" else "image_too_large",
+            "error": (
+                "El video supera el máximo permitido de 15 MB."
+                if tipo == "video" else "La imagen supera el máximo permitido."
+            ),
+            "max_bytes": max_bytes
+        }), 413
+
+    key = f"{_prefijo_upload_chat(cliente_id)}{uuid.uuid4().hex}.{extension}"
+    try:
+        cliente_s3, bucket = _obtener_cliente_s3_media()
+        # La política fija key, Content-Type y rango de tamaño; S3 rechaza
+        # cualquier otro archivo aunque el navegador altere el formulario.
+        politica = cliente_s3.generate_presigned_post(
+            Bucket=bucket,
+            Key=key,
+            Fields={"Content-Type": mime_type},
+            Conditions=[
+                {"Content-Type": mime_type},
+                ["content-length-range", 1, max_bytes],
+            ],
+            ExpiresIn=_obtener_entero_positivo_env(
+                "CHAT_UPLOAD_POLICY_EXPIRES_SECONDS",
+                300
+            ),
+        )
+    except Exception as e:
+        app.logger.error(
+            "Error al firmar upload directo: "
+            f"cliente_id={cliente_id}, tipo_error={type(e).__name__}"
+        )
+        return jsonify({
+            "ok": False,
+            "code": "upload_internal_error",
+            "error": "No se pudo preparar la subida."
+        }), 500
+
+    return jsonify({
+        "ok": True,
+        "url": politica["url"],
+        "fields": politica["fields"],
+        "key": key,
+        "tipo": tipo,
+    }), 200
+
+
+@app.route("/api/chat/upload/finalizar", methods=["POST"])
+def finalizar_upload_chat():
+    if not g.current_user:
+        return jsonify({"error": "No autorizado"}), 401
+
+    cliente_id = g.current_user["cliente_id"]
+    datos = request.get_json(silent=True) or {}
+    key = str(datos.get("key") or "")
+    prefijo = _prefijo_upload_chat(cliente_id)
+    nombre = key[len(prefijo):] if key.startswith(prefijo) else ""
+    if not CHAT_UPLOAD_NOMBRE_RE.match(nombre):
+        return jsonify({"ok": False, "code": "key_invalida", "error": "Archivo inválido."}), 400
+
+    try:
+        cliente_s3, bucket = _obtener_cliente_s3_media()
+        try:
+            objeto = cliente_s3.head_object(Bucket=bucket, Key=key)
+        except Exception:
+            return jsonify({
+                "ok": False,
+                "code": "upload_no_encontrado",
+                "error": "El archivo no se subió correctamente."
+            }), 404
+
+        extension = nombre.rsplit(".", 1)[1]
+        mime_type = str(objeto.get("ContentType") or "").split(";", 1)[0].strip().lower()
+        tipo = _clasificar_upload_chat(extension, mime_type)
+        tamano = int(objeto.get("ContentLength") or 0)
+        if not tipo or tamano <= 0 or tamano > _limite_upload_chat(tipo):
+            cliente_s3.delete_object(Bucket=bucket, Key=key)
+            return jsonify({
+                "ok": False,
+                "code": "upload_invalido",
+                "error": "El archivo subido no es válido."
+            }), 422
+    except Exception as e:
+        app.logger.error(
+            "Error al finalizar upload directo: "
+            f"cliente_id={cliente_id}, tipo_error={type(e).__name__}"
+        )
+        return jsonify({
+            "ok": False,
+            "code": "upload_internal_error",
+            "error": "No se pudo validar el archivo."
+        }), 500
+
+    # URL estable del CRM (igual que /static/uploads): el gateway y el
+    # historial del chat la siguen pudiendo abrir después de que expire
+    # cualquier URL presignada.
+    dominio_base = request.host_url.rstrip('/')
+    return jsonify({
+        "ok": True,
+        "url": f"{dominio_base}/api/chat/archivos/{nombre}",
+        "tipo": tipo,
+    }), 200
+
+
+@app.route("/api/chat/archivos/<nombre>", methods=["GET"])
+def obtener_archivo_chat(nombre):
+    # Público como /static/uploads: el nombre es un UUID aleatorio y el
+    # gateway lo descarga sin sesión. El tenant sale del subdominio.
+    cliente_id = obtener_cliente_id_de_subdominio()
+    if not cliente_id or not CHAT_UPLOAD_NOMBRE_RE.match(nombre):
+        return jsonify({"error": "Archivo no encontrado"}), 404
+
+    try:
+        cliente_s3, bucket = _obtener_cliente_s3_media()
+        url_firmada = _firmar_url_media(
+            cliente_id,
+            nombre,
+            bucket,
+            f"{_prefijo_upload_chat(cliente_id)}{nombre}",
+            "chat_upload"
+        )
+    except Exception as e:
+        app.logger.error(
+            "Error al generar acceso a archivo del chat: "
+            f"cliente_id={cliente_id}, tipo_error={type(e).__name__}"
+        )
+        return jsonify({"error": "No se pudo obtener el archivo"}), 500
+    return redirect(url_firmada, code=302)
+
     
 # ============================================================================
 # 4. OBTENER MENSAJES (LISTA DE CHATS Y DETALLE)
@@ -3374,6 +6670,22 @@ def obtener_media_privada(media_id):
         return jsonify({"error": "No autorizado"}), 401
 
     cliente_id = g.current_user["cliente_id"]
+    variante = request.args.get("variant", "original")
+    if variante not in ("original", "thumb"):
+        return jsonify({"error": "Variante no soportada"}), 400
+
+    def _redirigir(url_firmada, segundos_vigente):
+        respuesta = redirect(url_firmada, code=302)
+        # El navegador puede reutilizar la redirección mientras la URL vale.
+        respuesta.headers["Cache-Control"] = (
+            f"private, max-age={max(0, segundos_vigente)}"
+        )
+        return respuesta
+
+    en_cache = _url_firmada_en_cache(cliente_id, media_id, variante)
+    if en_cache:
+        return _redirigir(*en_cache)
+
     conn = conectar_db()
     if not conn:
         return jsonify({"error": "No se pudo conectar a la base de datos"}), 500
@@ -3384,8 +6696,7 @@ def obtener_media_privada(media_id):
             SELECT
                 s3_bucket,
                 s3_key,
-                mime_type,
-                original_filename
+                thumb_s3_key
             FROM whatsapp_media
             WHERE id = %s
               AND cliente_id = %s
@@ -3395,21 +6706,23 @@ def obtener_media_privada(media_id):
         if not media:
             return jsonify({"error": "Media no encontrada"}), 404
 
-        bucket, key, _mime_type, _original_filename = media
-        cliente_s3, _bucket_configurado = _crear_cliente_s3_media()
-        expiracion = _obtener_entero_positivo_env(
-            "WHATSAPP_MEDIA_PRESIGNED_EXPIRES_SECONDS",
-            300
-        )
-        url_firmada = cliente_s3.generate_presigned_url(
-            "get_object",
-            Params={
-                "Bucket": bucket,
-                "Key": key
-            },
-            ExpiresIn=expiracion
+        bucket, key, thumb_key = media
+        # Sin miniatura todavía, la variante thumb sirve el original (y se
+        # cachea como original para no fijar el fallback bajo "thumb").
+        if variante == "thumb":
+            if thumb_key:
+                key = thumb_key
+            else:
+                variante = "original"
+        url_firmada = _firmar_url_media(
+            cliente_id,
+            media_id,
+            bucket,
+            key,
+            variante
         )
-        return redirect(url_firmada, code=302)
+        expiracion, margen = _parametros_urls_firmadas()
+        return _redirigir(url_firmada, expiracion - margen)
     except ErrorProcesamientoMedia:
         app.logger.error(
             "Configuración incompleta al generar acceso a media privada: "
@@ -3439,17 +6752,22 @@ def obtener_mensajes():
 
     try:
         cursor = conn.cursor(cursor_factory=RealDictCursor)
-        # Obtenemos los últimos mensajes para armar la lista de chats
+        # Último mensaje por conversación (el más reciente al final: el
+        # frontend antepone cada chat a la lista)
         cursor.execute("""
-            SELECT DISTINCT ON (remitente)
-                remitente,
-                mensaje,
-                tipo,
-                fecha,
-                whatsapp_media_id
-            FROM mensajes 
-            WHERE cliente_id = %s 
-            ORDER BY remitente, fecha DESC
+            SELECT
+                cs.remitente,
+                cs.ultimo_mensaje AS mensaje,
+                cs.ultimo_tipo AS tipo,
+                cs.ultima_fecha AS fecha,
+                cs.ultimo_media_id AS whatsapp_media_id,
+                cs.no_leidos,
+                COALESCE(l.nombre, cs.remitente) AS nombre
+            FROM conversation_summary cs
+            LEFT JOIN leads l
+                ON l.cliente_id = cs.cliente_id AND l.telefono = cs.remitente
+            WHERE cs.cliente_id = %s
+            ORDER BY cs.ultima_fecha
         """, (cliente_id,))
         mensajes = [dict(row) for row in cursor.fetchall()]
         for mensaje in mensajes:
@@ -3465,8 +6783,28 @@ def obtener_mensajes():
         liberar_db(conn)
 
 
+def _cursor_mensaje_chat(mensaje):
+    if mensaje["fecha"] is None:
+        return None
+    return f"{mensaje['fecha'].isoformat()},{mensaje['id']}"
+
+
+def _parsear_cursor_mensaje_chat(valor):
+    """'<fecha ISO>,<id>' → (fecha, id); ValueError si no es válido."""
+    fecha_txt, _, id_txt = (valor or "").rpartition(",")
+    return datetime.fromisoformat(fecha_txt), int(id_txt)
+
+
 @app.route("/mensajes_chat", methods=["GET"])
 def obtener_mensajes_chat():
+    """
+    Historial de una conversación en orden cronológico.
+
+    Con ?limit=N (o before/after) pagina por keyset sobre (fecha, id):
+    sin cursor regresa la página más reciente; ?before=<cursor> la página
+    anterior y ?after=<cursor> lo posterior (fetch incremental). Sin esos
+    parámetros regresa el historial completo.
+    """
     cliente_id = obtener_cliente_id_de_subdominio()
     if not cliente_id:
         return jsonify({"error": "Cliente no autorizado"}), 404
@@ -3487,21 +6825,117 @@ def obtener_mensajes_chat():
         lead = cursor.fetchone()
         nombre_lead = lead["nombre"] if lead else remitente
 
-        # Obtener historial de mensajes ordenado cronológicamente
-        cursor.execute("""
-            SELECT id, mensaje, tipo, fecha, whatsapp_media_id
-            FROM mensajes 
-            WHERE remitente = %s AND cliente_id = %s 
-            ORDER BY fecha ASC
-        """, (remitente, cliente_id))
+        # Con media_inline=1 se regresan URLs presignadas en la misma
+        # respuesta y el navegador no pasa por /api/media/<id>. Sólo con
+        # sesión, igual que /api/media/<id>: sin ella quedan las rutas
+        # /api/media, que responden 401.
+        media_inline = (
+            request.args.get("media_inline") == "1"
+            and bool(g.current_user)
+        )
+
+        before = request.args.get("before")
+        after = request.args.get("after")
+        paginado = bool(before or after or request.args.get("limit"))
+        try:
+            limite = min(max(int(request.args.get("limit") or 50), 1), 200)
+            if before and after:
+                raise ValueError("before_y_after")
+            cursor_keyset = _parsear_cursor_mensaje_chat(before or after) if (before or after) else None
+        except ValueError:
+            return jsonify({"error": "Parámetros de paginación inválidos"}), 400
+
+        # Índice (cliente_id, remitente, fecha DESC, id DESC): la página
+        # más reciente y ?before se leen hacia atrás; ?after hacia adelante.
+        filtro_keyset = ""
+        orden = "m.fecha ASC, m.id ASC"
+        parametros = [remitente, cliente_id]
+        if paginado:
+            if after:
+                filtro_keyset = "AND (m.fecha, m.id) > (%s, %s)"
+                parametros.extend(cursor_keyset)
+            else:
+                orden = "m.fecha DESC, m.id DESC"
+                if before:
+                    filtro_keyset = "AND (m.fecha, m.id) < (%s, %s)"
+                    parametros.extend(cursor_keyset)
+            parametros.append(limite + 1)
+
+        cursor.execute(f"""
+            SELECT
+                m.id,
+                m.mensaje,
+                m.tipo,
+                m.estado,
+                m.fecha,
+                m.whatsapp_media_id,
+                wm.s3_bucket,
+                wm.s3_key,
+                wm.thumb_s3_key
+            FROM mensajes m
+            LEFT JOIN whatsapp_media wm
+              ON wm.id = m.whatsapp_media_id
+             AND wm.cliente_id = m.cliente_id
+            WHERE m.remitente = %s AND m.cliente_id = %s
+              {filtro_keyset}
+            ORDER BY {orden}
+            {"LIMIT %s" if paginado else ""}
+        """, parametros)
         mensajes = [dict(row) for row in cursor.fetchall()]
+
+        hay_mas = paginado and len(mensajes) > limite
+        if hay_mas:
+            mensajes = mensajes[:limite]
+        if paginado and not after:
+            mensajes.reverse()
+        # cursor_anterior: para ?before (None si no hay mensajes más viejos);
+        # cursor_siguiente: para ?after. Con ?after, hay_mas indica que
+        # quedan mensajes más nuevos por traer.
+        paginacion = {}
+        if paginado:
+            paginacion = {
+                "cursor_anterior": (
+                    _cursor_mensaje_chat(mensajes[0])
+                    if mensajes and hay_mas and not after else None
+                ),
+                "cursor_siguiente": (
+                    _cursor_mensaje_chat(mensajes[-1]) if mensajes else after
+                ),
+                "hay_mas": hay_mas,
+            }
+
         for mensaje in mensajes:
             media_id = mensaje.get("whatsapp_media_id")
+            bucket = mensaje.pop("s3_bucket")
+            key = mensaje.pop("s3_key")
+            thumb_key = mensaje.pop("thumb_s3_key")
             mensaje["media_url"] = (
                 f"/api/media/{media_id}" if media_id is not None else None
             )
-
-        return jsonify({"nombre": nombre_lead, "mensajes": mensajes})
+            mensaje["thumb_url"] = (
+                f"/api/media/{media_id}?variant=thumb" if thumb_key else None
+            )
+            if media_inline and media_id is not None and key:
+                try:
+                    mensaje["media_url"] = _firmar_url_media(
+                        cliente_id,
+                        media_id,
+                        bucket,
+                        key
+                    )
+                    if thumb_key:
+                        mensaje["thumb_url"] = _firmar_url_media(
+                            cliente_id,
+                            media_id,
+                            bucket,
+                            thumb_key,
+                            "thumb"
+                        )
+                except ErrorProcesamientoMedia:
+                    # Sin configuración S3 se conserva la ruta /api/media.
+                    media_inline = False
+
+        return jsonify({"nombre": nombre_lead, "mensajes": mensajes, **paginacion})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
     finally:
@@ -3512,6 +6946,165 @@ def obtener_mensajes_chat():
 
 
 
+
+# ============================================================================
+# BÚSQUEDA DE TEXTO COMPLETO EN MENSAJES
+# ============================================================================
+# Delimitadores que ts_headline pone alrededor de cada coincidencia; el
+# fragmento se escapa completo y después se cambian por <mark>.
+BUSQUEDA_INICIO_MARCA = "\x02"
+BUSQUEDA_FIN_MARCA = "\x03"
+
+
+def _fragmento_busqueda_html(fragmento):
+    return (
+        str(escape(fragmento or ""))
+        .replace(BUSQUEDA_INICIO_MARCA, "<mark>")
+        .replace(BUSQUEDA_FIN_MARCA, "</mark>")
+    )
+
+
+@app.route("/api/buscar", methods=["GET"])
+def api_buscar_mensajes():
+    """
+    Busca en los mensajes del tenant (español, sin acentos).
+
+    q acepta la sintaxis de websearch_to_tsquery ("frase exacta", -excluir,
+    OR). desde/hasta (ISO) acotan la fecha. Resultados por relevancia y luego
+    por fecha, paginados con limit/offset; cada uno trae un fragmento HTML
+    con las coincidencias en <mark> y el remitente para abrir el chat.
+    """
+    cliente_id = obtener_cliente_id_de_subdominio()
+    if not cliente_id:
+        return jsonify({"error": "No autorizado"}), 401
+
+    q = (request.args.get("q") or "").strip()
+    if not q:
+        return jsonify({"error": "Falta el texto a buscar"}), 400
+    try:
+        limite = min(max(int(request.args.get("limit") or 20), 1), 50)
+        offset = min(max(int(request.args.get("offset") or 0), 0), 1000)
+        filtros = []
+        parametros_filtro = []
+        for nombre, operador in (("desde", ">="), ("hasta", "<")):
+            valor = (request.args.get(nombre) or "").strip()
+            if valor:
+                filtros.append(f"AND m.fecha {operador} %s")
+                parametros_filtro.append(datetime.fromisoformat(valor))
+    except ValueError:
+        return jsonify({"error": "Parámetros inválidos"}), 400
+
+    conn = conectar_db()
+    if not conn:
+        return jsonify({"error": "No se pudo conectar a la base de datos"}), 500
+    try:
+        cursor = conn.cursor(cursor_factory=RealDictCursor)
+        # ts_headline es caro: sólo se calcula para la página ya ordenada.
+        cursor.execute(f"""
+            WITH consulta AS (
+                SELECT websearch_to_tsquery('es_unaccent', %s) AS tsq
+            ),
+            pagina AS (
+                SELECT
+                    m.id,
+                    m.remitente,
+                    m.tipo,
+                    m.fecha,
+                    m.mensaje,
+                    ts_rank_cd(m.mensaje_tsv, consulta.tsq) AS rango
+                FROM mensajes m, consulta
+                WHERE m.cliente_id = %s
+                  AND m.mensaje_tsv @@ consulta.tsq
+                  {" ".join(filtros)}
+                ORDER BY rango DESC, m.fecha DESC, m.id DESC
+                LIMIT %s OFFSET %s
+            )
+            SELECT
+                p.id,
+                p.remitente,
+                COALESCE(l.nombre, p.remitente) AS nombre,
+                p.tipo,
+                p.fecha,
+                p.rango,
+                ts_headline(
+                    'es_unaccent',
+                    p.mensaje,
+                    consulta.tsq,
+                    %s
+                ) AS fragmento
+            FROM pagina p
+            CROSS JOIN consulta
+            LEFT JOIN leads l
+                ON l.cliente_id = %s AND l.telefono = p.remitente
+            ORDER BY p.rango DESC, p.fecha DESC, p.id DESC
+        """, [
+            q,
+            cliente_id,
+            *parametros_filtro,
+            limite + 1,
+            offset,
+            f"StartSel={BUSQUEDA_INICIO_MARCA}, StopSel={BUSQUEDA_FIN_MARCA}, "
+            "MaxWords=25, MinWords=8, MaxFragments=2",
+            cliente_id,
+        ])
+        filas = [dict(fila) for fila in cursor.fetchall()]
+    except Exception as e:
+        app.logger.error(f"Error en /api/buscar: tipo_error={type(e).__name__}")
+        return jsonify({"error": "No se pudo buscar"}), 500
+    finally:
+        liberar_db(conn)
+
+    hay_mas = len(filas) > limite
+    resultados = []
+    for fila in filas[:limite]:
+        resultados.append({
+            "id": fila["id"],
+            "remitente": fila["remitente"],
+            "nombre": fila["nombre"],
+            "tipo": fila["tipo"],
+            "fecha": fila["fecha"].isoformat() if fila["fecha"] else None,
+            "rango": round(float(fila["rango"]), 4),
+            "fragmento_html": _fragmento_busqueda_html(fila["fragmento"]),
+        })
+    return jsonify({
+        "resultados": resultados,
+        "offset_siguiente": offset + limite if hay_mas else None,
+    })
+
+
+@app.cli.command("mensajes-busqueda-backfill")
+@click.option("--lote", type=int, default=5000, show_default=True, help="Filas por transacción.")
+def mensajes_busqueda_backfill_command(lote):
+    """Llena mensaje_tsv de los mensajes previos a la migración 010, por rangos de id."""
+    conn = conectar_db()
+    if not conn:
+        raise RuntimeError("No se pudo conectar a la base de datos")
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT COALESCE(MAX(id), 0) FROM mensajes")
+        id_maximo = cursor.fetchone()[0]
+        conn.rollback()
+        actualizados = 0
+        # Rangos de id en lugar de "WHERE mensaje_tsv IS NULL LIMIT n", que
+        # volvería a recorrer la tabla en cada lote.
+        for desde in range(0, id_maximo, lote):
+            try:
+                cursor.execute("""
+                    UPDATE mensajes
+                    SET mensaje_tsv = to_tsvector('es_unaccent', COALESCE(mensaje, ''))
+                    WHERE id > %s AND id <= %s
+                      AND mensaje_tsv IS NULL
+                """, (desde, desde + lote))
+                actualizados += cursor.rowcount
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+    finally:
+        liberar_db(conn)
+    print(json.dumps({"actualizados": actualizados}, ensure_ascii=False))
+
+
     
 #'''''''''''''''''''''''''''''''''''''''''''''''
 #------------SECION DE CALENDARIO---------------
@@ -3726,13 +7319,13 @@ def agregar_fecha_manual():
             json.dumps(metadatos_json),
             cliente_id
         ))
-        conn.commit()
-
-        socketio.emit(
+        encolar_evento_realtime(
+            cursor,
+            cliente_id,
             "calendario_actualizado",
-            {"accion": "nueva_fecha", "anio": fecha_local.year, "fecha": fecha_str, "titulo": titulo},
-            room=f"cliente_{cliente_id}"
+            {"accion": "nueva_fecha", "anio": fecha_local.year, "fecha": fecha_str, "titulo": titulo}
         )
+        conn.commit()
 
         return jsonify({
             "ok": True,
@@ -3959,14 +7552,15 @@ def editar_calendario(cal_id):
             cal_id,
             cliente_id
         ))
-        conn.commit()
-        
         if cursor.rowcount == 0:
+            conn.rollback()
             return jsonify({"error": "No se encontró esa fecha"}), 404
         
-        # ✅ EMITIR EVENTO SOCKET PARA ACTUALIZACIÓN EN TIEMPO REAL
+        # ✅ EVENTO SOCKET EN LA MISMA TRANSACCIÓN
         if fecha_evento:
-            socketio.emit(
+            encolar_evento_realtime(
+                cursor,
+                cliente_id,
                 "calendario_actualizado",
                 {
                     "accion": "editar_fecha",
@@ -3974,9 +7568,9 @@ def editar_calendario(cal_id):
                     "fecha": fecha_evento.strftime("%Y-%m-%d") if fecha_evento else None,
                     "titulo": titulo,
                     "cal_id": cal_id
-                },
-                room=f"cliente_{cliente_id}"
+                }
             )
+        conn.commit()
         
         return jsonify({"ok": True, "mensaje": "Fecha actualizada"}), 200
     except Exception as e:
@@ -4005,23 +7599,24 @@ def eliminar_calendario(cal_id):
         fecha_evento = row_fecha[0] if row_fecha else None
         
         cursor.execute("DELETE FROM calendario WHERE id = %s AND cliente_id = %s", (cal_id, cliente_id))
-        conn.commit()
-        
         if cursor.rowcount == 0:
+            conn.rollback()
             return jsonify({"error": "No se encontró ese ID"}), 404
         
-        # ✅ EMITIR EVENTO SOCKET PARA ACTUALIZACIÓN EN TIEMPO REAL
+        # ✅ EVENTO SOCKET EN LA MISMA TRANSACCIÓN
         if fecha_evento:
-            socketio.emit(
+            encolar_evento_realtime(
+                cursor,
+                cliente_id,
                 "calendario_actualizado",
                 {
                     "accion": "eliminar_fecha",
                     "anio": fecha_evento.year if fecha_evento else datetime.now().year,
                     "fecha": fecha_evento.strftime("%Y-%m-%d") if fecha_evento else None,
                     "cal_id": cal_id
-                },
-                room=f"cliente_{cliente_id}"
+                }
             )
+        conn.commit()
         
         return jsonify({"ok": True, "mensaje": "Fecha eliminada"}), 200
     except Exception as e:
@@ -4859,26 +8454,74 @@ def admin_crear_tenant():
 #--------------CONFIGURACION PARA HACER DE LA APP UN MULTITENANT-----------------
 #,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,,  
 
-# 📌 Endpoint para gestión de usuarios y roles en el CRM
-# Decorador genérico que verifica permisos antes de ejecutar un endpoin
-def requires_permission(action):
-    def decorator(f):
-        @wraps(f)
-        def wrapped(*args, **kwargs):
-            if not g.current_user:
-                abort(403)
-            # Por ahora, asumimos que si hay usuario, tiene permiso
-            # Puedes implementar permisos reales más tarde
-            return f(*args, **kwargs)
-        return wrapped
-    return decorator
-
 # Proteccion de Rutas
 @app.route("/pipeline/mover", methods=["POST"])
 @requires_permission("move_pipeline")
 def mover_pipeline():
-    # lógica para mover lead
-    ...
+    """
+    Mueve varios leads a un estado en una sola operación.
+
+    Body: {"ids": [..], "estado": "X"}. El estado se valida una vez, el
+    cambio es un solo UPDATE ... WHERE id = ANY(...) y sale un solo evento
+    leads_estado_actualizado con el estado anterior de cada lead movido.
+    """
+    cliente_id = g.current_user["cliente_id"]
+    datos = request.get_json(silent=True) or {}
+    nuevo_estado = str(datos.get("estado") or "").strip()
+    try:
+        ids = sorted({int(i) for i in (datos.get("ids") or [])})
+    except (TypeError, ValueError):
+        return jsonify({"error": "ids inválidos"}), 400
+    if not ids or not nuevo_estado:
+        return jsonify({"error": "Faltan ids o estado"}), 400
+    if len(ids) > _obtener_entero_positivo_env("PIPELINE_MOVER_MAX_IDS", 500):
+        return jsonify({"error": "Demasiados leads en una sola operación"}), 400
+
+    conn = conectar_db()
+    if not conn:
+        return jsonify({"error": "No se pudo conectar a la base de datos"}), 500
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT 1 FROM lead_estados_tenant
+            WHERE cliente_id = %s AND nombre = %s AND activo = true
+        """, (cliente_id, nuevo_estado))
+        if not cursor.fetchone():
+            return jsonify({"error": "Estado no válido para este tenant"}), 400
+
+        # La subconsulta bloquea las filas y conserva el estado previo, que
+        # el RETURNING del UPDATE ya no vería.
+        cursor.execute("""
+            UPDATE leads l
+            SET estado = %s
+            FROM (
+                SELECT id, estado
+                FROM leads
+                WHERE cliente_id = %s AND id = ANY(%s)
+                ORDER BY id
+                FOR UPDATE
+            ) previo
+            WHERE l.id = previo.id
+              AND l.estado IS DISTINCT FROM %s
+            RETURNING l.id, l.telefono, previo.estado
+        """, (nuevo_estado, cliente_id, ids, nuevo_estado))
+        movidos = [
+            {"id": lead_id, "telefono": telefono, "estado_anterior": estado_anterior}
+            for lead_id, telefono, estado_anterior in cursor.fetchall()
+        ]
+        if movidos:
+            encolar_evento_realtime(cursor, cliente_id, "leads_estado_actualizado", {
+                "estado_nuevo": nuevo_estado,
+                "leads": movidos,
+            })
+        conn.commit()
+        return jsonify({"movidos": len(movidos), "sin_cambio": len(ids) - len(movidos)}), 200
+    except Exception as e:
+        conn.rollback()
+        app.logger.error(f"Error en /pipeline/mover: cliente_id={cliente_id} tipo_error={type(e).__name__}")
+        return jsonify({"error": "No se pudieron mover los leads"}), 500
+    finally:
+        liberar_db(conn)
 
  # RUTA PARA SUBIR LOGO 
 @app.route("/config/logo", methods=["POST"])
@@ -5314,6 +8957,246 @@ def test_whatsapp_connection():
         return jsonify({"error": f"❌ Error interno: {str(e)[:100]}"}), 500      
         
 
+# ============================================================================
+# ESTADOS DE ENTREGA DE META (sent / delivered / read / failed)
+# ============================================================================
+# Meta manda varios callbacks por mensaje saliente y suelen llegar varios en un
+# mismo POST. Se acumulan por entrega del webhook, se colapsan por wamid y se
+# aplican con un solo UPDATE ... FROM (VALUES ...) por lote.
+ESTADOS_META_A_CRM = {
+    "sent": "Enviado",
+    "delivered": "Entregado",
+    "read": "Leído",
+    "failed": "Fallido",
+}
+
+# Orden de avance: un callback atrasado nunca regresa el estado del mensaje.
+RANGO_ESTADO_MENSAJE = {
+    "Enviado": 1,
+    "Entregado": 2,
+    "Leído": 3,
+    "Fallido": 3,
+}
+
+
+def _extraer_meta_message_id(respuesta_gateway):
+    """Obtiene el wamid que devuelve el gateway Node, si lo reporta."""
+    try:
+        datos = respuesta_gateway.json()
+    except ValueError:
+        return None
+    if not isinstance(datos, dict):
+        return None
+
+    candidato = datos.get("meta_message_id") or datos.get("message_id")
+    if not candidato:
+        mensajes_meta = datos.get("messages")
+        if isinstance(mensajes_meta, list) and mensajes_meta:
+            primero = mensajes_meta[0]
+            if isinstance(primero, dict):
+                candidato = primero.get("id")
+
+    if not isinstance(candidato, str) or not candidato.strip():
+        return None
+    return candidato.strip()[:255]
+
+
+def extraer_estados_meta(value, buffer_estados):
+    """
+    Agrega al buffer los statuses[] de un change del webhook.
+
+    El buffer se indexa por (phone_number_id, wamid) y conserva sólo el
+    estado más avanzado, así un sent+delivered+read del mismo POST se
+    traduce en una sola fila del UPDATE.
+    """
+    estados = value.get("statuses") or []
+    if not isinstance(estados, list):
+        return 0
+
+    phone_number_id = str(
+        (value.get("metadata") or {}).get("phone_number_id") or ""
+    ).strip()
+    if not phone_number_id:
+        return 0
+
+    agregados = 0
+    for estado_meta in estados:
+        if not isinstance(estado_meta, dict):
+            continue
+        wamid = str(estado_meta.get("id") or "").strip()
+        estado_crm = ESTADOS_META_A_CRM.get(estado_meta.get("status"))
+        if not wamid or not estado_crm:
+            continue
+
+        _fusionar_estado_meta(buffer_estados, (phone_number_id, wamid), estado_crm)
+        agregados += 1
+
+    return agregados
+
+
+def _fusionar_estado_meta(buffer_estados, clave, estado_crm):
+    actual = buffer_estados.get(clave)
+    if (
+        actual is None
+        or RANGO_ESTADO_MENSAJE[estado_crm] > RANGO_ESTADO_MENSAJE[actual]
+    ):
+        buffer_estados[clave] = estado_crm
+
+
+# Meta suele mandar un status por POST: el buffer de cada webhook se suma a
+# uno por proceso, que se aplica cada WHATSAPP_STATUS_FLUSH_INTERVAL_SECONDS
+# o al llegar a WHATSAPP_STATUS_BUFFER_MAX estados, en un solo UPDATE.
+_estados_meta_pendientes = {}
+_estados_meta_lock = threading.Lock()
+_vaciado_estados_meta_iniciado = False
+
+
+def encolar_estados_meta(buffer_estados):
+    """Suma los estados de un webhook al buffer del proceso."""
+    if not buffer_estados:
+        return
+    _asegurar_vaciado_estados_meta()
+    with _estados_meta_lock:
+        for clave, estado_crm in buffer_estados.items():
+            _fusionar_estado_meta(_estados_meta_pendientes, clave, estado_crm)
+        lleno = len(_estados_meta_pendientes) >= _obtener_entero_positivo_env(
+            "WHATSAPP_STATUS_BUFFER_MAX",
+            200
+        )
+    if lleno:
+        vaciar_estados_meta()
+
+
+def vaciar_estados_meta():
+    """Aplica y vacía el buffer del proceso. Regresa los mensajes actualizados."""
+    global _estados_meta_pendientes
+    with _estados_meta_lock:
+        lote, _estados_meta_pendientes = _estados_meta_pendientes, {}
+    return aplicar_estados_meta(lote)
+
+
+def _vaciar_estados_meta_periodicamente():
+    intervalo = _obtener_entero_positivo_env(
+        "WHATSAPP_STATUS_FLUSH_INTERVAL_SECONDS",
+        2
+    )
+    while True:
+        time.sleep(intervalo)
+        try:
+            vaciar_estados_meta()
+        except Exception as e:
+            app.logger.error(
+                "Error al vaciar estados de Meta: "
+                f"tipo_error={type(e).__name__}"
+            )
+
+
+def _asegurar_vaciado_estados_meta():
+    """Arranca (una vez por proceso) el hilo que vacía el buffer de estados."""
+    global _vaciado_estados_meta_iniciado
+    if _vaciado_estados_meta_iniciado:
+        return
+    with _estados_meta_lock:
+        if _vaciado_estados_meta_iniciado:
+            return
+        threading.Thread(
+            target=_vaciar_estados_meta_periodicamente,
+            name="estados-meta",
+            daemon=True,
+        ).start()
+        _vaciado_estados_meta_iniciado = True
+
+
+def aplicar_estados_meta(buffer_estados):
+    """
+    Aplica en lote los estados acumulados y publica un evento coalescido por
+    tenant. Regresa el número de mensajes actualizados.
+    """
+    if not buffer_estados:
+        return 0
+
+    conn = conectar_db()
+    if not conn:
+        app.logger.error(
+            "No se pudieron aplicar estados de Meta: "
+            f"estados={len(buffer_estados)}, motivo=db_no_disponible"
+        )
+        return 0
+
+    try:
+        cursor = conn.cursor()
+        phone_ids = sorted({phone_id for phone_id, _ in buffer_estados})
+        cursor.execute("""
+            SELECT whatsapp_phone_number_id, cliente_id
+            FROM tenant_integraciones
+            WHERE whatsapp_phone_number_id = ANY(%s)
+        """, (phone_ids,))
+        tenants = {
+            str(phone_id).strip(): cliente_id
+            for phone_id, cliente_id in cursor.fetchall()
+        }
+
+        filas = [
+            (
+                tenants[phone_id],
+                wamid,
+                estado,
+                RANGO_ESTADO_MENSAJE[estado],
+            )
+            for (phone_id, wamid), estado in buffer_estados.items()
+            if phone_id in tenants
+        ]
+        if not filas:
+            conn.rollback()
+            return 0
+
+        actualizados = execute_values(cursor, """
+            UPDATE mensajes AS m
+            SET estado = v.estado
+            FROM (VALUES %s) AS v(cliente_id, meta_message_id, estado, rango)
+            WHERE m.cliente_id = v.cliente_id
+              AND m.meta_message_id = v.meta_message_id
+              AND m.tipo LIKE 'enviado%%'
+              AND v.rango > CASE m.estado
+                    WHEN 'Enviado' THEN 1
+                    WHEN 'Entregado' THEN 2
+                    WHEN 'Leído' THEN 3
+                    WHEN 'Fallido' THEN 3
+                    ELSE 0
+                  END
+            RETURNING m.cliente_id, m.id, m.remitente, m.estado
+        """, filas, template="(%s::integer, %s, %s, %s::integer)", fetch=True)
+
+        cambios_por_chat = {}
+        for cliente_id, mensaje_id, remitente, estado in actualizados:
+            cambios_por_chat.setdefault((cliente_id, remitente), []).append({
+                "id": mensaje_id,
+                "remitente": remitente,
+                "estado": estado,
+            })
+        # Los estados sólo importan a quien tiene abierta la conversación.
+        for (cliente_id, remitente), cambios in cambios_por_chat.items():
+            encolar_evento_realtime(
+                cursor,
+                cliente_id,
+                "mensajes_estado_actualizado",
+                {"cliente_id": cliente_id, "mensajes": cambios},
+                room=_room_chat_realtime(cliente_id, remitente),
+            )
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        app.logger.error(
+            "Error aplicando estados de Meta: "
+            f"estados={len(buffer_estados)}, tipo_error={type(e).__name__}"
+        )
+        return 0
+    finally:
+        liberar_db(conn)
+
+    return len(actualizados)
+
+
 # ============================================================================
 # WEBHOOK META: WHATSAPP / FACEBOOK / INSTAGRAM (MULTI-TENANT)
 # ============================================================================
@@ -5348,12 +9231,16 @@ def webhook_meta():
         if "object" not in payload or payload.get("object") not in ["whatsapp", "page"]:
             return jsonify({"ok": True}), 200
 
+        buffer_estados = {}
         for entry in payload.get("entry", []):
             for change in entry.get("changes", []):
                 value = change.get("value", {})
+
+                # Los status updates (sent, delivered, read) se acumulan y se
+                # suman al buffer del proceso, que los aplica en lote.
+                extraer_estados_meta(value, buffer_estados)
+
                 messages = value.get("messages", [])
-                
-                # Si no hay mensajes, puede ser status update (sent, delivered, read)
                 if not messages:
                     continue
 
@@ -5488,22 +9375,21 @@ def webhook_meta():
                     (cliente_id, external_user_id, platform, direccion, mensaje_texto, procesado_por, creado_en)
                     VALUES (%s, %s, 'whatsapp', 'outgoing', %s, %s, CURRENT_TIMESTAMP)
                 """, (tbc_cliente_id, external_user_id, respuesta_bot, procesado_por))
-                conn.commit()
 
-                # 🔗 6. SOCKET: ACTUALIZAR CHAT EN TIEMPO REAL
-                try:
-                    socketio.emit("nuevo_mensaje_chat", {
-                        "cliente_id": tbc_cliente_id,
-                        "external_user_id": external_user_id,
-                        "texto": respuesta_bot,
-                        "direccion": "outgoing",
-                        "timestamp": datetime.now().isoformat()
-                    }, room=f"cliente_{tbc_cliente_id}")
-                except Exception as e:
-                    app.logger.warning(f"⚠️ Socket emit falló: {e}")
+                # 🔗 6. SOCKET: ACTUALIZAR CHAT EN TIEMPO REAL (misma transacción)
+                encolar_evento_realtime(cur, tbc_cliente_id, "nuevo_mensaje_chat", {
+                    "cliente_id": tbc_cliente_id,
+                    "external_user_id": external_user_id,
+                    "texto": respuesta_bot,
+                    "direccion": "outgoing",
+                    "timestamp": datetime.now().isoformat()
+                })
+                conn.commit()
 
                 liberar_db(conn)
 
+        encolar_estados_meta(buffer_estados)
+
         return jsonify({"ok": True}), 200
 
     except Exception as e:
@@ -5626,22 +9512,16 @@ def api_bot_config():
                 data.get("handoff_email")
             ))
             
+            # 🔗 SOCKET: Config general actualizada (se publica al confirmar)
+            encolar_evento_realtime(cur, cliente_id, "configuracion_actualizada", {
+                "tipo": "chatbot",
+                "subtipo": "config",
+                "cliente_id": cliente_id,
+                "timestamp": datetime.now().isoformat(),
+                "mensaje": "Configuración general actualizada"
+            })
             conn.commit()
             
-            # 🔗 EMITIR SOCKET: Config general actualizada (tiempo real)
-            try:
-                socketio.emit("configuracion_actualizada", {
-                    "tipo": "chatbot",
-                    "subtipo": "config",
-                    "cliente_id": cliente_id,
-                    "timestamp": datetime.now().isoformat(),
-                    "mensaje": "Configuración general actualizada"
-                }, room=f"cliente_{cliente_id}")
-                app.logger.info(f"🔗 Socket emitido: chatbot config actualizada para cliente {cliente_id}")
-            except Exception as e:
-                app.logger.warning(f"⚠️ No se pudo emitir socket para chatbot config: {e}")
-                # No fallar la petición si el socket falla
-            
             return jsonify({
                 "ok": True, 
                 "mensaje": "✅ Configuración del bot actualizada correctamente",
@@ -5740,22 +9620,17 @@ def api_bot_keywords():
                 data.get("case_sensitive", False)
             ))
             
+            # 🔗 SOCKET: Keywords actualizadas (se publica al confirmar)
+            encolar_evento_realtime(cur, cliente_id, "configuracion_actualizada", {
+                "tipo": "chatbot",
+                "subtipo": "keywords",
+                "cliente_id": cliente_id,
+                "timestamp": datetime.now().isoformat(),
+                "keyword": keyword,
+                "accion": "creada_o_actualizada"
+            })
             conn.commit()
             
-            # 🔗 EMITIR SOCKET: Keywords actualizadas (tiempo real)
-            try:
-                socketio.emit("configuracion_actualizada", {
-                    "tipo": "chatbot",
-                    "subtipo": "keywords",
-                    "cliente_id": cliente_id,
-                    "timestamp": datetime.now().isoformat(),
-                    "keyword": keyword,
-                    "accion": "creada_o_actualizada"
-                }, room=f"cliente_{cliente_id}")
-                app.logger.info(f"🔗 Socket emitido: keyword '{keyword}' actualizada para cliente {cliente_id}")
-            except Exception as e:
-                app.logger.warning(f"⚠️ No se pudo emitir socket para keywords: {e}")
-            
             return jsonify({
                 "ok": True, 
                 "mensaje": f"✅ Keyword '{keyword}' guardada correctamente",
@@ -5785,27 +9660,23 @@ def api_bot_keywords():
                 DELETE FROM bot_keywords 
                 WHERE id = %s AND cliente_id = %s
             """, (keyword_id, cliente_id))
+            eliminadas = cur.rowcount
             
+            # 🔗 SOCKET: Keywords actualizadas (se publica al confirmar)
+            encolar_evento_realtime(cur, cliente_id, "configuracion_actualizada", {
+                "tipo": "chatbot",
+                "subtipo": "keywords",
+                "cliente_id": cliente_id,
+                "timestamp": datetime.now().isoformat(),
+                "keyword": keyword_eliminada,
+                "accion": "eliminada"
+            })
             conn.commit()
             
-            # 🔗 EMITIR SOCKET: Keywords actualizadas (tiempo real)
-            try:
-                socketio.emit("configuracion_actualizada", {
-                    "tipo": "chatbot",
-                    "subtipo": "keywords",
-                    "cliente_id": cliente_id,
-                    "timestamp": datetime.now().isoformat(),
-                    "keyword": keyword_eliminada,
-                    "accion": "eliminada"
-                }, room=f"cliente_{cliente_id}")
-                app.logger.info(f"🔗 Socket emitido: keyword '{keyword_eliminada}' eliminada para cliente {cliente_id}")
-            except Exception as e:
-                app.logger.warning(f"⚠️ No se pudo emitir socket para keywords: {e}")
-            
             return jsonify({
                 "ok": True, 
                 "mensaje": f"✅ Keyword '{keyword_eliminada}' eliminada correctamente",
-                "eliminadas": cur.rowcount
+                "eliminadas": eliminadas
             }), 200
             
     except Exception as e:
@@ -5914,18 +9785,14 @@ def api_bot_flows():
                 data.get("orden", 0)
             ))
             
+            # 🔗 Socket (se publica al confirmar)
+            encolar_evento_realtime(cur, cliente_id, "configuracion_actualizada", {
+                "tipo": "chatbot", "subtipo": "flows",
+                "cliente_id": cliente_id, "timestamp": datetime.now().isoformat(),
+                "flow_nombre": nombre, "accion": "creado_o_actualizado"
+            })
             conn.commit()
             
-            # 🔗 Socket emit (igual que antes)
-            try:
-                socketio.emit("configuracion_actualizada", {
-                    "tipo": "chatbot", "subtipo": "flows",
-                    "cliente_id": cliente_id, "timestamp": datetime.now().isoformat(),
-                    "flow_nombre": nombre, "accion": "creado_o_actualizado"
-                }, room=f"cliente_{cliente_id}")
-            except Exception as e:
-                app.logger.warning(f"⚠️ Socket emit falló: {e}")
-            
             return jsonify({
                 "ok": True, 
                 "mensaje": f"✅ Flujo '{nombre}' guardado correctamente",
@@ -5945,19 +9812,17 @@ def api_bot_flows():
             
             flow_nombre = row[0]
             cur.execute("DELETE FROM bot_flows WHERE id = %s AND cliente_id = %s", (flow_id, cliente_id))
-            conn.commit()
+            eliminados = cur.rowcount
             
-            # 🔗 Socket emit para delete
-            try:
-                socketio.emit("configuracion_actualizada", {
-                    "tipo": "chatbot", "subtipo": "flows",
-                    "cliente_id": cliente_id, "timestamp": datetime.now().isoformat(),
-                    "flow_nombre": flow_nombre, "accion": "eliminado"
-                }, room=f"cliente_{cliente_id}")
-            except Exception as e:
-                app.logger.warning(f"⚠️ Socket emit falló: {e}")
+            # 🔗 Socket para delete (se publica al confirmar)
+            encolar_evento_realtime(cur, cliente_id, "configuracion_actualizada", {
+                "tipo": "chatbot", "subtipo": "flows",
+                "cliente_id": cliente_id, "timestamp": datetime.now().isoformat(),
+                "flow_nombre": flow_nombre, "accion": "eliminado"
+            })
+            conn.commit()
             
-            return jsonify({"ok": True, "mensaje": f"✅ Flujo eliminado", "eliminados": cur.rowcount}), 200
+            return jsonify({"ok": True, "mensaje": f"✅ Flujo eliminado", "eliminados": eliminados}), 200
             
             
                     # ==================== PUT: Actualizar flujo existente ====================
@@ -6015,18 +9880,14 @@ def api_bot_flows():
                 flow_id, cliente_id
             ))
             
+            # 🔗 Socket (se publica al confirmar)
+            encolar_evento_realtime(cur, cliente_id, "configuracion_actualizada", {
+                "tipo": "chatbot", "subtipo": "flows",
+                "cliente_id": cliente_id, "timestamp": datetime.now().isoformat(),
+                "flow_nombre": data.get("nombre"), "accion": "actualizado"
+            })
             conn.commit()
             
-            # 🔗 Socket emit
-            try:
-                socketio.emit("configuracion_actualizada", {
-                    "tipo": "chatbot", "subtipo": "flows",
-                    "cliente_id": cliente_id, "timestamp": datetime.now().isoformat(),
-                    "flow_nombre": data.get("nombre"), "accion": "actualizado"
-                }, room=f"cliente_{cliente_id}")
-            except Exception as e:
-                app.logger.warning(f"⚠️ Socket emit falló: {e}")
-            
             return jsonify({
                 "ok": True, 
                 "mensaje": "✅ Flujo actualizado correctamente",
@@ -6159,21 +10020,16 @@ def guardar_campos_evento():
                 VALUES (%s, %s, %s, %s, %s, %s, %s, true)
             """, (cliente_id, nombre, clave, tipo, opciones, obligatorio, i))
     
+    # ✅ EVENTO SOCKET PARA ACTUALIZACIÓN EN TIEMPO REAL (se publica al confirmar)
+    encolar_evento_realtime(cur, cliente_id, "configuracion_actualizada", {
+        "tipo": "campos_evento",
+        "cliente_id": cliente_id,
+        "timestamp": datetime.now().isoformat(),
+        "cantidad_campos": len(campos)
+    })
     conn.commit()
     liberar_db(conn)
     
-    # ✅ EMITIR EVENTO SOCKET PARA ACTUALIZACIÓN EN TIEMPO REAL
-    socketio.emit(
-        "configuracion_actualizada",
-        {
-            "tipo": "campos_evento",
-            "cliente_id": cliente_id,
-            "timestamp": datetime.now().isoformat(),
-            "cantidad_campos": len(campos)
-        },
-        room=f"cliente_{cliente_id}"
-    )
-    
     return jsonify({"ok": True})
 
 
@@ -6220,20 +10076,15 @@ def guardar_servicios_tenant():
             INSERT INTO servicios_tenant (cliente_id, nombre, clave, tipo)
             VALUES (%s, %s, %s, %s)
             """, (cliente_id, nombre, clave, tipo))
+    # ✅ EVENTO SOCKET PARA ACTUALIZACIÓN EN TIEMPO REAL (se publica al confirmar)
+    encolar_evento_realtime(cur, cliente_id, "configuracion_actualizada", {
+        "tipo": "servicios",
+        "cliente_id": cliente_id,
+        "timestamp": datetime.now().isoformat()
+    })
     conn.commit()
     liberar_db(conn)
     
-    # ✅ EMITIR EVENTO SOCKET PARA ACTUALIZACIÓN EN TIEMPO REAL
-    socketio.emit(
-        "configuracion_actualizada",
-        {
-            "tipo": "servicios",
-            "cliente_id": cliente_id,
-            "timestamp": datetime.now().isoformat()
-        },
-        room=f"cliente_{cliente_id}"
-    )
-    
     return jsonify({"ok": True})
 
 
@@ -7098,7 +10949,7 @@ def actualizar_roles(user_id):
 def dashboard():
     if 'user_id' not in session:
         return redirect('/login')
-    return render_template("index.html")
+    return render_template("index.html", socketio_transports=SOCKETIO_TRANSPORTS)
 
 # 📌 Iniciar la app con WebSockets
 if __name__ == "__main__":
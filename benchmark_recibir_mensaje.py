@@ -0,0 +1,128 @@
+"""
+Benchmark local del web tier en modo multi-worker contra /recibir_mensaje.
+
+Modo multi-worker:
+  - WEB_WORKERS=N en el Procfile (gunicorn -k eventlet -w N).
+  - SOCKETIO_TRANSPORTS=websocket si el balanceador no tiene sesiones
+    pegajosas; con "polling" cada sid debe caer siempre en el mismo worker.
+  - DB_POOL_MAXCONN por worker: el total de conexiones es N * DB_POOL_MAXCONN
+    (más worker_media y worker_realtime); debe caber en max_connections.
+  - El balanceador usa GET /readyz como health check.
+  - Los emits salen del outbox vía worker_realtime.py y el message queue de
+    Redis, y las cachés en memoria se invalidan por Redis pub/sub, así que
+    ningún request depende del worker que lo atiende.
+
+Uso (contra una base y un Redis locales, nunca producción):
+
+  BOT_INTERNAL_SECRET=... python benchmark_recibir_mensaje.py \\
+      --phone-id <whatsapp_phone_id de un tenant de prueba> --workers 1,2,4
+
+Por cada número de workers levanta gunicorn en --port, espera /readyz,
+genera carga con --clientes procesos durante --segundos y reporta req/s y
+el factor respecto a 1 worker. Cada request inserta un mensaje de prueba;
+por omisión tipo "enviado" para no disparar respuestas automáticas.
+"""
+import argparse
+import multiprocessing
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import requests
+
+
+def _esperar_listo(url_base, timeout):
+    limite = time.monotonic() + timeout
+    while time.monotonic() < limite:
+        try:
+            if requests.get(f"{url_base}/readyz", timeout=2).status_code == 200:
+                return True
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    return False
+
+
+def _cliente_carga(args):
+    url_base, secreto, phone_id, tipo, segundos, indice = args
+    sesion = requests.Session()
+    exitosos = fallidos = 0
+    latencias = []
+    fin = time.monotonic() + segundos
+    while time.monotonic() < fin:
+        inicio = time.monotonic()
+        try:
+            respuesta = sesion.post(
+                f"{url_base}/recibir_mensaje",
+                json={
+                    "plataforma": "whatsapp",
+                    "remitente": f"bench{indice:04d}",
+                    "mensaje": f"benchmark {exitosos + fallidos}",
+                    "tipo": tipo,
+                    "whatsapp_phone_id": phone_id,
+                },
+                headers={"X-Bot-Secret": secreto},
+                timeout=30,
+            )
+            if respuesta.status_code < 300:
+                exitosos += 1
+                latencias.append(time.monotonic() - inicio)
+            else:
+                fallidos += 1
+        except requests.RequestException:
+            fallidos += 1
+    return exitosos, fallidos, latencias
+
+
+def _medir(url_base, opciones, secreto):
+    argumentos = [
+        (url_base, secreto, opciones.phone_id, opciones.tipo, opciones.segundos, i)
+        for i in range(opciones.clientes)
+    ]
+    with multiprocessing.Pool(opciones.clientes) as pool_clientes:
+        resultados = pool_clientes.map(_cliente_carga, argumentos)
+    exitosos = sum(r[0] for r in resultados)
+    fallidos = sum(r[1] for r in resultados)
+    latencias = sorted(l for r in resultados for l in r[2])
+    p95 = latencias[int(len(latencias) * 0.95) - 1] if latencias else 0.0
+    return exitosos / opciones.segundos, fallidos, p95
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--phone-id", required=True)
+    parser.add_argument("--workers", default=f"1,{os.cpu_count() or 1}")
+    parser.add_argument("--clientes", type=int, default=4 * (os.cpu_count() or 1))
+    parser.add_argument("--segundos", type=float, default=20)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--tipo", default="enviado", choices=["enviado", "recibido"])
+    opciones = parser.parse_args()
+
+    secreto = os.getenv("BOT_INTERNAL_SECRET")
+    if not secreto:
+        sys.exit("Falta BOT_INTERNAL_SECRET")
+
+    url_base = f"http://127.0.0.1:{opciones.port}"
+    base = None
+    print(f"{'workers':>8} {'req/s':>10} {'p95 ms':>8} {'fallidos':>9} {'factor':>7}")
+    for workers in [int(w) for w in opciones.workers.split(",") if w.strip()]:
+        servidor = subprocess.Popen([
+            "gunicorn", "-k", "eventlet", "-w", str(workers),
+            "-b", f"127.0.0.1:{opciones.port}", "app:app",
+        ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            if not _esperar_listo(url_base, timeout=60):
+                sys.exit(f"gunicorn con {workers} workers no respondió /readyz")
+            rps, fallidos, p95 = _medir(url_base, opciones, secreto)
+        finally:
+            servidor.send_signal(signal.SIGTERM)
+            servidor.wait(timeout=30)
+        base = base or rps
+        factor = rps / base if base else 0.0
+        print(f"{workers:>8} {rps:>10.1f} {p95 * 1000:>8.1f} {fallidos:>9} {factor:>7.2f}")
+
+
+if __name__ == "__main__":
+    main()
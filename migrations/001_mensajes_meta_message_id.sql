@@ -0,0 +1,13 @@
+-- ============================================================================
+-- 001: ID de mensaje de Meta en mensajes (estados sent/delivered/read)
+-- ============================================================================
+-- Los callbacks de estado de Meta sólo traen el wamid del mensaje saliente,
+-- por lo que se guarda al enviar y se indexa por tenant para aplicar los
+-- estados en lote.
+
+ALTER TABLE mensajes
+    ADD COLUMN IF NOT EXISTS meta_message_id TEXT;
+
+CREATE UNIQUE INDEX IF NOT EXISTS mensajes_cliente_meta_message_id_uq
+    ON mensajes (cliente_id, meta_message_id)
+    WHERE meta_message_id IS NOT NULL;
@@ -0,0 +1,57 @@
+-- ============================================================================
+-- 002: Objetos S3 deduplicados por contenido (cliente_id, sha256)
+-- ============================================================================
+-- Cada whatsapp_media sigue siendo una fila por mensaje, pero apunta a un
+-- objeto compartido. ref_count cuenta las filas de whatsapp_media que lo usan;
+-- el objeto S3 sólo se borra cuando llega a cero.
+
+CREATE TABLE IF NOT EXISTS whatsapp_media_objetos (
+    id BIGSERIAL PRIMARY KEY,
+    cliente_id INTEGER NOT NULL REFERENCES clientes (id) ON DELETE CASCADE,
+    sha256 TEXT NOT NULL,
+    s3_bucket TEXT NOT NULL,
+    s3_key TEXT NOT NULL,
+    mime_type TEXT NOT NULL,
+    size_bytes BIGINT NOT NULL,
+    ref_count INTEGER NOT NULL DEFAULT 0 CHECK (ref_count >= 0),
+    creado_en TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    actualizado_en TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    CONSTRAINT whatsapp_media_objetos_cliente_sha256_uq UNIQUE (cliente_id, sha256)
+);
+
+ALTER TABLE whatsapp_media
+    ADD COLUMN IF NOT EXISTS objeto_id BIGINT
+        REFERENCES whatsapp_media_objetos (id);
+
+CREATE INDEX IF NOT EXISTS whatsapp_media_objeto_id_idx
+    ON whatsapp_media (objeto_id);
+
+-- Backfill: la media existente se registra como objeto con su propia key.
+-- Duplicados históricos con otra key quedan sin objeto_id (objeto propio).
+INSERT INTO whatsapp_media_objetos (
+    cliente_id, sha256, s3_bucket, s3_key, mime_type, size_bytes, ref_count, creado_en
+)
+SELECT DISTINCT ON (cliente_id, sha256)
+    cliente_id, sha256, s3_bucket, s3_key, mime_type, size_bytes, 0, creado_en
+FROM whatsapp_media
+WHERE sha256 IS NOT NULL
+ORDER BY cliente_id, sha256, id
+ON CONFLICT (cliente_id, sha256) DO NOTHING;
+
+UPDATE whatsapp_media AS wm
+SET objeto_id = o.id
+FROM whatsapp_media_objetos AS o
+WHERE wm.objeto_id IS NULL
+  AND wm.cliente_id = o.cliente_id
+  AND wm.s3_bucket = o.s3_bucket
+  AND wm.s3_key = o.s3_key;
+
+UPDATE whatsapp_media_objetos AS o
+SET ref_count = conteo.total
+FROM (
+    SELECT objeto_id, COUNT(*) AS total
+    FROM whatsapp_media
+    WHERE objeto_id IS NOT NULL
+    GROUP BY objeto_id
+) AS conteo
+WHERE o.id = conteo.objeto_id;
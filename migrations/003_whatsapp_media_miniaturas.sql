@@ -0,0 +1,13 @@
+-- ============================================================================
+-- 003: Miniaturas de imágenes y posters de video en whatsapp_media
+-- ============================================================================
+-- La miniatura vive en S3 junto al original (<key>.thumb.webp). Las columnas
+-- quedan NULL mientras no exista; /api/media/<id>?variant=thumb regresa el
+-- original en ese caso.
+
+ALTER TABLE whatsapp_media
+    ADD COLUMN IF NOT EXISTS thumb_s3_key TEXT,
+    ADD COLUMN IF NOT EXISTS thumb_mime_type TEXT,
+    ADD COLUMN IF NOT EXISTS thumb_size_bytes INTEGER,
+    ADD COLUMN IF NOT EXISTS thumb_ancho INTEGER,
+    ADD COLUMN IF NOT EXISTS thumb_alto INTEGER;
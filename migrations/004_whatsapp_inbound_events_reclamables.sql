@@ -0,0 +1,24 @@
+-- ============================================================================
+-- 004: Índices parciales para reclamar trabajos multimedia
+-- ============================================================================
+-- CREATE INDEX CONCURRENTLY no puede correr dentro de una transacción:
+-- ejecutar este archivo con psql sin --single-transaction.
+--
+-- Sólo indexa filas reclamables, así que su tamaño depende de la cola
+-- pendiente y no del historial completado. El orden coincide con el de
+-- reclamar_trabajos_multimedia: por tenant, carril (0 = image/sticker/audio,
+-- 1 = video/document) y next_attempt_at.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS whatsapp_inbound_events_reclamables_idx
+    ON whatsapp_inbound_events (
+        cliente_id,
+        (CASE WHEN message_type IN ('image', 'sticker', 'audio') THEN 0 ELSE 1 END),
+        next_attempt_at,
+        id
+    )
+    WHERE status IN ('pending', 'failed');
+
+-- MIN(next_attempt_at) del worker al calcular cuánto dormir.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS whatsapp_inbound_events_proximo_idx
+    ON whatsapp_inbound_events (next_attempt_at)
+    WHERE status IN ('pending', 'failed');
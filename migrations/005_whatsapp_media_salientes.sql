@@ -0,0 +1,27 @@
+-- ============================================================================
+-- 005: Caché de media saliente subida a Meta (flujos imagen/video)
+-- ============================================================================
+-- Un asset de catálogo se sube una vez por número de WhatsApp y se envía por
+-- su media id hasta que expira. etag/last_modified permiten revalidar la URL
+-- con un GET condicional sin volver a descargarla.
+
+CREATE TABLE IF NOT EXISTS whatsapp_media_salientes (
+    id BIGSERIAL PRIMARY KEY,
+    cliente_id INTEGER NOT NULL REFERENCES clientes (id) ON DELETE CASCADE,
+    whatsapp_phone_number_id TEXT NOT NULL,
+    url TEXT NOT NULL,
+    sha256 TEXT NOT NULL,
+    meta_media_id TEXT NOT NULL,
+    mime_type TEXT NOT NULL,
+    size_bytes BIGINT NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    expira_en TIMESTAMPTZ NOT NULL,
+    verificado_en TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    creado_en TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    CONSTRAINT whatsapp_media_salientes_phone_url_sha256_uq
+        UNIQUE (whatsapp_phone_number_id, url, sha256)
+);
+
+CREATE INDEX IF NOT EXISTS whatsapp_media_salientes_phone_url_idx
+    ON whatsapp_media_salientes (whatsapp_phone_number_id, url, verificado_en DESC);
@@ -0,0 +1,15 @@
+-- ============================================================================
+-- 006: Outbox transaccional de eventos Socket.IO
+-- ============================================================================
+-- Los handlers insertan el evento en la misma transacción que el cambio de
+-- datos; worker_realtime.py lo publica en la cola Redis de Socket.IO y lo
+-- borra. Un evento de una transacción revertida nunca se publica.
+
+CREATE TABLE IF NOT EXISTS realtime_outbox (
+    id BIGSERIAL PRIMARY KEY,
+    cliente_id INTEGER NOT NULL,
+    room TEXT NOT NULL,
+    evento TEXT NOT NULL,
+    payload JSONB NOT NULL,
+    creado_en TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
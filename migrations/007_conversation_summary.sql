@@ -0,0 +1,23 @@
+-- ============================================================================
+-- 007: Resumen por conversación (último mensaje y no leídos)
+-- ============================================================================
+-- Una fila por (cliente_id, remitente), mantenida en la misma transacción
+-- que cada INSERT en mensajes. /leads y /mensajes leen de aquí en lugar de
+-- recorrer todo el historial. Las filas existentes se llenan con
+-- `flask conversaciones-backfill`.
+
+CREATE TABLE IF NOT EXISTS conversation_summary (
+    cliente_id INTEGER NOT NULL,
+    remitente TEXT NOT NULL,
+    ultimo_mensaje_id INTEGER,
+    ultimo_mensaje TEXT,
+    ultimo_tipo TEXT,
+    ultima_fecha TIMESTAMP NOT NULL,
+    ultimo_media_id BIGINT,
+    no_leidos INTEGER NOT NULL DEFAULT 0 CHECK (no_leidos >= 0),
+    actualizado_en TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (cliente_id, remitente)
+);
+
+CREATE INDEX IF NOT EXISTS conversation_summary_cliente_fecha_idx
+    ON conversation_summary (cliente_id, ultima_fecha DESC);
@@ -0,0 +1,12 @@
+-- ============================================================================
+-- 008: Índice para paginar el historial de una conversación
+-- ============================================================================
+-- CREATE INDEX CONCURRENTLY no puede correr dentro de una transacción:
+-- ejecutar este archivo con psql sin --single-transaction.
+--
+-- /mensajes_chat pagina por keyset sobre (fecha, id) dentro de una
+-- conversación; la página más reciente y ?before recorren el índice en este
+-- orden y ?after lo recorre hacia atrás.
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS mensajes_cliente_remitente_fecha_id_idx
+    ON mensajes (cliente_id, remitente, fecha DESC, id DESC);
@@ -0,0 +1,17 @@
+-- ============================================================================
+-- 009: Índices del tablero de leads (/api/leads)
+-- ============================================================================
+-- CREATE INDEX CONCURRENTLY no puede correr dentro de una transacción:
+-- ejecutar este archivo con psql sin --single-transaction.
+
+-- Página de una columna: WHERE estado = X AND id < cursor ORDER BY id DESC.
+-- También sirve al conteo por estado (GROUP BY estado) como index-only scan.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS leads_cliente_estado_id_idx
+    ON leads (cliente_id, estado, id DESC);
+
+-- Filtro por prefijo de nombre (sin distinguir mayúsculas) y de teléfono.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS leads_cliente_nombre_prefijo_idx
+    ON leads (cliente_id, lower(nombre) text_pattern_ops);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS leads_cliente_telefono_prefijo_idx
+    ON leads (cliente_id, telefono text_pattern_ops);
@@ -0,0 +1,47 @@
+-- ============================================================================
+-- 010: Búsqueda de texto completo en mensajes (/api/buscar)
+-- ============================================================================
+-- CREATE INDEX CONCURRENTLY no puede correr dentro de una transacción:
+-- ejecutar este archivo con psql sin --single-transaction.
+--
+-- mensaje_tsv es una columna normal mantenida por trigger y no una columna
+-- GENERATED ... STORED: agregar esta última reescribe toda la tabla con
+-- ACCESS EXCLUSIVE. Así el ALTER es instantáneo y las filas existentes se
+-- llenan por lotes con `flask mensajes-busqueda-backfill`.
+
+CREATE EXTENSION IF NOT EXISTS unaccent;
+CREATE EXTENSION IF NOT EXISTS btree_gin;
+
+-- Español sin acentos: "cumpleaños" encuentra "cumpleanos" y viceversa.
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_ts_config WHERE cfgname = 'es_unaccent') THEN
+        CREATE TEXT SEARCH CONFIGURATION es_unaccent (COPY = spanish);
+        ALTER TEXT SEARCH CONFIGURATION es_unaccent
+            ALTER MAPPING FOR hword, hword_part, word
+            WITH unaccent, spanish_stem;
+    END IF;
+END
+$$;
+
+ALTER TABLE mensajes
+    ADD COLUMN IF NOT EXISTS mensaje_tsv tsvector;
+
+CREATE OR REPLACE FUNCTION mensajes_tsv_actualizar() RETURNS trigger
+LANGUAGE plpgsql AS $$
+BEGIN
+    NEW.mensaje_tsv := to_tsvector('es_unaccent', COALESCE(NEW.mensaje, ''));
+    RETURN NEW;
+END
+$$;
+
+DROP TRIGGER IF EXISTS mensajes_tsv_trg ON mensajes;
+CREATE TRIGGER mensajes_tsv_trg
+    BEFORE INSERT OR UPDATE OF mensaje ON mensajes
+    FOR EACH ROW EXECUTE FUNCTION mensajes_tsv_actualizar();
+
+-- GIN por tenant (btree_gin permite cliente_id en el mismo índice). Con
+-- fastupdate (por omisión) los INSERT van a la lista pendiente y no pagan
+-- la inserción completa en el índice.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS mensajes_busqueda_idx
+    ON mensajes USING gin (cliente_id, mensaje_tsv);
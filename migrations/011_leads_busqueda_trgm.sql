@@ -0,0 +1,25 @@
+-- ============================================================================
+-- 011: Búsqueda de leads por fragmento de nombre o teléfono (/api/leads/buscar)
+-- ============================================================================
+-- CREATE INDEX CONCURRENTLY no puede correr dentro de una transacción:
+-- ejecutar este archivo con psql sin --single-transaction.
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE EXTENSION IF NOT EXISTS unaccent;
+CREATE EXTENSION IF NOT EXISTS btree_gin;
+
+-- unaccent() es STABLE y no puede usarse en un índice; con el diccionario
+-- calificado por esquema el resultado no depende del search_path y la
+-- envoltura puede declararse IMMUTABLE.
+CREATE OR REPLACE FUNCTION crm_normalizar(texto TEXT) RETURNS TEXT
+LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT AS $$
+    SELECT lower(public.unaccent('public.unaccent'::regdictionary, texto))
+$$;
+
+-- Cualquier fragmento del teléfono (formato 521XXXXXXXXXX).
+CREATE INDEX CONCURRENTLY IF NOT EXISTS leads_cliente_telefono_trgm_idx
+    ON leads USING gin (cliente_id, telefono gin_trgm_ops);
+
+-- Cualquier fragmento del nombre, sin acentos ni mayúsculas.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS leads_cliente_nombre_trgm_idx
+    ON leads USING gin (cliente_id, crm_normalizar(nombre) gin_trgm_ops);
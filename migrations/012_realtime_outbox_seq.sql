@@ -0,0 +1,9 @@
+-- ============================================================================
+-- 012: Seq realtime asignado una sola vez por evento del outbox
+-- ============================================================================
+-- El publicador guarda aquí el _seq antes de emitir; si muere entre el emit
+-- y el DELETE, la reentrega reutiliza el mismo seq y los clientes la
+-- descartan como ya vista.
+
+ALTER TABLE realtime_outbox
+    ADD COLUMN IF NOT EXISTS seq BIGINT;
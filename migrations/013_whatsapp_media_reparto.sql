@@ -0,0 +1,24 @@
+-- ============================================================================
+-- 013: Estado del reparto de trabajos multimedia entre carriles y tenants
+-- ============================================================================
+-- reclamar_trabajos_multimedia conserva aquí el estado entre reclamos:
+--   - whatsapp_media_reparto (una fila): contador global de reclamos; uno de
+--     cada WHATSAPP_MEDIA_VIDEO_LANE_WEIGHT prefiere el carril lento. El
+--     UPDATE de esta fila también serializa los reclamos entre réplicas.
+--   - whatsapp_media_turnos: último servicio por tenant y carril; dentro del
+--     carril se atiende al tenant que lleva más tiempo sin servicio.
+
+CREATE TABLE IF NOT EXISTS whatsapp_media_reparto (
+    id SMALLINT PRIMARY KEY DEFAULT 1 CHECK (id = 1),
+    turno BIGINT NOT NULL DEFAULT 0
+);
+
+INSERT INTO whatsapp_media_reparto (id) VALUES (1)
+ON CONFLICT (id) DO NOTHING;
+
+CREATE TABLE IF NOT EXISTS whatsapp_media_turnos (
+    cliente_id INTEGER NOT NULL,
+    carril SMALLINT NOT NULL,
+    ultimo_servicio TIMESTAMPTZ NOT NULL,
+    PRIMARY KEY (cliente_id, carril)
+);
@@ -0,0 +1,16 @@
+-- ============================================================================
+-- 014: Refresco en segundo plano de la media saliente subida a Meta
+-- ============================================================================
+-- El envío de respuestas sólo lee whatsapp_media_salientes. Si el asset no
+-- está en caché o toca revalidarlo, lo anota aquí y worker_media.py (o
+-- `flask media-salientes-refrescar`) lo descarga y lo sube a Meta fuera
+-- del request.
+
+CREATE TABLE IF NOT EXISTS whatsapp_media_salientes_pendientes (
+    whatsapp_phone_number_id TEXT NOT NULL,
+    url TEXT NOT NULL,
+    cliente_id INTEGER NOT NULL REFERENCES clientes (id) ON DELETE CASCADE,
+    tipo TEXT NOT NULL,
+    solicitado_en TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (whatsapp_phone_number_id, url)
+);
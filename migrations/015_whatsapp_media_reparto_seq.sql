@@ -0,0 +1,11 @@
+-- ============================================================================
+-- 015: Turno de carril multimedia con una secuencia
+-- ============================================================================
+-- reclamar_trabajos_multimedia toma el desfase del carril lento con nextval,
+-- que no bloquea ni se revierte, así que las réplicas del worker ya no se
+-- serializan en la fila de whatsapp_media_reparto (013). whatsapp_media_turnos
+-- se conserva: guarda el último servicio por tenant y carril.
+
+CREATE SEQUENCE IF NOT EXISTS whatsapp_media_reparto_seq;
+
+DROP TABLE IF EXISTS whatsapp_media_reparto;
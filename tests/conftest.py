@@ -0,0 +1,13 @@
+import os
+import sys
+
+from cryptography.fernet import Fernet
+
+# app.py exige esta configuración al importarse; sin servidor de Postgres el
+# pool queda en None y cada prueba sustituye conectar_db.
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379/0")
+os.environ.setdefault("SECRET_KEY", "pruebas")
+os.environ.setdefault("CREDENTIALS_ENCRYPTION_KEY", Fernet.generate_key().decode())
+os.environ.setdefault("DATABASE_URL", "postgresql://localhost:1/pruebas")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,88 @@
+import pytest
+
+import app as crm
+
+
+class CursorFalso:
+    def __init__(self, conexion):
+        self.conexion = conexion
+        self.rowcount = 0
+        self._resultado = None
+
+    def execute(self, sql, parametros=None):
+        self.conexion.sentencias.append(" ".join(sql.split()))
+        self.rowcount = 1
+        self._resultado = self.conexion.respuestas.pop(0) if "SELECT fijo" in sql else None
+
+    def fetchone(self):
+        return self._resultado
+
+
+class ConexionFalsa:
+    def __init__(self, respuestas=None):
+        self.sentencias = []
+        self.respuestas = list(respuestas or [])
+        self.confirmada = False
+        self.revertida = False
+
+    def cursor(self, *args, **kwargs):
+        return CursorFalso(self)
+
+    def commit(self):
+        self.confirmada = True
+
+    def rollback(self):
+        self.revertida = True
+
+
+@pytest.fixture
+def cliente(monkeypatch):
+    def preparar(conexion):
+        monkeypatch.setattr(crm, "conectar_db", lambda: conexion)
+        monkeypatch.setattr(crm, "liberar_db", lambda conn: None)
+        monkeypatch.setattr(crm, "obtener_cliente_id_de_subdominio", lambda: 7)
+        return crm.app.test_client()
+    return preparar
+
+
+def _eventos_outbox(conexion):
+    return [s for s in conexion.sentencias if s.startswith("INSERT INTO realtime_outbox")]
+
+
+def test_guardar_estados_lead_confirma_y_encola_evento(cliente):
+    conexion = ConexionFalsa()
+    respuesta = cliente(conexion).post("/leads/estados", json={
+        "estados": [
+            {"nombre": "✅ CONTACTO INICIAL", "fijo": True},
+            {"nombre": "Cotizado", "color": "#43a047"},
+        ],
+        "estados_eliminados": ["Viejo"],
+    })
+
+    assert respuesta.status_code == 200
+    assert respuesta.get_json() == {"ok": True, "leads_movidos": 1}
+    assert conexion.confirmada and not conexion.revertida
+    assert len(_eventos_outbox(conexion)) == 1
+
+
+def test_eliminar_estado_lead_confirma_y_encola_evento(cliente):
+    conexion = ConexionFalsa(respuestas=[(False,)])
+    respuesta = cliente(conexion).post("/leads/estado/eliminar", json={
+        "nombre": "Cotizado",
+        "estado_destino": "✅ CONTACTO INICIAL",
+    })
+
+    assert respuesta.status_code == 200
+    assert respuesta.get_json() == {"ok": True}
+    assert conexion.confirmada and not conexion.revertida
+    assert len(_eventos_outbox(conexion)) == 1
+
+
+def test_eliminar_estado_lead_rechaza_estado_fijo(cliente):
+    conexion = ConexionFalsa(respuestas=[(True,)])
+    respuesta = cliente(conexion).post("/leads/estado/eliminar", json={
+        "nombre": "✅ CONTACTO INICIAL",
+    })
+
+    assert respuesta.status_code == 403
+    assert not _eventos_outbox(conexion)
@@ -1,14 +1,26 @@
 import logging
 import os
+import select
 import signal
 import threading
 import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
 
 from app import (
+    WHATSAPP_MEDIA_CANAL_NOTIFY,
+    LatidoLeasesMultimedia,
     conectar_db,
+    conectar_db_dedicada,
+    db_pool,
+    ffmpeg_disponible,
     liberar_db,
-    procesar_un_trabajo_multimedia,
+    procesar_trabajo_multimedia,
+    reclamar_trabajos_multimedia,
     recuperar_leases_multimedia_vencidos,
+    refrescar_medias_salientes,
+    segundos_hasta_proximo_trabajo_multimedia,
 )
 
 
@@ -29,6 +41,157 @@ def _obtener_segundos_positivos(nombre, valor_default):
     return segundos
 
 
+def _obtener_entero_positivo(nombre, valor_default):
+    valor = os.getenv(nombre)
+    if valor is None or not valor.strip():
+        return int(valor_default)
+    try:
+        entero = int(valor)
+    except (TypeError, ValueError) as exc:
+        raise RuntimeError(f"Configuración inválida: {nombre}") from exc
+    if entero <= 0:
+        raise RuntimeError(f"Configuración inválida: {nombre}")
+    return entero
+
+
+class PresupuestoBytes:
+    """
+    Tope de bytes multimedia en vuelo dentro del proceso.
+
+    Un trabajo más grande que el tope completo se deja pasar cuando no hay
+    nada más en vuelo, para que nunca quede bloqueado para siempre.
+    """
+
+    def __init__(self, maximo_bytes):
+        self._maximo_bytes = maximo_bytes
+        self._en_vuelo = 0
+        self._condicion = threading.Condition()
+
+    def reservar(self, bytes_solicitados):
+        reservados = max(1, min(int(bytes_solicitados), self._maximo_bytes))
+        with self._condicion:
+            while (
+                self._en_vuelo > 0
+                and self._en_vuelo + reservados > self._maximo_bytes
+            ):
+                self._condicion.wait(timeout=1)
+            self._en_vuelo += reservados
+        return reservados
+
+    def liberar(self, reservados):
+        with self._condicion:
+            self._en_vuelo = max(0, self._en_vuelo - reservados)
+            self._condicion.notify_all()
+
+    @property
+    def en_vuelo(self):
+        with self._condicion:
+            return self._en_vuelo
+
+
+class EscuchaTrabajos:
+    """
+    Conexión dedicada con LISTEN sobre el canal multimedia.
+
+    esperar() regresa en cuanto llega un NOTIFY, se solicita la detención o
+    vence el timeout. Si la conexión se pierde, se degrada a polling y se
+    reconecta en la siguiente espera.
+    """
+
+    def __init__(self, canal):
+        self._canal = canal
+        self._conn = None
+        self._pipe_lectura, self._pipe_escritura = os.pipe()
+        os.set_blocking(self._pipe_lectura, False)
+        os.set_blocking(self._pipe_escritura, False)
+
+    def _conectar(self):
+        conn = conectar_db_dedicada()
+        conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        with conn.cursor() as cursor:
+            cursor.execute(f'LISTEN "{self._canal}"')
+        self._conn = conn
+        LOGGER.info("Escuchando notificaciones multimedia: canal=%s", self._canal)
+
+    def despertar(self):
+        try:
+            os.write(self._pipe_escritura, b"\0")
+        except (BlockingIOError, OSError):
+            pass
+
+    def esperar(self, timeout):
+        if self._conn is None:
+            try:
+                self._conectar()
+            except Exception as exc:
+                LOGGER.error(
+                    "No se pudo abrir LISTEN multimedia: tipo_error=%s",
+                    type(exc).__name__,
+                )
+                STOP_REQUESTED.wait(timeout)
+                return False
+
+        try:
+            listos, _, _ = select.select(
+                [self._conn, self._pipe_lectura],
+                [],
+                [],
+                max(0.0, timeout),
+            )
+            if self._pipe_lectura in listos:
+                try:
+                    while os.read(self._pipe_lectura, 1024):
+                        pass
+                except BlockingIOError:
+                    pass
+            if self._conn in listos:
+                self._conn.poll()
+                notificado = bool(self._conn.notifies)
+                self._conn.notifies.clear()
+                return notificado
+            return False
+        except Exception as exc:
+            LOGGER.error(
+                "Conexión LISTEN multimedia perdida: tipo_error=%s",
+                type(exc).__name__,
+            )
+            self.cerrar()
+            return False
+
+    def cerrar(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+
+
+ESCUCHA = EscuchaTrabajos(WHATSAPP_MEDIA_CANAL_NOTIFY)
+
+
+def _segundos_espera_sin_trabajo(poll_seconds, idle_seconds, proxima_recuperacion):
+    """
+    Calcula cuánto dormir con la cola vacía: hasta el próximo reintento
+    programado, la próxima recuperación de leases o el poll de seguridad.
+    """
+    espera = poll_seconds
+    try:
+        proximo = segundos_hasta_proximo_trabajo_multimedia()
+    except Exception as exc:
+        LOGGER.error(
+            "No se pudo calcular el próximo trabajo multimedia: tipo_error=%s",
+            type(exc).__name__,
+        )
+        proximo = idle_seconds
+    if proximo is not None:
+        # Un trabajo vencido que no se pudo reclamar está bloqueado por otra
+        # réplica: se reintenta pronto, sin girar en vacío.
+        espera = min(espera, max(proximo, 0.2))
+    espera = min(espera, max(0.0, proxima_recuperacion - time.monotonic()))
+    return espera
+
+
 def _validar_configuracion_critica():
     variables_requeridas = (
         "AWS_REGION",
@@ -41,6 +204,8 @@ def _validar_configuracion_critica():
         raise RuntimeError(
             "Configuración multimedia incompleta: " + ", ".join(faltantes)
         )
+    # No es crítico: sin ffmpeg los videos se procesan sin poster.
+    ffmpeg_disponible()
 
     conn = conectar_db()
     if not conn:
@@ -57,6 +222,46 @@ def _validar_configuracion_critica():
 def _solicitar_detencion(signum, _frame):
     LOGGER.info("Señal de detención recibida: signal=%s", signum)
     STOP_REQUESTED.set()
+    ESCUCHA.despertar()
+
+
+def _registrar_resultado(futuro):
+    try:
+        resultado = futuro.result()
+    except Exception as exc:
+        LOGGER.error(
+            "Error inesperado en el ejecutor multimedia: tipo_error=%s",
+            type(exc).__name__,
+        )
+        return
+
+    status = resultado.get("status") if isinstance(resultado, dict) else None
+    if status not in {"completed", "failed"}:
+        LOGGER.warning("Resultado multimedia inesperado: status=%s", status)
+
+
+def _procesar_con_lease(latido, lease, presupuesto):
+    try:
+        return procesar_trabajo_multimedia(lease.trabajo, presupuesto, lease)
+    finally:
+        latido.liberar(lease.trabajo)
+
+
+def _refrescar_medias_salientes_periodicamente(intervalo):
+    """
+    Hilo aparte: subir un video a Meta puede tardar y no debe frenar la
+    reclamación de trabajos entrantes.
+    """
+    while not STOP_REQUESTED.wait(intervalo):
+        try:
+            refrescados = refrescar_medias_salientes()
+            if refrescados:
+                LOGGER.info("Media saliente refrescada: count=%s", refrescados)
+        except Exception as exc:
+            LOGGER.error(
+                "Error refrescando media saliente: tipo_error=%s",
+                type(exc).__name__,
+            )
 
 
 def ejecutar_worker():
@@ -66,9 +271,53 @@ def ejecutar_worker():
     )
     recovery_interval = _obtener_segundos_positivos(
         "WHATSAPP_MEDIA_LEASE_RECOVERY_INTERVAL_SECONDS",
+        15,
+    )
+    lease_timeout = _obtener_segundos_positivos(
+        "WHATSAPP_MEDIA_LEASE_TIMEOUT_SECONDS",
         60,
     )
+    heartbeat_seconds = _obtener_segundos_positivos(
+        "WHATSAPP_MEDIA_LEASE_HEARTBEAT_SECONDS",
+        15,
+    )
+    # Deben caber al menos dos latidos por lease para tolerar uno fallido.
+    if heartbeat_seconds * 2 > lease_timeout:
+        raise RuntimeError(
+            "Configuración inválida: WHATSAPP_MEDIA_LEASE_HEARTBEAT_SECONDS "
+            "debe ser a lo más la mitad de WHATSAPP_MEDIA_LEASE_TIMEOUT_SECONDS"
+        )
+    # Con LISTEN/NOTIFY el poll sólo es una red de seguridad.
+    poll_seconds = _obtener_segundos_positivos(
+        "WHATSAPP_MEDIA_WORKER_POLL_SECONDS",
+        30,
+    )
+    concurrencia = _obtener_entero_positivo(
+        "WHATSAPP_MEDIA_WORKER_CONCURRENCY",
+        1,
+    )
+    tamano_lote = _obtener_entero_positivo(
+        "WHATSAPP_MEDIA_WORKER_BATCH_SIZE",
+        concurrencia,
+    )
+    refresco_salientes_seconds = _obtener_segundos_positivos(
+        "WHATSAPP_OUTBOUND_MEDIA_REFRESH_INTERVAL_SECONDS",
+        10,
+    )
+    presupuesto = PresupuestoBytes(
+        _obtener_entero_positivo(
+            "WHATSAPP_MEDIA_WORKER_MAX_INFLIGHT_BYTES",
+            64 * 1024 * 1024,
+        )
+    )
     _validar_configuracion_critica()
+    # Cada ejecutor usa a lo más una conexión a la vez, más la del loop de
+    # reclamación, la del latido de leases y la del refresco de salientes.
+    if db_pool is not None and concurrencia + 3 > db_pool.maxconn:
+        raise RuntimeError(
+            "Configuración inválida: WHATSAPP_MEDIA_WORKER_CONCURRENCY "
+            f"excede el pool de conexiones ({db_pool.maxconn})"
+        )
 
     signal.signal(signal.SIGTERM, _solicitar_detencion)
     signal.signal(signal.SIGINT, _solicitar_detencion)
@@ -78,8 +327,25 @@ def ejecutar_worker():
         LOGGER.warning("Leases multimedia recuperados al iniciar: count=%s", recuperados)
 
     proxima_recuperacion = time.monotonic() + recovery_interval
-    LOGGER.info("Media worker iniciado")
+    LOGGER.info(
+        "Media worker iniciado: concurrencia=%s, lote=%s",
+        concurrencia,
+        tamano_lote,
+    )
 
+    latido = LatidoLeasesMultimedia(heartbeat_seconds)
+    latido.iniciar()
+    threading.Thread(
+        target=_refrescar_medias_salientes_periodicamente,
+        args=(refresco_salientes_seconds,),
+        name="media-salientes",
+        daemon=True,
+    ).start()
+    en_curso = set()
+    executor = ThreadPoolExecutor(
+        max_workers=concurrencia,
+        thread_name_prefix="media",
+    )
     try:
         while not STOP_REQUESTED.is_set():
             ahora = time.monotonic()
@@ -99,8 +365,18 @@ def ejecutar_worker():
                 finally:
                     proxima_recuperacion = time.monotonic() + recovery_interval
 
+            terminados = {futuro for futuro in en_curso if futuro.done()}
+            for futuro in terminados:
+                _registrar_resultado(futuro)
+            en_curso -= terminados
+
+            libres = concurrencia - len(en_curso)
+            if libres <= 0:
+                wait(en_curso, timeout=idle_seconds, return_when=FIRST_COMPLETED)
+                continue
+
             try:
-                resultado = procesar_un_trabajo_multimedia()
+                trabajos = reclamar_trabajos_multimedia(min(tamano_lote, libres))
             except Exception as exc:
                 LOGGER.error(
                     "Error inesperado en el loop multimedia: tipo_error=%s",
@@ -109,13 +385,36 @@ def ejecutar_worker():
                 STOP_REQUESTED.wait(idle_seconds)
                 continue
 
-            status = resultado.get("status") if isinstance(resultado, dict) else None
-            if status == "no_job":
-                STOP_REQUESTED.wait(idle_seconds)
-            elif status not in {"completed", "failed"}:
-                LOGGER.warning("Resultado multimedia inesperado: status=%s", status)
-                STOP_REQUESTED.wait(idle_seconds)
+            if not trabajos:
+                ESCUCHA.esperar(
+                    _segundos_espera_sin_trabajo(
+                        poll_seconds,
+                        idle_seconds,
+                        proxima_recuperacion,
+                    )
+                )
+                continue
+
+            for trabajo in trabajos:
+                # Se registra al reclamar para que el latido cubra el trabajo
+                # desde antes de que arranque su ejecutor.
+                lease = latido.registrar(trabajo)
+                en_curso.add(
+                    executor.submit(
+                        _procesar_con_lease,
+                        latido,
+                        lease,
+                        presupuesto,
+                    )
+                )
     finally:
+        # Los trabajos en vuelo terminan con su lease; lo no reclamado queda
+        # pending para otra réplica.
+        executor.shutdown(wait=True)
+        latido.detener()
+        for futuro in en_curso:
+            _registrar_resultado(futuro)
+        ESCUCHA.cerrar()
         LOGGER.info("Media worker detenido")
 
 
@@ -0,0 +1,199 @@
+import logging
+import os
+import select
+import signal
+import threading
+
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
+from app import (
+    REALTIME_CANAL_NOTIFY,
+    conectar_db,
+    conectar_db_dedicada,
+    liberar_db,
+    publicar_eventos_realtime,
+)
+from worker_media import _obtener_entero_positivo, _obtener_segundos_positivos
+
+
+LOGGER = logging.getLogger("crm_realtime_worker")
+STOP_REQUESTED = threading.Event()
+
+# Un solo publicador activo conserva el orden por id del outbox; las demás
+# réplicas esperan el lock como respaldo.
+REALTIME_ADVISORY_LOCK = 7_358_001
+
+
+class EscuchaOutbox:
+    """
+    Conexión dedicada con LISTEN sobre el canal del outbox.
+
+    La misma conexión sostiene el advisory lock del publicador: si se pierde,
+    el lock se libera y otra réplica puede tomar el relevo.
+    """
+
+    def __init__(self, canal):
+        self._canal = canal
+        self._conn = None
+        self._pipe_lectura, self._pipe_escritura = os.pipe()
+        os.set_blocking(self._pipe_lectura, False)
+        os.set_blocking(self._pipe_escritura, False)
+
+    @property
+    def activa(self):
+        return self._conn is not None
+
+    def conectar(self):
+        """Regresa True si esta réplica quedó como publicador."""
+        conn = conectar_db_dedicada()
+        conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    "SELECT pg_try_advisory_lock(%s)",
+                    (REALTIME_ADVISORY_LOCK,),
+                )
+                if not cursor.fetchone()[0]:
+                    conn.close()
+                    return False
+                cursor.execute(f'LISTEN "{self._canal}"')
+        except Exception:
+            conn.close()
+            raise
+        self._conn = conn
+        LOGGER.info("Publicador realtime activo: canal=%s", self._canal)
+        return True
+
+    def despertar(self):
+        try:
+            os.write(self._pipe_escritura, b"\0")
+        except (BlockingIOError, OSError):
+            pass
+
+    def esperar(self, timeout):
+        try:
+            listos, _, _ = select.select(
+                [self._conn, self._pipe_lectura],
+                [],
+                [],
+                max(0.0, timeout),
+            )
+            if self._pipe_lectura in listos:
+                try:
+                    while os.read(self._pipe_lectura, 1024):
+                        pass
+                except BlockingIOError:
+                    pass
+            if self._conn in listos:
+                self._conn.poll()
+                notificado = bool(self._conn.notifies)
+                self._conn.notifies.clear()
+                return notificado
+            return False
+        except Exception as exc:
+            LOGGER.error(
+                "Conexión LISTEN realtime perdida: tipo_error=%s",
+                type(exc).__name__,
+            )
+            self.cerrar()
+            return False
+
+    def cerrar(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+            self._conn = None
+
+
+ESCUCHA = EscuchaOutbox(REALTIME_CANAL_NOTIFY)
+
+
+def _validar_configuracion_critica():
+    conn = conectar_db()
+    if not conn:
+        raise RuntimeError("Base de datos no disponible al iniciar el worker")
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM realtime_outbox LIMIT 1")
+    finally:
+        conn.rollback()
+        liberar_db(conn)
+
+
+def _solicitar_detencion(signum, _frame):
+    LOGGER.info("Señal de detención recibida: signal=%s", signum)
+    STOP_REQUESTED.set()
+    ESCUCHA.despertar()
+
+
+def ejecutar_worker():
+    idle_seconds = _obtener_segundos_positivos(
+        "REALTIME_WORKER_IDLE_SECONDS",
+        2,
+    )
+    # Con LISTEN/NOTIFY el poll sólo es una red de seguridad.
+    poll_seconds = _obtener_segundos_positivos(
+        "REALTIME_WORKER_POLL_SECONDS",
+        5,
+    )
+    tamano_lote = _obtener_entero_positivo(
+        "REALTIME_WORKER_BATCH_SIZE",
+        200,
+    )
+    # Tras un NOTIFY se espera esta ventana para juntar los eventos de la
+    # ráfaga y publicarlos por room en un solo eventos_lote.
+    ventana_coalescencia = _obtener_segundos_positivos(
+        "REALTIME_COALESCE_WINDOW_SECONDS",
+        0.25,
+    )
+    _validar_configuracion_critica()
+
+    signal.signal(signal.SIGTERM, _solicitar_detencion)
+    signal.signal(signal.SIGINT, _solicitar_detencion)
+
+    LOGGER.info(
+        "Realtime worker iniciado: lote=%s, ventana=%s",
+        tamano_lote,
+        ventana_coalescencia,
+    )
+    try:
+        while not STOP_REQUESTED.is_set():
+            if not ESCUCHA.activa:
+                try:
+                    activo = ESCUCHA.conectar()
+                except Exception as exc:
+                    LOGGER.error(
+                        "No se pudo abrir LISTEN realtime: tipo_error=%s",
+                        type(exc).__name__,
+                    )
+                    activo = False
+                if not activo:
+                    STOP_REQUESTED.wait(idle_seconds)
+                    continue
+
+            try:
+                publicados = publicar_eventos_realtime(tamano_lote)
+            except Exception as exc:
+                LOGGER.error(
+                    "Error publicando outbox realtime: tipo_error=%s",
+                    type(exc).__name__,
+                )
+                STOP_REQUESTED.wait(idle_seconds)
+                continue
+
+            # Un lote lleno indica atraso: se sigue drenando sin esperar.
+            if publicados < tamano_lote and ESCUCHA.esperar(poll_seconds):
+                STOP_REQUESTED.wait(ventana_coalescencia)
+    finally:
+        ESCUCHA.cerrar()
+        LOGGER.info("Realtime worker detenido")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s %(name)s %(message)s",
+    )
+    ejecutar_worker()